@@ -0,0 +1,35 @@
+'''
+  Measure the import time of PDG material definitions
+
+  Each case is timed in fresh interpreters, as for short-lived workers. The
+  precomputed tables are compared to the Python source tables, which used to
+  be imported on first access. The import of the pumas package itself is not
+  timed.
+
+  Author: Valentin Niess
+'''
+import subprocess
+import sys
+
+
+cases = {
+    'tables (1 material)': 'd.materials["StandardRock"]',
+    'tables (all)': '[d.materials[k] for k in d.materials]',
+    'sources (all)': 'from pumas._materials import data'
+}
+
+n = 20
+for name, statement in cases.items():
+    script = f'''
+import pumas.definitions as d
+import time
+t0 = time.perf_counter()
+{statement}
+print(time.perf_counter() - t0)
+'''
+    dt = []
+    for _ in range(n):
+        output = subprocess.run((sys.executable, '-c', script),
+            capture_output=True, check=True, text=True).stdout
+        dt.append(float(output))
+    print(f'{name:20} {1E+03 * min(dt):7.2f} ms')
@@ -0,0 +1,62 @@
+'''
+  Measure the throughput of vectorised process functions
+
+  Each function is evaluated over a large array of kinetic energies, and the
+  result is compared to a plain Python loop over scalar calls.
+
+  Author: Valentin Niess
+'''
+import numpy
+import time
+from pumas.constants import MUON_MASS
+from pumas.process import Bremsstrahlung, Elastic, Electronic
+
+
+# Standard rock properties
+Z, A, I, density = 11, 22, 136.4E-09, 2.65E+03
+
+# Array of kinetic energies, in GeV
+n = 100000
+energy = numpy.logspace(-2, 6, n)
+
+
+def benchmark(label, vector, scalar, m=1000):
+    '''Compare vectorised and scalar calls
+    '''
+    t0 = time.perf_counter()
+    vector(energy)
+    dt = time.perf_counter() - t0
+    rate = n / dt
+
+    t0 = time.perf_counter()
+    for e in energy[:m]:
+        scalar(float(e))
+    dt = time.perf_counter() - t0
+    rate0 = m / dt
+
+    print(f'{label:26s} {rate:9.3E} calls/s (x {rate / rate0:.1f})')
+
+
+benchmark('Elastic.dcs',
+    lambda e: Elastic.dcs(Z, A, MUON_MASS, e, 1E-03),
+    lambda e: Elastic.dcs(Z, A, MUON_MASS, e, 1E-03))
+
+benchmark('Elastic.free_path',
+    lambda e: Elastic.free_path(Z, A, MUON_MASS, e),
+    lambda e: Elastic.free_path(Z, A, MUON_MASS, e))
+
+benchmark('Electronic.dcs',
+    lambda e: Electronic.dcs(Z, I, MUON_MASS, e, 1E-03 * e),
+    lambda e: Electronic.dcs(Z, I, MUON_MASS, e, 1E-03 * e))
+
+benchmark('Electronic.stopping_power',
+    lambda e: Electronic.stopping_power(Z, A, 1, I, density, MUON_MASS, e),
+    lambda e: Electronic.stopping_power(Z, A, 1, I, density, MUON_MASS, e))
+
+benchmark('Electronic.density_effect',
+    lambda e: Electronic.density_effect(Z, A, 1, I, density, MUON_MASS, e),
+    lambda e: Electronic.density_effect(Z, A, 1, I, density, MUON_MASS, e))
+
+benchmark('Bremsstrahlung.dcs',
+    lambda e: Bremsstrahlung.dcs(Z, A, MUON_MASS, e, 1E-02 * e),
+    lambda e: Bremsstrahlung.dcs(Z, A, MUON_MASS, e, 1E-02 * e))
@@ -0,0 +1,80 @@
+'''
+  Measure the throughput of straight-line ray casting
+
+  An opacity map is computed through a hill made of stacked polyhedral layers,
+  using Geometry.raycast. The result is compared to a transport in
+  'disabled' energy loss mode, which used to be the way to get this.
+
+  Author: Valentin Niess
+'''
+import numpy
+import pumas
+import time
+
+
+# Build the geometry: a pyramidal hill, made of layers of varying density,
+# under an exponential atmosphere
+n_layers, height, width = 20, 500, 2000
+slope = 0.5 * width / height
+layers = []
+for i in range(n_layers):
+    z0, z1 = i * height / n_layers, (i + 1) * height / n_layers
+    w = 0.5 * width * (1 - z0 / height)
+    faces = numpy.array((
+        (0, 0, z0, 0, 0, -1),
+        (0, 0, z1, 0, 0, 1),
+        (w, 0, z0, 1, 0, slope),
+        (-w, 0, z0, -1, 0, slope),
+        (0, w, z0, 0, 1, slope),
+        (0, -w, z0, 0, -1, slope)
+    ))
+    faces[:, 3:] /= numpy.linalg.norm(faces[:, 3:], axis=1)[:, None]
+    density = 2.65E+03 - 20 * i
+    layers.append((faces, pumas.UniformMedium('StandardRock', density)))
+
+geometry = pumas.InfiniteGeometry(pumas.GradientMedium('Air', 1.205,
+    -1.04E+04))
+for faces, medium in layers:
+    geometry.append(pumas.PolyhedronGeometry(faces, medium))
+
+# Lines of sight of a detector at the hill foot
+n_azimuth, n_elevation = 360, 90
+azimuth, elevation = numpy.meshgrid(
+    numpy.radians(numpy.linspace(-60, 60, n_azimuth)),
+    numpy.radians(numpy.linspace(1, 45, n_elevation)))
+directions = numpy.stack((
+    numpy.cos(elevation) * numpy.cos(azimuth),
+    numpy.cos(elevation) * numpy.sin(azimuth),
+    numpy.sin(elevation)), axis=-1)
+origin = (-0.5 * width - 100, 0, 1)
+max_distance = 1E+04
+
+# Ray casting
+t0 = time.perf_counter()
+result = geometry.raycast(origin, directions, max_distance)
+dt = time.perf_counter() - t0
+n = directions.size // 3
+print(f'raycast   {n / dt:9.3E} rays/s')
+
+opacity = numpy.sum(result.grammage, axis=-1)
+print(f'opacity   {opacity.min():.3E} - {opacity.max():.3E} kg/m^2')
+
+# Transport, without any energy loss nor scattering
+simulation = pumas.Context(
+    pumas.Physics('../pumas/examples/data'),
+    geometry = geometry,
+    energy_loss = 'disabled',
+    scattering = 'disabled',
+    distance_limit = max_distance
+)
+
+m = 1000
+states = pumas.StateArray(m)
+states.position = origin
+states.direction = directions.reshape(-1, 3)[:m]
+states.energy = 1E+03
+
+t0 = time.perf_counter()
+simulation.transport(states)
+dt = time.perf_counter() - t0
+print(f'transport {m / dt:9.3E} rays/s')
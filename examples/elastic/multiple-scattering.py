@@ -69,22 +69,9 @@ else:
         raise ValueError(f"bad setup '{setup}'")
 
 
-def Box(center, hx, hy, hz):
-    '''Helper function for creating data for an axis aligned box
-    '''
-    x0, y0, z0 = center
-    return (
-        (x0 + hx, 0, 0,  1,  0,  0),
-        (0, y0 + hy, 0,  0,  1,  0),
-        (0, 0, z0 + hz,  0,  0,  1),
-        (x0 - hx, 0, 0, -1,  0,  0),
-        (0, y0 - hy, 0,  0, -1,  0),
-        (0, 0, z0 - hz,  0,  0, -1)
-    )
-
 medium = pumas.UniformMedium(material, density)
-geometry = pumas.PolyhedronGeometry(
-    Box((0, 0, 0.5 * thickness), 10, 10, 0.5 * thickness), medium=medium)
+geometry = pumas.BoxGeometry((20, 20, thickness),
+    center=(0, 0, 0.5 * thickness), medium=medium)
 
 # Create the transport engine
 simulation = pumas.Context(
@@ -0,0 +1,54 @@
+'''
+  Tabulate the muon flux under a flat rock overburden
+
+  The flux is computed by backward transport, from underground positions up to
+  the ground, where a parametric sea level flux is used. Grid nodes are spread
+  over all cores, and checkpointed. Thus, the job can be interrupted and
+  resumed by running this script again. The result is written as a flux
+  tabulation file, which is loaded back and interpolated.
+
+  Author: Valentin Niess
+'''
+import numpy
+import pumas
+
+
+def gaisser(energy, cos_theta, altitude, charge):
+    '''Gaisser's parametrisation of the sea level muon flux, in
+       1 / (GeV m^2 s sr)
+    '''
+    ratio = 1.2766
+    fraction = numpy.where(charge > 0, ratio / (1 + ratio), 1 / (1 + ratio))
+    c = numpy.maximum(cos_theta, 0)
+    e = energy + 0.10566
+    flux = 1.4E+03 * e**-2.7 * (1 / (1 + 1.1 * e * c / 115) +
+        0.054 / (1 + 1.1 * e * c / 850))
+    return numpy.where(cos_theta > 0, flux * fraction, 0)
+
+
+# Geometry: a 1 km thick slab of rock, with its top side at z = 0
+depth = 1E+03
+geometry = pumas.SlabGeometry(depth, center=(0, 0, -0.5 * depth),
+    medium=pumas.UniformMedium('StandardRock', 2.65E+03))
+
+tabulator = pumas.FluxTabulator(
+    pumas.Physics('../pumas/examples/data'),
+    geometry,
+    gaisser,
+    energy = (1E-01, 1E+04),
+    cos_theta = (0.1, 1),
+    altitude = (-depth, 0),
+    shape = (41, 10, 11),
+    events = 1000,
+    seed = 2024,
+    energy_limit = 1E+06
+)
+
+tabulator.run('flux-rock.bin', checkpoint='flux-rock.npz', interval=60)
+
+# Interpolate the resulting tabulation
+flux = pumas.FluxTabulation('flux-rock.bin')
+altitude = numpy.linspace(-depth, 0, 11)
+print('altitude (m)   flux(100 GeV, vertical) (1 / (GeV m^2 s sr))')
+for h, f in zip(altitude, flux(1E+02, 1, altitude)):
+    print(f'{h:12.1f}   {f:.3E}')
@@ -0,0 +1,59 @@
+'''
+  Transport muons through placed copies of a detector
+
+  A detector module is frozen once, and placed several times along a tilted
+  ring, without duplicating its definition. Muons are generated in the frame
+  of the experimental hall, which is rotated w.r.t. the frame of the geometry.
+  Thus, states are transformed on the fly by the transport context.
+
+  Author: Valentin Niess
+'''
+import numpy
+import pumas
+
+
+# A detector module: a water slab, with a dense absorber plate on top
+module = pumas.BoxGeometry((1, 1, 0.1), medium=pumas.UniformMedium('Water'))
+module.append(pumas.BoxGeometry((1, 1, 0.02), center=(0, 0, 0.04),
+    medium=pumas.UniformMedium('StandardRock', 11.35E+03)))
+module.freeze()
+
+# Place copies of the module around the vertical axis, facing outwards
+geometry = pumas.InfiniteGeometry(pumas.UniformMedium('Air', 1.205))
+n_modules, radius = 12, 3
+for i in range(n_modules):
+    phi = 360 * i / n_modules
+    rotation = pumas.UnitaryTransformation.from_euler('yz', (90, phi))
+    translation = radius * numpy.array((numpy.cos(numpy.radians(phi)),
+        numpy.sin(numpy.radians(phi)), 0))
+    frame = pumas.UnitaryTransformation(rotation.matrix, translation)
+    geometry.append(pumas.PlacedGeometry(module, frame))
+
+# The hall frame is tilted by 15 deg w.r.t. the frame of the geometry
+simulation = pumas.Context(
+    pumas.Physics('../pumas/examples/data'),
+    geometry = geometry,
+    frame = pumas.UnitaryTransformation.from_euler('x', -15),
+    distance_limit = 2 * radius
+)
+
+# Generate muons at the center of the hall, with isotropic directions
+n = 10000
+states = pumas.StateArray(n)
+states.energy = 1
+rng = numpy.random.default_rng(2024)
+cos_theta = rng.uniform(-1, 1, n)
+phi = rng.uniform(0, 2 * numpy.pi, n)
+sin_theta = numpy.sqrt(1 - cos_theta**2)
+states.direction = numpy.stack((sin_theta * numpy.cos(phi),
+    sin_theta * numpy.sin(phi), cos_theta), axis=-1)
+
+simulation.transport(states)
+
+# States are returned in the hall frame
+elevation = numpy.degrees(numpy.arcsin(cos_theta))
+hit = states.grammage > 1.5 * states.distance
+for e0, e1 in ((-90, -30), (-30, 0), (0, 30), (30, 90)):
+    sel = (elevation >= e0) & (elevation < e1)
+    print(f'elevation [{e0:3d}, {e1:3d}) deg: {numpy.mean(hit[sel]):.3f} '
+          'hit fraction')
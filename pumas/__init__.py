@@ -1,13 +1,23 @@
 from .context import Context
+from .coordinates import UnitaryTransformation
 from .core import LibraryError
-from .geometry import InfiniteGeometry, PolyhedronGeometry
+from .flux import FluxTabulation, FluxTabulator
+from .geometry import BoxGeometry, ConeGeometry, CylinderGeometry,             \
+    EarthGeometry, InfiniteGeometry, MagnetGrid, MeshGeometry,                 \
+    PlacedGeometry, PolyhedronGeometry, SlabGeometry, SphereGeometry,          \
+    Topography, VoxelGeometry
 from .libpumas import lib
-from .medium import UniformMedium
+from .medium import GradientMedium, UniformMedium
 from .physics import Physics
+from .recorder import Recorder
 from .state import StateArray
 
-__all__ = ('Context', 'ffi', 'InfiniteGeometry', 'lib', 'LibraryError',
-    'Physics', 'PolyhedronGeometry', 'StateArray', 'UniformMedium')
+__all__ = ('BoxGeometry', 'ConeGeometry', 'Context', 'CylinderGeometry',
+    'EarthGeometry', 'ffi', 'FluxTabulation', 'FluxTabulator',
+    'GradientMedium', 'InfiniteGeometry', 'lib', 'LibraryError', 'MagnetGrid',
+    'MeshGeometry', 'Physics', 'PlacedGeometry', 'PolyhedronGeometry',
+    'Recorder', 'SlabGeometry', 'SphereGeometry', 'StateArray', 'Topography',
+    'UniformMedium', 'UnitaryTransformation', 'VoxelGeometry')
 
 
 def _initialise():
@@ -1,5 +1,5 @@
 #pragma once
-#include "turtle.h"
+#include <stddef.h>
 
 /* Coordinates objects */
 struct pumas_coordinates_unitary_transformation {
@@ -116,3 +116,38 @@ void pumas_coordinates_frame_initialise_local(
     const struct pumas_cartesian_point * cartesian,
     const struct pumas_geodetic_point * geodetic, double declination,
     double inclination);
+
+/* Vectorised conversions, over n items. Strides between consecutive items are
+ * given in number of doubles, e.g. 0 for a broadcasted item. Geodetic points
+ * are (latitude, longitude, altitude), and horizontal directions (azimuth,
+ * elevation), with angles in degrees.
+ */
+void pumas_coordinates_ecef_from_geodetic_v(size_t n,
+    const double * geodetic, size_t geodetic_stride, double * ecef,
+    size_t ecef_stride);
+
+void pumas_coordinates_ecef_to_geodetic_v(size_t n, const double * ecef,
+    size_t ecef_stride, double * geodetic, size_t geodetic_stride);
+
+void pumas_coordinates_ecef_from_horizontal_v(size_t n,
+    const double * geodetic, size_t geodetic_stride,
+    const double * horizontal, size_t horizontal_stride, double * direction,
+    size_t direction_stride);
+
+void pumas_coordinates_ecef_to_horizontal_v(size_t n,
+    const double * geodetic, size_t geodetic_stride, const double * direction,
+    size_t direction_stride, double * horizontal, size_t horizontal_stride);
+
+/* Vectorised transforms of cartesian points or vectors, from the given frame
+ * to its parent one, or the opposite if inverse is not null. Input and output
+ * data might overlap.
+ */
+void pumas_coordinates_point_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, const double * points, size_t points_stride,
+    double * out, size_t out_stride);
+
+void pumas_coordinates_vector_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, const double * vectors, size_t vectors_stride,
+    double * out, size_t out_stride);
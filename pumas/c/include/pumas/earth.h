@@ -4,6 +4,51 @@
 #include "turtle.h"
 
 
+/* Topography data, shared between contexts. Either a stack of tiles, with a
+ * bounded cache of decoded tiles, or a single map.
+ */
+struct pumas_earth_topography {
+        struct turtle_stack * stack;
+        struct turtle_map * map;
+};
+
+enum pumas_return pumas_earth_topography_create(
+    struct pumas_earth_topography ** topography, const char * path,
+    int cache_size);
+
+void pumas_earth_topography_destroy(
+    struct pumas_earth_topography ** topography);
+
+/* Geomagnetic field snapshot, shared between contexts */
+enum pumas_return pumas_earth_magnet_create(struct gull_snapshot ** snapshot,
+    const char * path, int day, int month, int year);
+
+void pumas_earth_magnet_destroy(struct gull_snapshot ** snapshot);
+
+/* Geomagnetic field tabulated over a regular geodetic grid, for trilinear
+ * interpolation. The field is stored in ECEF frame, in row major order with
+ * shape (latitude, longitude, altitude, 3).
+ */
+struct pumas_earth_magnet_grid {
+        int shape[3];
+        double latitude[2];
+        double longitude[2];
+        double altitude[2];
+        const double * data;
+};
+
+/* Tabulate the field of a snapshot over a grid */
+enum pumas_return pumas_earth_magnet_grid_compute(
+    struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid, double * data);
+
+/* Vectorised geomagnetic field, in ECEF frame, at geodetic positions. The grid
+ * is used if not NULL, otherwise the snapshot.
+ */
+enum pumas_return pumas_earth_magnet_field_v(struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid, int n,
+    const double * geodetic, double * magnet);
+
 /* Per context data for the Earth geometry */
 struct pumas_geometry_earth {
         struct pumas_geometry base;
@@ -15,6 +60,7 @@ struct pumas_geometry_earth {
         struct {
                 double * workspace[1];
                 struct gull_snapshot * snapshot[1];
+                const struct pumas_earth_magnet_grid * grid;
                 double distance;
                 double last[3];
         } magnet;
@@ -28,6 +74,19 @@ void pumas_geometry_earth_get(struct pumas_geometry * geometry,
 double pumas_geometry_earth_magnet(struct pumas_geometry * geometry,
     struct pumas_state * state, double * magnet);
 
+/* Create an Earth geometry with layered media. Layers are given from bottom
+ * to top. The top surface of a layer is described by topography data, with
+ * an elevation offset, or by a constant altitude if no data are provided. The
+ * geoid and the geomagnetic field are optional. The field is interpolated from
+ * a grid, if provided, or evaluated from a snapshot. Note that topography data
+ * and the geomagnetic field are not owned by the geometry.
+ */
+struct pumas_geometry_earth * pumas_geometry_earth_create(int n_layers,
+    struct pumas_medium ** media, struct pumas_earth_topography ** topography,
+    const double * offsets, struct pumas_earth_topography * geoid,
+    struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid);
+
 /* Initialiser for the Earth geometry */
 void pumas_geometry_earth_reset(struct pumas_geometry * geometry);
 
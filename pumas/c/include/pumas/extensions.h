@@ -5,6 +5,36 @@ extern "C" {
 #endif
 
 #include "pumas.h"
+#include "pumas/coordinates.h"
+
+/* Bounding Volume Hierarchy (BVH) of Axis Aligned Bounding Boxes (AABBs).
+ *
+ * Boxes are stored as {xmin, ymin, zmin, xmax, ymax, zmax}. For internal nodes
+ * `first` is the index of the left child node, the right one following it. For
+ * leaves, `count` is non null and `first` indexes the sorted items.
+ */
+struct pumas_bvh_node {
+        double box[6];
+        int first;
+        int count;
+};
+
+/* Build a BVH from n boxes, into nodes (at least 2 n - 1 of them). The
+ * permutation of items, in leaves order, is returned in index.
+ */
+int pumas_bvh_build(int n, const double * boxes,
+    struct pumas_bvh_node * nodes, int * index);
+
+/* Index of daughter volumes */
+struct pumas_geometry;
+
+struct pumas_geometry_bvh {
+        int n_nodes;
+        int n_bounded;
+        int n_unbounded;
+        struct pumas_geometry ** daughters;
+        struct pumas_bvh_node nodes[];
+};
 
 /* Wrapper for geometries */
 struct pumas_geometry {
@@ -14,21 +44,67 @@ struct pumas_geometry {
             double *);
         void (*reset)(struct pumas_geometry *);
         void (*destroy)(struct pumas_geometry *);
+        int (*box)(struct pumas_geometry *, double *);
 
         struct pumas_geometry * mother;
         struct pumas_geometry * daughters;
         struct pumas_geometry * next;
+
+        struct pumas_geometry_bvh * bvh;
+
+        size_t size; /* Size of the memory block, or 0 if not relocatable */
+        int frozen;
 };
 
 /* A transparent medium, e.g. for a bounding box */
 extern struct pumas_medium * PUMAS_MEDIUM_TRANSPARENT;
 
+/* Recorder of Monte Carlo steps.
+ *
+ * Records are appended to a growable buffer, for one every `period` events
+ * and up to `max_steps` steps per event (if strictly positive). The last
+ * record of an event holds its final state, with a null step.
+ */
+struct pumas_recorder_record {
+        long event;
+        double position[3];
+        double direction[3];
+        double energy;
+        double step;
+        struct pumas_medium * medium;
+};
+
+struct pumas_recorder {
+        long period;
+        long max_steps;
+        long event;
+        long steps;
+        size_t size;
+        size_t capacity;
+        struct pumas_recorder_record * records;
+};
+
+struct pumas_recorder * pumas_recorder_create(long period, long max_steps);
+void pumas_recorder_destroy(struct pumas_recorder * recorder);
+void pumas_recorder_clear(struct pumas_recorder * recorder);
+void pumas_recorder_start(struct pumas_recorder * recorder);
+void pumas_recorder_record(struct pumas_recorder * recorder,
+    struct pumas_state * state, struct pumas_medium * medium, double step);
+void pumas_recorder_stop(struct pumas_recorder * recorder,
+    struct pumas_state * state, struct pumas_medium * medium);
+
 /* Layout of the user data section */
 struct pumas_user_data {
         struct pumas_geometry * top;
         struct pumas_geometry * current;
         void (*callback)(struct pumas_geometry *, struct pumas_state *,
             struct pumas_medium *, double); /* User callback for debug */
+        struct pumas_recorder * recorder; /* Steps recorder, if any */
+        int stateful; /* Flag for geometries with reset hook(s) */
+        /* Local frame of the geometry, if any. States are transformed to it
+         * before their transport, and back afterwards.
+         */
+        const struct pumas_coordinates_unitary_transformation * frame;
 };
 
 /* Forward errors */
@@ -52,6 +128,28 @@ struct pumas_state_extended {
                 double distance;
                 double last[3];
         } vertical;
+
+        /* Isotropic safety distance, i.e. a sphere around the origin within
+         * which the medium is unchanged. Geometry getters report their safety
+         * as value, or leave it negative if not supported.
+         */
+        struct {
+                double value;
+                double radius;
+                double origin[3];
+                double direction[3];
+                double step;
+                struct pumas_medium * medium;
+                struct pumas_geometry * current;
+        } safety;
+
+        /* Current node within a placed geometry, and its local frame w.r.t.
+         * the parent one. These are set when a placement is located.
+         */
+        struct {
+                struct pumas_geometry * current;
+                struct pumas_coordinates_unitary_transformation frame;
+        } local;
 };
 
 void pumas_state_extended_reset(struct pumas_state_extended * state,
@@ -104,11 +202,29 @@ void pumas_geometry_set(
 
 void pumas_geometry_destroy(struct pumas_context * context);
 
+/* Destroy a geometry hierarchy that is not bound to any context */
+void pumas_geometry_tree_destroy(struct pumas_geometry * geometry);
+
+/* Reset the per-context state of the geometry. This is a no-op, but for the
+ * current node, unless some node had a reset hook when the geometry was set.
+ */
 void pumas_geometry_reset(struct pumas_context * context);
 
+/* Check if a geometry hierarchy has reset hook(s), i.e. a per-context state */
+int pumas_geometry_stateful(const struct pumas_geometry * geometry);
+
 void pumas_geometry_push(struct pumas_geometry * geometry,
     struct pumas_geometry * daughter);
 
+/* Compile a geometry into a single, immutable, memory block that can be
+ * shared between contexts. The source geometry is destroyed. NULL is returned
+ * if the geometry cannot be frozen, e.g. if some node holds a per-context
+ * state.
+ */
+struct pumas_geometry * pumas_geometry_freeze(struct pumas_geometry * geometry);
+
+void pumas_geometry_frozen_destroy(struct pumas_geometry * geometry);
+
 /* Generic geometry callback for PUMAS */
 enum pumas_step pumas_geometry_medium(struct pumas_context * context,
     struct pumas_state * state, struct pumas_medium ** medium_p,
@@ -138,18 +254,175 @@ struct pumas_geometry_polyhedron {
         struct pumas_polyhedron_face faces[];
 };
 
-/* Create and destroy a polyhedron geometry */
+/* Create and destroy a polyhedron geometry. Faces normals must be unit
+ * vectors.
+ */
 struct pumas_geometry_polyhedron * pumas_geometry_polyhedron_create(
     struct pumas_medium * medium, int n_faces);
 
+/* Create a hierarchy of n polyhedrons, given in depth first order. The faces
+ * of all polyhedrons are concatenated, as {origin, normal} 6-vectors. Normals
+ * are normalised on copy.
+ */
+struct pumas_geometry * pumas_geometry_polyhedron_create_v(int n,
+    const int * depths, const int * n_faces, struct pumas_medium ** media,
+    const double * faces);
+
 void pumas_geometry_polyhedron_destroy(struct pumas_geometry * geometry);
 
+/* Bounding box of a Polyhedron geometry, or 0 if unbounded */
+int pumas_geometry_polyhedron_box(struct pumas_geometry * geometry,
+    double * box);
+
 /* Getter for a Polyhedron geometry */
 void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
     struct pumas_state * state, struct pumas_medium ** medium_p,
     double * step_p);
 
-/* Flux tabulations */
+/* Data for the Mesh geometry, i.e. a closed triangular mesh. The BVH nodes
+ * (2 n_triangles - 1 of them) are followed by the vertices and then by the
+ * triangles, sorted according to the BVH leaves.
+ */
+struct pumas_geometry_mesh {
+        struct pumas_geometry base;
+        struct pumas_medium * medium;
+
+        int n_vertices;
+        int n_triangles;
+        int n_nodes;
+        struct pumas_bvh_node nodes[];
+};
+
+/* Create a mesh geometry from vertices and triangles (as vertices indices) */
+struct pumas_geometry_mesh * pumas_geometry_mesh_create(
+    struct pumas_medium * medium, int n_vertices, const double * vertices,
+    int n_triangles, const int * triangles);
+
+/* Bounding box of a Mesh geometry */
+int pumas_geometry_mesh_box(struct pumas_geometry * geometry, double * box);
+
+/* Getter for a Mesh geometry */
+void pumas_geometry_mesh_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p);
+
+/* Data for the Voxel geometry, i.e. a regular grid of voxels. The material
+ * indices and the densities are referenced, not copied. Voxels are indexed
+ * in C order, with negative material indices standing for void.
+ */
+struct pumas_geometry_voxel {
+        struct pumas_geometry base;
+        int shape[3];
+        double origin[3];
+        double size[3];
+        const int * indices;
+        const double * densities;
+        struct pumas_medium ** media;
+};
+
+/* Create a voxel geometry */
+struct pumas_geometry_voxel * pumas_geometry_voxel_create(const int * shape,
+    const double * origin, const double * size, const int * indices,
+    const double * densities, struct pumas_medium ** media);
+
+/* Bounding box of a Voxel geometry */
+int pumas_geometry_voxel_box(struct pumas_geometry * geometry, double * box);
+
+/* Getter for a Voxel geometry */
+void pumas_geometry_voxel_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p);
+
+/* A medium whose density is given by the current voxel geometry */
+void pumas_medium_voxel_initialise(struct pumas_medium * medium, int material);
+
+/* Analytic primitive solids. Depending on the type, the size parameters are:
+ * - BOX: half widths along the x, y and z axes.
+ * - SPHERE: radius.
+ * - CYLINDER: radius and half length along the axis (possibly infinite).
+ * - CONE: radius at the bottom and at the top, and half length along the
+ *   axis, i.e. a conical frustum.
+ * - SLAB: half thickness along the axis.
+ */
+enum pumas_primitive_type {
+        PUMAS_PRIMITIVE_BOX = 0,
+        PUMAS_PRIMITIVE_SPHERE,
+        PUMAS_PRIMITIVE_CYLINDER,
+        PUMAS_PRIMITIVE_CONE,
+        PUMAS_PRIMITIVE_SLAB
+};
+
+struct pumas_geometry_primitive {
+        struct pumas_geometry base;
+        struct pumas_medium * medium;
+
+        enum pumas_primitive_type type;
+        double center[3];
+        double axis[3];
+        double size[3];
+};
+
+/* Create a primitive geometry */
+struct pumas_geometry_primitive * pumas_geometry_primitive_create(
+    struct pumas_medium * medium, enum pumas_primitive_type type,
+    const double * center, const double * axis, const double * size);
+
+/* Bounding box of a primitive geometry, or 0 if unbounded */
+int pumas_geometry_primitive_box(struct pumas_geometry * geometry,
+    double * box);
+
+/* Getter for a primitive geometry */
+void pumas_geometry_primitive_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p);
+
+/* A placed geometry, i.e. a content hierarchy expressed in a local frame.
+ * States are transformed to the local frame while navigating the content. If
+ * the content is not owned, e.g. if it is frozen, it is not destroyed with the
+ * placement. Then, it can be shared by several placements.
+ */
+struct pumas_geometry_placement {
+        struct pumas_geometry base;
+        struct pumas_coordinates_unitary_transformation frame;
+        struct pumas_geometry * content;
+        int owned;
+};
+
+/* Create a placed geometry */
+struct pumas_geometry_placement * pumas_geometry_placement_create(
+    struct pumas_geometry * content, int owned,
+    const struct pumas_coordinates_unitary_transformation * frame);
+
+/* Bounding box of a placed geometry, or 0 if unbounded */
+int pumas_geometry_placement_box(struct pumas_geometry * geometry,
+    double * box);
+
+/* Getter for a placed geometry */
+void pumas_geometry_placement_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p);
+
+/* Integral of q^order * dcs(q) over [q0, q1] */
+double pumas_dcs_integrate(pumas_dcs_t * dcs, double Z, double A,
+    double mass, double energy, int order, double q0, double q1);
+
+/* Tabulation of the normalised CDF of a DCS, over log(q) */
+enum pumas_return pumas_dcs_sampler_tabulate(pumas_dcs_t * dcs,
+    enum pumas_process process, double Z, double A, double mass,
+    double energy, double cutoff, int n, double * cdf);
+
+/* Flux tabulations.
+ *
+ * Two file formats are supported. Version 1 files contain the shape, as 3
+ * int64, the ranges, as 6 doubles, and the flux, as floats. Version 2 files
+ * start with a 128 bytes header, i.e. the "PUMASFLX" magic string, the
+ * version and a byte order mark (0x01020304), as uint32, the shape and the
+ * ranges, followed by the flux, as floats. Version 2 data are memory mapped,
+ * if their byte order is native.
+ *
+ * The flux is indexed as [h][c][k][charge], where index 0 (1) stands for
+ * positive (negative) charges.
+ */
 struct pumas_flux_tabulation {
         int n_k;
         int n_c;
@@ -160,15 +433,31 @@ struct pumas_flux_tabulation {
         double c_max;
         double h_min;
         double h_max;
-        float data[];
+        /* Grid steps, precomputed at load */
+        double dlk;
+        double dc;
+        double dh;
+        const float * data;
+        void * map; /* Memory mapped file, if any */
+        size_t map_size;
 };
 
 struct pumas_flux_tabulation * pumas_flux_tabulation_load(const char * path);
+void pumas_flux_tabulation_destroy(struct pumas_flux_tabulation * tabulation);
 
 double pumas_flux_tabulation_get(
     const struct pumas_flux_tabulation * tabulation, double k, double c,
     double h, double charge);
 
+/* Vectorised flux, using the same scheme than pumas_flux_tabulation_get, i.e.
+ * a linear interpolation along cos(theta), and a log one along log(kinetic
+ * energy) and altitude, except for null values.
+ */
+void pumas_flux_tabulation_get_v(
+    const struct pumas_flux_tabulation * tabulation, size_t n,
+    const double * k, const double * c, const double * h,
+    const double * charge, double * flux);
+
 #ifdef __cplusplus
 }
 #endif
@@ -6,19 +6,48 @@ extern "C" {
 
 #include "pumas.h"
 
+struct pumas_coordinates_unitary_transformation;
+struct pumas_geometry;
 
+/* Vectorised transport. The events ending the transport of states are
+ * returned, if events is not NULL.
+ */
 enum pumas_return pumas_context_transport_v(struct pumas_context * context,
-    size_t n_states, struct pumas_state * states);
+    size_t n_states, struct pumas_state * states, enum pumas_event * events);
+
+/* Transform the positions and directions of states, in place, from a local
+ * frame to its parent one, or conversely if inverse is not null
+ */
+void pumas_state_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, struct pumas_state * states);
 
 void pumas_context_random_v(
     struct pumas_context * context, size_t n, double * data);
 
 void pumas_dcs_call_v(pumas_dcs_t * dcs, double Z, double A, double mass,
-    double energy, size_t n, double * qs, double * values);
+    size_t n, double * energies, double * qs, double * values);
+
+enum pumas_return pumas_dcs_integrate_v(pumas_dcs_t * dcs,
+    enum pumas_process process, double Z, double A, double mass, int order,
+    double x0, double x1, size_t n, double * energies, double * values);
+
+enum pumas_return pumas_dcs_sample_v(enum pumas_process process, double Z,
+    double mass, double cutoff, int n_nodes, const double * nodes, int n_cdf,
+    const double * cdfs, size_t n, double * energies, double * randoms,
+    double * values);
 
 void pumas_elastic_path_v(int order, double Z, double A, double mass,
     size_t n, double * energies, double * values);
 
+void pumas_electronic_density_effect_v(int n_elements, const double * Z,
+    const double * A, const double * w, double I, double density,
+    double mass, size_t n, double * energies, double * values);
+
+void pumas_electronic_stopping_power_v(int n_elements, const double * Z,
+    const double * A, const double * w, double I, double density,
+    double mass, size_t n, double * energies, double * values);
+
 enum pumas_return pumas_physics_property_elastic_cutoff_angle_v(
     const struct pumas_physics * physics, int material, size_t n,
     double * energies, double * values);
@@ -55,6 +84,11 @@ enum pumas_return pumas_physics_table_value_v(
     const struct pumas_physics * physics, enum pumas_property property,
     enum pumas_mode scheme, int material, double * values);
 
+enum pumas_return pumas_geometry_raycast_v(struct pumas_geometry * geometry,
+    int n_threads, int n_media, struct pumas_medium ** media, size_t n,
+    const double * origins, const double * directions,
+    const double * max_distances, double * grammages, double * distances);
+
 #ifdef __cplusplus
 }
 #endif
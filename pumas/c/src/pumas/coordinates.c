@@ -1,4 +1,112 @@
-#include "pumas_coordinates.h"
+#include <float.h>
+#include <math.h>
+#include <string.h>
+
+#include "pumas/coordinates.h"
+
+
+/* WGS84 ellipsoid, and conversions between ECEF and geodetic coordinates, or
+ * local horizontal directions. Angles are in degrees.
+ */
+#define WGS84_A 6378137.
+#define WGS84_E2 6.69437999014E-03
+#define DEG (M_PI / 180.)
+
+static void ecef_from_geodetic(double latitude, double longitude,
+    double altitude, double * ecef)
+{
+        const double s = sin(latitude * DEG);
+        const double c = cos(latitude * DEG);
+        const double n = WGS84_A / sqrt(1. - WGS84_E2 * s * s);
+        const double rho = (n + altitude) * c;
+        ecef[0] = rho * cos(longitude * DEG);
+        ecef[1] = rho * sin(longitude * DEG);
+        ecef[2] = (n * (1. - WGS84_E2) + altitude) * s;
+}
+
+
+static void ecef_to_geodetic(const double * ecef, double * latitude,
+    double * longitude, double * altitude)
+{
+#define GEODETIC_MAX_ITERATIONS 10
+
+        const double rho = sqrt(ecef[0] * ecef[0] + ecef[1] * ecef[1]);
+        *longitude = (rho > 0.) ? atan2(ecef[1], ecef[0]) / DEG : 0.;
+
+        /* Iterate on the latitude, starting from the spherical one */
+        double phi = atan2(ecef[2], rho * (1. - WGS84_E2));
+        double s, n;
+        int i;
+        for (i = 0; i < GEODETIC_MAX_ITERATIONS; i++) {
+                s = sin(phi);
+                n = WGS84_A / sqrt(1. - WGS84_E2 * s * s);
+                const double tmp = atan2(ecef[2] + WGS84_E2 * n * s, rho);
+                const double delta = fabs(tmp - phi);
+                phi = tmp;
+                if (delta <= 1E-14) break;
+        }
+        s = sin(phi);
+        n = WGS84_A / sqrt(1. - WGS84_E2 * s * s);
+
+        *latitude = phi / DEG;
+        *altitude = rho * cos(phi) + ecef[2] * s -
+            n * (1. - WGS84_E2 * s * s);
+
+#undef GEODETIC_MAX_ITERATIONS
+}
+
+
+/* Basis of the local East, North, Up (ENU) frame, as columns */
+static void enu_basis(double latitude, double longitude, double basis[3][3])
+{
+        const double sla = sin(latitude * DEG), cla = cos(latitude * DEG);
+        const double slo = sin(longitude * DEG), clo = cos(longitude * DEG);
+        basis[0][0] = -slo;
+        basis[1][0] = clo;
+        basis[2][0] = 0.;
+        basis[0][1] = -sla * clo;
+        basis[1][1] = -sla * slo;
+        basis[2][1] = cla;
+        basis[0][2] = cla * clo;
+        basis[1][2] = cla * slo;
+        basis[2][2] = sla;
+}
+
+
+static void ecef_from_horizontal(double latitude, double longitude,
+    double azimuth, double elevation, double * direction)
+{
+        double basis[3][3];
+        enu_basis(latitude, longitude, basis);
+
+        const double ce = cos(elevation * DEG);
+        const double enu[3] = {ce * sin(azimuth * DEG),
+            ce * cos(azimuth * DEG), sin(elevation * DEG)};
+        int i;
+        for (i = 0; i < 3; i++) {
+                direction[i] = basis[i][0] * enu[0] + basis[i][1] * enu[1] +
+                    basis[i][2] * enu[2];
+        }
+}
+
+
+static void ecef_to_horizontal(double latitude, double longitude,
+    const double * direction, double * azimuth, double * elevation)
+{
+        double basis[3][3];
+        enu_basis(latitude, longitude, basis);
+
+        double enu[3];
+        int i;
+        for (i = 0; i < 3; i++) {
+                enu[i] = basis[0][i] * direction[0] +
+                    basis[1][i] * direction[1] + basis[2][i] * direction[2];
+        }
+
+        const double rho = sqrt(enu[0] * enu[0] + enu[1] * enu[1]);
+        *azimuth = (rho > 0.) ? atan2(enu[0], enu[1]) / DEG : 0.;
+        *elevation = atan2(enu[2], rho) / DEG;
+}
 
 
 /* Coordinates transforms */
@@ -100,8 +208,8 @@ void pumas_coordinates_cartesian_vector_transform(
 static void cartesian_from_geodetic(struct pumas_cartesian_point * self,
     const struct pumas_geodetic_point * point)
 {
-        turtle_ecef_from_geodetic(point->latitude, point->longitude,
-                                  point->altitude, (double *)self);
+        ecef_from_geodetic(point->latitude, point->longitude,
+                           point->altitude, (double *)self);
 }
 
 
@@ -181,7 +289,6 @@ static void spherical_from_cartesian(void * self_, const void * point_)
         const double rho = sqrt(rho2);
         self->theta = atan2(rho, point->z);
 
-        double phi;
         if (fabs(self->theta) <= FLT_EPSILON)
                 self->phi = 0;
         else
@@ -240,8 +347,8 @@ void pumas_coordinates_geodetic_point_from_cartesian(
                 point = &tmp;
         }
 
-        turtle_ecef_to_geodetic((double *)point, &self->latitude,
-                                &self->longitude, &self->altitude);
+        ecef_to_geodetic((double *)point, &self->latitude,
+                         &self->longitude, &self->altitude);
 }
 
 
@@ -252,11 +359,12 @@ void pumas_coordinates_geodetic_point_from_spherical(
         struct pumas_cartesian_point tmp;
         cartesian_from_spherical(&tmp, point);
 
+        tmp.frame = point->frame;
         if (point->frame != NULL)
                 cartesian_point_transform(&tmp, NULL);
 
-        turtle_ecef_to_geodetic((double *)point, &self->latitude,
-                                &self->longitude, &self->altitude);
+        ecef_to_geodetic((double *)&tmp, &self->latitude,
+                         &self->longitude, &self->altitude);
 }
 
 
@@ -437,18 +545,139 @@ void pumas_coordinates_frame_initialise_local(
         double tmp[3];
         int i;
 
-        turtle_ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
+        ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
             90 + declination, 0, tmp);
         for (i = 0; i < 3; i++)
                 frame->matrix[i][0] = tmp[i];
 
-        turtle_ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
+        ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
             declination, -inclination, tmp);
         for (i = 0; i < 3; i++)
                 frame->matrix[i][1] = tmp[i];
 
-        turtle_ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
+        ecef_from_horizontal(geodetic->latitude, geodetic->longitude,
             0, 90 - inclination, tmp);
         for (i = 0; i < 3; i++)
                 frame->matrix[i][2] = tmp[i];
 }
+
+
+/* Vectorised conversions */
+void pumas_coordinates_ecef_from_geodetic_v(size_t n,
+    const double * geodetic, size_t geodetic_stride, double * ecef,
+    size_t ecef_stride)
+{
+        size_t i;
+        for (i = 0; i < n; i++, geodetic += geodetic_stride,
+             ecef += ecef_stride) {
+                double r[3];
+                ecef_from_geodetic(geodetic[0], geodetic[1], geodetic[2], r);
+                memcpy(ecef, r, sizeof r);
+        }
+}
+
+
+void pumas_coordinates_ecef_to_geodetic_v(size_t n, const double * ecef,
+    size_t ecef_stride, double * geodetic, size_t geodetic_stride)
+{
+        size_t i;
+        for (i = 0; i < n; i++, ecef += ecef_stride,
+             geodetic += geodetic_stride) {
+                double g[3];
+                ecef_to_geodetic(ecef, g, g + 1, g + 2);
+                memcpy(geodetic, g, sizeof g);
+        }
+}
+
+
+void pumas_coordinates_ecef_from_horizontal_v(size_t n,
+    const double * geodetic, size_t geodetic_stride,
+    const double * horizontal, size_t horizontal_stride, double * direction,
+    size_t direction_stride)
+{
+        size_t i;
+        for (i = 0; i < n; i++, geodetic += geodetic_stride,
+             horizontal += horizontal_stride,
+             direction += direction_stride) {
+                double u[3];
+                ecef_from_horizontal(geodetic[0], geodetic[1], horizontal[0],
+                    horizontal[1], u);
+                memcpy(direction, u, sizeof u);
+        }
+}
+
+
+void pumas_coordinates_ecef_to_horizontal_v(size_t n,
+    const double * geodetic, size_t geodetic_stride, const double * direction,
+    size_t direction_stride, double * horizontal, size_t horizontal_stride)
+{
+        size_t i;
+        for (i = 0; i < n; i++, geodetic += geodetic_stride,
+             direction += direction_stride,
+             horizontal += horizontal_stride) {
+                double h[2];
+                ecef_to_horizontal(geodetic[0], geodetic[1], direction, h,
+                    h + 1);
+                memcpy(horizontal, h, sizeof h);
+        }
+}
+
+
+void pumas_coordinates_point_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, const double * points, size_t points_stride,
+    double * out, size_t out_stride)
+{
+        const double (* const m)[3] = frame->matrix;
+        const double * const t = frame->translation;
+        size_t i;
+        for (i = 0; i < n; i++, points += points_stride, out += out_stride) {
+                if (inverse) {
+                        const double r[3] = {points[0] - t[0],
+                            points[1] - t[1], points[2] - t[2]};
+                        out[0] = m[0][0] * r[0] + m[1][0] * r[1] +
+                            m[2][0] * r[2];
+                        out[1] = m[0][1] * r[0] + m[1][1] * r[1] +
+                            m[2][1] * r[2];
+                        out[2] = m[0][2] * r[0] + m[1][2] * r[1] +
+                            m[2][2] * r[2];
+                } else {
+                        const double r[3] = {points[0], points[1], points[2]};
+                        out[0] = t[0] + m[0][0] * r[0] + m[0][1] * r[1] +
+                            m[0][2] * r[2];
+                        out[1] = t[1] + m[1][0] * r[0] + m[1][1] * r[1] +
+                            m[1][2] * r[2];
+                        out[2] = t[2] + m[2][0] * r[0] + m[2][1] * r[1] +
+                            m[2][2] * r[2];
+                }
+        }
+}
+
+
+void pumas_coordinates_vector_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, const double * vectors, size_t vectors_stride,
+    double * out, size_t out_stride)
+{
+        const double (* const m)[3] = frame->matrix;
+        size_t i;
+        for (i = 0; i < n; i++, vectors += vectors_stride,
+             out += out_stride) {
+                const double u[3] = {vectors[0], vectors[1], vectors[2]};
+                if (inverse) {
+                        out[0] = m[0][0] * u[0] + m[1][0] * u[1] +
+                            m[2][0] * u[2];
+                        out[1] = m[0][1] * u[0] + m[1][1] * u[1] +
+                            m[2][1] * u[2];
+                        out[2] = m[0][2] * u[0] + m[1][2] * u[1] +
+                            m[2][2] * u[2];
+                } else {
+                        out[0] = m[0][0] * u[0] + m[0][1] * u[1] +
+                            m[0][2] * u[2];
+                        out[1] = m[1][0] * u[0] + m[1][1] * u[1] +
+                            m[1][2] * u[2];
+                        out[2] = m[2][0] * u[0] + m[2][1] * u[1] +
+                            m[2][2] * u[2];
+                }
+        }
+}
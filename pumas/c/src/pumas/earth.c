@@ -1,5 +1,232 @@
-#include "pumas_coordinates.h"
-#include "pumas_earth.h"
+#include <float.h>
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+
+#include "pumas/coordinates.h"
+#include "pumas/earth.h"
+
+
+/* Lock for topography stacks shared between contexts */
+static pthread_mutex_t earth_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+static int earth_lock(void)
+{
+        return pthread_mutex_lock(&earth_mutex);
+}
+
+static int earth_unlock(void)
+{
+        return pthread_mutex_unlock(&earth_mutex);
+}
+
+
+enum pumas_return pumas_earth_topography_create(
+    struct pumas_earth_topography ** topography, const char * path,
+    int cache_size)
+{
+        *topography = calloc(1, sizeof **topography);
+        if (*topography == NULL) return PUMAS_RETURN_MEMORY_ERROR;
+
+        /* Folders are loaded as stacks of tiles, files as a single map */
+        struct stat st;
+        enum turtle_return rc;
+        if ((stat(path, &st) == 0) && S_ISDIR(st.st_mode)) {
+                rc = turtle_stack_create(&(*topography)->stack, path,
+                    cache_size, &earth_lock, &earth_unlock);
+        } else {
+                rc = turtle_map_load(&(*topography)->map, path);
+        }
+
+        if (rc != TURTLE_RETURN_SUCCESS) {
+                free(*topography);
+                *topography = NULL;
+                return PUMAS_RETURN_IO_ERROR;
+        }
+
+        return PUMAS_RETURN_SUCCESS;
+}
+
+
+void pumas_earth_topography_destroy(
+    struct pumas_earth_topography ** topography)
+{
+        if (*topography == NULL) return;
+        turtle_stack_destroy(&(*topography)->stack);
+        turtle_map_destroy(&(*topography)->map);
+        free(*topography);
+        *topography = NULL;
+}
+
+
+enum pumas_return pumas_earth_magnet_create(struct gull_snapshot ** snapshot,
+    const char * path, int day, int month, int year)
+{
+        if (gull_snapshot_create(snapshot, path, day, month, year) !=
+            GULL_RETURN_SUCCESS) {
+                *snapshot = NULL;
+                return PUMAS_RETURN_IO_ERROR;
+        }
+
+        return PUMAS_RETURN_SUCCESS;
+}
+
+
+void pumas_earth_magnet_destroy(struct gull_snapshot ** snapshot)
+{
+        gull_snapshot_destroy(snapshot);
+}
+
+
+/* Geomagnetic field from a snapshot, in ECEF frame */
+static enum gull_return earth_magnet_snapshot(struct gull_snapshot * snapshot,
+    double ** workspace, const double * ecef,
+    const struct pumas_geodetic_point * geodetic, double * magnet)
+{
+        /* Get the local frame */
+        struct pumas_coordinates_unitary_transformation frame;
+        struct pumas_cartesian_point ecef_position = {
+            ecef[0], ecef[1], ecef[2]};
+        pumas_coordinates_frame_initialise_local(&frame, &ecef_position,
+            geodetic, 0, 0);
+
+        /* Get the local magnetic field (ENU frame) */
+        struct pumas_cartesian_vector magnet_enu = {.frame = &frame};
+        enum gull_return rc = gull_snapshot_field(snapshot,
+            geodetic->latitude, geodetic->longitude, geodetic->altitude,
+            (double *)(&magnet_enu), workspace);
+
+        /* Transform back to ECEF */
+        pumas_coordinates_cartesian_vector_transform(&magnet_enu, NULL);
+        magnet[0] = magnet_enu.x;
+        magnet[1] = magnet_enu.y;
+        magnet[2] = magnet_enu.z;
+
+        return rc;
+}
+
+
+/* Geomagnetic field from a grid, using a trilinear interpolation. Outside of
+ * the grid, the closest boundary value is used.
+ */
+static void earth_magnet_grid(const struct pumas_earth_magnet_grid * grid,
+    const struct pumas_geodetic_point * geodetic, double * magnet)
+{
+        const double x[3] = {
+            geodetic->latitude, geodetic->longitude, geodetic->altitude};
+        const double * const range[3] = {
+            grid->latitude, grid->longitude, grid->altitude};
+
+        int i, index[3];
+        double h[3];
+        for (i = 0; i < 3; i++) {
+                const int n = grid->shape[i];
+                if (n <= 1) {
+                        index[i] = 0;
+                        h[i] = 0;
+                        continue;
+                }
+                double t = (x[i] - range[i][0]) /
+                    (range[i][1] - range[i][0]) * (n - 1);
+                if (t < 0) t = 0;
+                else if (t > n - 1) t = n - 1;
+                index[i] = (int)t;
+                if (index[i] > n - 2) index[i] = n - 2;
+                h[i] = t - index[i];
+        }
+
+        magnet[0] = magnet[1] = magnet[2] = 0;
+        int corner;
+        for (corner = 0; corner < 8; corner++) {
+                double w = 1;
+                size_t k = 0;
+                for (i = 0; i < 3; i++) {
+                        const int bit = (corner >> i) & 0x1;
+                        if (bit && (grid->shape[i] <= 1)) {
+                                w = 0;
+                                break;
+                        }
+                        w *= bit ? h[i] : 1 - h[i];
+                        k = k * grid->shape[i] + index[i] + bit;
+                }
+                if (w == 0) continue;
+
+                const double * const b = grid->data + 3 * k;
+                magnet[0] += w * b[0];
+                magnet[1] += w * b[1];
+                magnet[2] += w * b[2];
+        }
+}
+
+
+enum pumas_return pumas_earth_magnet_grid_compute(
+    struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid, double * data)
+{
+        const double * const range[3] = {
+            grid->latitude, grid->longitude, grid->altitude};
+        double delta[3];
+        int i;
+        for (i = 0; i < 3; i++) {
+                delta[i] = (grid->shape[i] > 1) ?
+                    (range[i][1] - range[i][0]) / (grid->shape[i] - 1) : 0;
+        }
+
+        double * workspace = NULL;
+        enum pumas_return rc = PUMAS_RETURN_SUCCESS;
+        int j, k;
+        for (i = 0; i < grid->shape[0]; i++)
+        for (j = 0; j < grid->shape[1]; j++)
+        for (k = 0; k < grid->shape[2]; k++) {
+                struct pumas_geodetic_point geodetic = {
+                    range[0][0] + i * delta[0], range[1][0] + j * delta[1],
+                    range[2][0] + k * delta[2]};
+                double ecef[3];
+                turtle_ecef_from_geodetic(geodetic.latitude,
+                    geodetic.longitude, geodetic.altitude, ecef);
+                if (earth_magnet_snapshot(snapshot, &workspace, ecef,
+                    &geodetic, data) != GULL_RETURN_SUCCESS) {
+                        rc = PUMAS_RETURN_VALUE_ERROR;
+                        goto exit;
+                }
+                data += 3;
+        }
+
+exit:
+        free(workspace);
+        return rc;
+}
+
+
+enum pumas_return pumas_earth_magnet_field_v(struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid, int n,
+    const double * geodetic, double * magnet)
+{
+        double * workspace = NULL;
+        enum pumas_return rc = PUMAS_RETURN_SUCCESS;
+        int i;
+        for (i = 0; i < n; i++, geodetic += 3, magnet += 3) {
+                struct pumas_geodetic_point point = {
+                    geodetic[0], geodetic[1], geodetic[2]};
+                if (grid != NULL) {
+                        earth_magnet_grid(grid, &point, magnet);
+                        continue;
+                }
+
+                double ecef[3];
+                turtle_ecef_from_geodetic(point.latitude, point.longitude,
+                    point.altitude, ecef);
+                if (earth_magnet_snapshot(snapshot, &workspace, ecef, &point,
+                    magnet) != GULL_RETURN_SUCCESS) {
+                        rc = PUMAS_RETURN_VALUE_ERROR;
+                        break;
+                }
+        }
+
+        free(workspace);
+        return rc;
+}
 
 
 void pumas_geometry_earth_get(struct pumas_geometry * base_geometry,
@@ -50,28 +277,19 @@ double pumas_geometry_earth_magnet(struct pumas_geometry * base_geometry,
                     &geodetic_position.latitude, &geodetic_position.longitude,
                     &geodetic_position.altitude);
 
-                /* Get the local frame */
-                struct pumas_coordinates_unitary_transformation frame;
-                struct pumas_cartesian_point ecef_position = {
-                    state->position[0], state->position[1], state->position[2]};
-                pumas_coordinates_frame_initialise_local(&frame, &ecef_position,
-                    &geodetic_position, 0, 0);
-
-                /* Get the local magnetic field (ENU frame) */
-                struct pumas_cartesian_vector magnet_enu = {.frame = &frame};
-                gull_snapshot_field(*earth->magnet.snapshot,
-                    geodetic_position.latitude, geodetic_position.longitude,
-                    geodetic_position.altitude, (double *)(&magnet_enu),
-                    earth->magnet.workspace);
-
-                /* Transform back to ECEF */
-                pumas_coordinates_cartesian_vector_transform(
-                    &magnet_enu, NULL);
+                /* Get the magnetic field (ECEF frame) */
+                if (earth->magnet.grid != NULL) {
+                        earth_magnet_grid(earth->magnet.grid,
+                            &geodetic_position, magnet);
+                } else {
+                        earth_magnet_snapshot(*earth->magnet.snapshot,
+                            earth->magnet.workspace, state->position,
+                            &geodetic_position, magnet);
+                }
 
                 /* Update the magnet and its history */
-                memcpy(&earth->magnet.last, &magnet_enu,
+                memcpy(&earth->magnet.last, magnet,
                     sizeof earth->magnet.last);
-                memcpy(magnet, &magnet_enu, sizeof earth->magnet.last);
                 earth->magnet.distance = state->distance +
                                          GEOMAGNET_UPDATE_DISTANCE;
         }
@@ -98,11 +316,72 @@ void pumas_geometry_earth_destroy(struct pumas_geometry * base_geometry)
         turtle_stepper_destroy(earth->stepper);
         free(*earth->magnet.workspace);
         *earth->magnet.workspace = NULL;
-        gull_snapshot_destroy(earth->magnet.snapshot);
         free(base_geometry);
 }
 
 
+struct pumas_geometry_earth * pumas_geometry_earth_create(int n_layers,
+    struct pumas_medium ** media, struct pumas_earth_topography ** topography,
+    const double * offsets, struct pumas_earth_topography * geoid,
+    struct gull_snapshot * snapshot,
+    const struct pumas_earth_magnet_grid * grid)
+{
+        if ((n_layers <= 0) || ((geoid != NULL) && (geoid->map == NULL)))
+                return NULL;
+
+        struct pumas_geometry_earth * earth = calloc(1,
+            sizeof *earth + n_layers * sizeof *earth->media);
+        if (earth == NULL) return NULL;
+
+        earth->base.get = &pumas_geometry_earth_get;
+        earth->base.reset = &pumas_geometry_earth_reset;
+        earth->base.destroy = &pumas_geometry_earth_destroy;
+        if ((snapshot != NULL) || (grid != NULL))
+                earth->base.magnet = &pumas_geometry_earth_magnet;
+
+        earth->media = (void *)(earth + 1);
+        memcpy(earth->media, media, n_layers * sizeof *earth->media);
+        earth->n_layers = n_layers;
+        *earth->magnet.snapshot = snapshot;
+        earth->magnet.grid = grid;
+        pumas_geometry_earth_reset(&earth->base);
+
+        /* Configure the stepper, with one data set per layer */
+        if (turtle_stepper_create(earth->stepper) != TURTLE_RETURN_SUCCESS)
+                goto error;
+        if ((geoid != NULL) && (turtle_stepper_geoid_set(
+            *earth->stepper, geoid->map) != TURTLE_RETURN_SUCCESS))
+                goto error;
+
+        int i;
+        for (i = 0; i < n_layers; i++) {
+                struct turtle_stepper * stepper = *earth->stepper;
+                if ((i > 0) && (turtle_stepper_add_layer(stepper) !=
+                    TURTLE_RETURN_SUCCESS))
+                        goto error;
+
+                const struct pumas_earth_topography * t = topography[i];
+                enum turtle_return rc;
+                if (t == NULL) {
+                        rc = turtle_stepper_add_flat(stepper, offsets[i]);
+                } else if (t->stack != NULL) {
+                        rc = turtle_stepper_add_stack(
+                            stepper, t->stack, offsets[i]);
+                } else {
+                        rc = turtle_stepper_add_map(
+                            stepper, t->map, offsets[i]);
+                }
+                if (rc != TURTLE_RETURN_SUCCESS) goto error;
+        }
+
+        return earth;
+
+error:
+        pumas_geometry_earth_destroy(&earth->base);
+        return NULL;
+}
+
+
 double pumas_medium_gradient_project_altitude(
     struct pumas_medium_gradient * medium,
     struct pumas_state_extended * state)
@@ -1,7 +1,13 @@
+#include <fcntl.h>
 #include <float.h>
+#include <limits.h>
 #include <math.h>
+#include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 #include "pumas/extensions.h"
 
@@ -71,9 +77,155 @@ void pumas_state_extended_reset(struct pumas_state_extended * state,
         state->context = context;
         state->geodetic.computed = 0;
         state->vertical.distance = -1;
+        state->safety.radius = 0;
 }
 
 
+/* Bounding Volume Hierarchy (BVH) over axis aligned boxes */
+#define BVH_LEAF_SIZE 4
+
+static double bvh_centroid(const double * boxes, int item, int axis)
+{
+        const double * const b = boxes + 6 * item;
+        return b[axis] + b[axis + 3];
+}
+
+
+/* Partial sort of items, w.r.t. their centroid, such that the k-th one is
+ * at its final position (Hoare's selection algorithm)
+ */
+static void bvh_select(
+    int * index, int n, int k, const double * boxes, int axis)
+{
+        int lo = 0, hi = n - 1;
+        while (lo < hi) {
+                const double pivot =
+                    bvh_centroid(boxes, index[(lo + hi) / 2], axis);
+                int i = lo, j = hi;
+                while (i <= j) {
+                        while (bvh_centroid(boxes, index[i], axis) < pivot)
+                                i++;
+                        while (bvh_centroid(boxes, index[j], axis) > pivot)
+                                j--;
+                        if (i <= j) {
+                                const int tmp = index[i];
+                                index[i++] = index[j];
+                                index[j--] = tmp;
+                        }
+                }
+                if (k <= j) hi = j;
+                else if (k >= i) lo = i;
+                else break;
+        }
+}
+
+
+static void bvh_build_node(int node_index, int first, int count,
+    const double * boxes, struct pumas_bvh_node * nodes, int * index,
+    int * n_nodes)
+{
+        /* Compute the node bounds and the spread of centroids */
+        struct pumas_bvh_node * node = nodes + node_index;
+        double cmin[3] = {DBL_MAX, DBL_MAX, DBL_MAX};
+        double cmax[3] = {-DBL_MAX, -DBL_MAX, -DBL_MAX};
+        int i, j;
+        for (j = 0; j < 3; j++) {
+                node->box[j] = DBL_MAX;
+                node->box[j + 3] = -DBL_MAX;
+        }
+        for (i = first; i < first + count; i++) {
+                const double * const b = boxes + 6 * index[i];
+                for (j = 0; j < 3; j++) {
+                        if (b[j] < node->box[j]) node->box[j] = b[j];
+                        if (b[j + 3] > node->box[j + 3])
+                                node->box[j + 3] = b[j + 3];
+                        const double c = b[j] + b[j + 3];
+                        if (c < cmin[j]) cmin[j] = c;
+                        if (c > cmax[j]) cmax[j] = c;
+                }
+        }
+
+        if (count <= BVH_LEAF_SIZE) {
+                node->first = first;
+                node->count = count;
+                return;
+        }
+
+        /* Split at the median, along the largest spread of centroids */
+        int axis = 0;
+        for (j = 1; j < 3; j++) {
+                if (cmax[j] - cmin[j] > cmax[axis] - cmin[axis]) axis = j;
+        }
+        const int half = count / 2;
+        bvh_select(index + first, count, half, boxes, axis);
+
+        const int left = *n_nodes;
+        *n_nodes += 2;
+        node->first = left;
+        node->count = 0;
+        bvh_build_node(left, first, half, boxes, nodes, index, n_nodes);
+        bvh_build_node(left + 1, first + half, count - half, boxes, nodes,
+            index, n_nodes);
+}
+
+
+int pumas_bvh_build(int n, const double * boxes,
+    struct pumas_bvh_node * nodes, int * index)
+{
+        int i;
+        for (i = 0; i < n; i++) index[i] = i;
+        if (n <= 0) return 0;
+
+        int n_nodes = 1;
+        bvh_build_node(0, 0, n, boxes, nodes, index, &n_nodes);
+        return n_nodes;
+}
+
+
+/* Check if a box is crossed by a ray segment, [0, tmax]. A null tmax
+ * checks if the box contains the ray origin
+ */
+static int bvh_box_hit(const double * box, const double * r,
+    const double * u, const double * inv, double tmax)
+{
+        double t0 = 0., t1 = tmax;
+        int i;
+        for (i = 0; i < 3; i++) {
+                if (u[i] == 0.) {
+                        if ((r[i] < box[i]) || (r[i] > box[i + 3])) return 0;
+                } else {
+                        double ta = (box[i] - r[i]) * inv[i];
+                        double tb = (box[i + 3] - r[i]) * inv[i];
+                        if (ta > tb) {
+                                const double tmp = ta;
+                                ta = tb;
+                                tb = tmp;
+                        }
+                        if (ta > t0) t0 = ta;
+                        if (tb < t1) t1 = tb;
+                        if (t0 > t1) return 0;
+                }
+        }
+        return 1;
+}
+
+
+/* Distance from a point to a box, null if inside */
+static double bvh_box_distance(const double * box, const double * r)
+{
+        double d2 = 0.;
+        int i;
+        for (i = 0; i < 3; i++) {
+                double d = 0.;
+                if (r[i] < box[i]) d = box[i] - r[i];
+                else if (r[i] > box[i + 3]) d = r[i] - box[i + 3];
+                d2 += d * d;
+        }
+        return sqrt(d2);
+}
+#undef BVH_LEAF_SIZE
+
+
 /* Setters and getters for the geometry */
 struct pumas_geometry * pumas_geometry_get(struct pumas_context * context)
 {
@@ -82,11 +234,113 @@ struct pumas_geometry * pumas_geometry_get(struct pumas_context * context)
 }
 
 
+/* Index the daughters of geometry nodes with a BVH */
+#define BVH_MIN_DAUGHTERS 8
+#define BVH_BOX_MARGIN 1E-06
+
+static size_t geometry_bvh_size(int n)
+{
+        return sizeof(struct pumas_geometry_bvh) +
+            (2 * n - 1) * sizeof(struct pumas_bvh_node) +
+            n * sizeof(struct pumas_geometry *);
+}
+
+
+/* Build the BVH of the n daughters of a geometry node. The BVH is stored in
+ * the provided buffer, if not NULL, which must be large enough. Otherwise,
+ * it is allocated. NULL is returned if there are not enough bounded
+ * daughters, or on failure.
+ */
+static struct pumas_geometry_bvh * geometry_bvh_create(
+    struct pumas_geometry * geometry, int n, void * buffer)
+{
+        /* Get the bounding boxes of daughters. The scratch buffer is laid
+         * out by decreasing alignment: boxes, daughters and index.
+         */
+        double * boxes = malloc(n * (6 * sizeof(*boxes) +
+            sizeof(struct pumas_geometry *) + sizeof(int)));
+        if (boxes == NULL) return NULL;
+        struct pumas_geometry ** daughters = (void *)(boxes + 6 * n);
+        int * index = (void *)(daughters + n);
+
+        struct pumas_geometry_bvh * bvh = NULL;
+        int n_bounded = 0, n_unbounded = 0;
+        struct pumas_geometry * g;
+        for (g = geometry->daughters; g != NULL; g = g->next) {
+                double * const b = boxes + 6 * n_bounded;
+                if ((g->box != NULL) && g->box(g, b)) {
+                        int j;
+                        for (j = 0; j < 3; j++) {
+                                b[j] -= BVH_BOX_MARGIN;
+                                b[j + 3] += BVH_BOX_MARGIN;
+                        }
+                        daughters[n_bounded++] = g;
+                } else {
+                        daughters[n - 1 - n_unbounded++] = g;
+                }
+        }
+        if (n_bounded < BVH_MIN_DAUGHTERS) goto exit;
+
+        /* Build the tree */
+        const int n_nodes = 2 * n_bounded - 1;
+        bvh = (buffer != NULL) ? buffer : malloc(geometry_bvh_size(n));
+        if (bvh == NULL) goto exit;
+        bvh->daughters = (void *)(bvh->nodes + n_nodes);
+        bvh->n_nodes = pumas_bvh_build(n_bounded, boxes, bvh->nodes, index);
+        bvh->n_bounded = n_bounded;
+        bvh->n_unbounded = n_unbounded;
+
+        int i;
+        for (i = 0; i < n_bounded; i++)
+                bvh->daughters[i] = daughters[index[i]];
+        for (i = n_bounded; i < n; i++)
+                bvh->daughters[i] = daughters[i];
+exit:
+        free(boxes);
+        return bvh;
+}
+
+
+/* Index the daughters of all geometry nodes. On failure, the linear traversal
+ * of daughters is used instead
+ */
+static void geometry_index(struct pumas_geometry * geometry)
+{
+        free(geometry->bvh);
+        geometry->bvh = NULL;
+
+        int n = 0;
+        struct pumas_geometry * g;
+        for (g = geometry->daughters; g != NULL; g = g->next) {
+                geometry_index(g);
+                n++;
+        }
+        if (n >= BVH_MIN_DAUGHTERS)
+                geometry->bvh = geometry_bvh_create(geometry, n, NULL);
+}
+
+
 void pumas_geometry_set(
     struct pumas_context * context, struct pumas_geometry * geometry)
 {
         struct pumas_user_data * user_data = context->user_data;
         user_data->top = geometry;
+        user_data->stateful = 0;
+        if ((geometry != NULL) && !geometry->frozen) {
+                geometry_index(geometry);
+                user_data->stateful = pumas_geometry_stateful(geometry);
+        }
+}
+
+
+int pumas_geometry_stateful(const struct pumas_geometry * geometry)
+{
+        if (geometry->reset != NULL) return 1;
+
+        const struct pumas_geometry * g;
+        for (g = geometry->daughters; g != NULL; g = g->next)
+                if (pumas_geometry_stateful(g)) return 1;
+        return 0;
 }
 
 
@@ -104,16 +358,21 @@ void pumas_geometry_reset(struct pumas_context * context)
 {
         struct pumas_user_data * user_data = context->user_data;
         user_data->current = user_data->top;
-        if (user_data->top != NULL)
+        if ((user_data->top != NULL) && user_data->stateful)
                 geometry_reset(user_data->top);
 }
 
 
 static void geometry_destroy(struct pumas_geometry * geometry)
 {
-        struct pumas_geometry * g;
-        for (g = geometry->daughters; g != NULL; g = g->next)
+        struct pumas_geometry * g = geometry->daughters;
+        while (g != NULL) {
+                struct pumas_geometry * next = g->next;
                 geometry_destroy(g);
+                g = next;
+        }
+        free(geometry->bvh);
+        geometry->bvh = NULL;
         if (geometry->destroy != NULL) geometry->destroy(geometry);
 }
 
@@ -122,10 +381,17 @@ void pumas_geometry_destroy(struct pumas_context * context)
 {
         struct pumas_user_data * user_data = context->user_data;
         if (user_data->top != NULL) {
-                geometry_destroy(user_data->top);
+                if (!user_data->top->frozen) geometry_destroy(user_data->top);
                 user_data->top = NULL;
         }
         user_data->current = NULL;
+        user_data->stateful = 0;
+}
+
+
+void pumas_geometry_tree_destroy(struct pumas_geometry * geometry)
+{
+        if ((geometry != NULL) && !geometry->frozen) geometry_destroy(geometry);
 }
 
 
@@ -144,12 +410,191 @@ void pumas_geometry_push(struct pumas_geometry * geometry,
 }
 
 
+/* Frozen geometries, compiled into a single memory arena */
+#define ARENA_ALIGN(size) (((size) + 15) & ~(size_t)15)
+
+static size_t geometry_arena_size(struct pumas_geometry * geometry)
+{
+        /* Nodes with a per-context state cannot be shared */
+        if ((geometry->size == 0) || (geometry->reset != NULL)) return 0;
+
+        size_t size = ARENA_ALIGN(geometry->size);
+        int n = 0;
+        struct pumas_geometry * g;
+        for (g = geometry->daughters; g != NULL; g = g->next) {
+                const size_t s = geometry_arena_size(g);
+                if (s == 0) return 0;
+                size += s;
+                n++;
+        }
+        if (n >= BVH_MIN_DAUGHTERS) size += ARENA_ALIGN(geometry_bvh_size(n));
+
+        return size;
+}
+
+
+static struct pumas_geometry * geometry_arena_copy(
+    struct pumas_geometry * geometry, struct pumas_geometry * mother,
+    char ** cursor)
+{
+        struct pumas_geometry * copy = (void *)*cursor;
+        *cursor += ARENA_ALIGN(geometry->size);
+        memcpy(copy, geometry, geometry->size);
+        copy->destroy = NULL;
+        copy->mother = mother;
+        copy->daughters = NULL;
+        copy->next = NULL;
+        copy->bvh = NULL;
+        copy->frozen = 1;
+
+        int n = 0;
+        struct pumas_geometry * g, * last = NULL;
+        for (g = geometry->daughters; g != NULL; g = g->next) {
+                struct pumas_geometry * daughter =
+                    geometry_arena_copy(g, copy, cursor);
+                if (last == NULL) copy->daughters = daughter;
+                else last->next = daughter;
+                last = daughter;
+                n++;
+        }
+
+        if (n >= BVH_MIN_DAUGHTERS) {
+                copy->bvh = geometry_bvh_create(copy, n, *cursor);
+                *cursor += ARENA_ALIGN(geometry_bvh_size(n));
+        }
+
+        return copy;
+}
+
+
+struct pumas_geometry * pumas_geometry_freeze(struct pumas_geometry * geometry)
+{
+        struct pumas_geometry * frozen = NULL;
+        const size_t size = geometry_arena_size(geometry);
+        if (size > 0) {
+                char * cursor = malloc(size);
+                if (cursor != NULL)
+                        frozen = geometry_arena_copy(geometry, NULL, &cursor);
+        }
+        geometry_destroy(geometry);
+
+        return frozen;
+}
+
+
+void pumas_geometry_frozen_destroy(struct pumas_geometry * geometry)
+{
+        free(geometry);
+}
+
+#undef ARENA_ALIGN
+#undef BVH_MIN_DAUGHTERS
+#undef BVH_BOX_MARGIN
+
+
 /* The transparent medium, e.g. for bounding boxes */
 static struct pumas_medium transparent_medium = { -1, NULL };
 struct pumas_medium * PUMAS_MEDIUM_TRANSPARENT = &transparent_medium;
 
 
 /* Recursive geometry navigation */
+static void geometry_navigate(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p, struct pumas_geometry * exclude,
+    struct pumas_geometry ** current_p);
+
+
+/* Navigate into a daughter volume. The mother step is updated with the
+ * entrance distance, if not inside.
+ */
+static int geometry_navigate_daughter(struct pumas_geometry * daughter,
+    struct pumas_geometry * mother, struct pumas_state * state,
+    struct pumas_medium ** medium_p, double * step_p, double * step,
+    struct pumas_geometry ** current_p)
+{
+        geometry_navigate(daughter, state, medium_p, step_p, mother,
+                          current_p);
+        if (*medium_p != NULL) return 1;
+        else if (step_p != NULL) {
+                if ((*step_p > 0) && ((*step <= 0) || (*step_p < *step)))
+                        *step = *step_p;
+        }
+        return 0;
+}
+
+
+/* Navigate into the daughter volumes that are reachable according to the
+ * BVH, i.e. whose box contains the current position or is crossed by the
+ * ray segment up to the current step
+ */
+static void geometry_navigate_bvh(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p, double * step, struct pumas_geometry * exclude,
+    struct pumas_geometry ** current_p)
+{
+#define BVH_STACK_SIZE 64
+
+        struct pumas_geometry_bvh * bvh = geometry->bvh;
+        struct pumas_geometry ** d;
+        int i;
+
+        /* Unbounded daughters are always checked */
+        for (i = 0, d = bvh->daughters + bvh->n_bounded; i < bvh->n_unbounded;
+             i++, d++) {
+                if (*d == exclude) continue;
+                if (geometry_navigate_daughter(*d, geometry, state, medium_p,
+                    step_p, step, current_p)) return;
+        }
+
+        /* Get the ray direction, w.r.t. the transport mode */
+        const double * const r = state->position;
+        double u[3] = {0., 0., 0.}, inv[3];
+        if (step_p != NULL) {
+                struct pumas_state_extended * extended = (void *)state;
+                const double sgn = (extended->context->mode.direction ==
+                    PUMAS_MODE_FORWARD) ? 1 : -1;
+                for (i = 0; i < 3; i++) {
+                        u[i] = sgn * state->direction[i];
+                        inv[i] = (u[i] == 0.) ? 0. : 1. / u[i];
+                }
+        }
+
+        /* Traverse the tree */
+        int stack[BVH_STACK_SIZE], n_stack = 0;
+        stack[n_stack++] = 0;
+        while (n_stack > 0) {
+                const struct pumas_bvh_node * node =
+                    bvh->nodes + stack[--n_stack];
+                const double tmax = (step_p == NULL) ? 0. :
+                    ((*step > 0) ? *step : DBL_MAX);
+                if (!bvh_box_hit(node->box, r, u, inv, tmax)) {
+                        /* Pruned daughters bound the safety distance */
+                        struct pumas_state_extended * extended =
+                            (void *)state;
+                        const double d = bvh_box_distance(node->box, r);
+                        if (d < extended->safety.radius)
+                                extended->safety.radius = d;
+                        continue;
+                }
+
+                if (node->count == 0) {
+                        stack[n_stack++] = node->first + 1;
+                        stack[n_stack++] = node->first;
+                        continue;
+                }
+
+                for (i = 0, d = bvh->daughters + node->first; i < node->count;
+                     i++, d++) {
+                        if (*d == exclude) continue;
+                        if (geometry_navigate_daughter(*d, geometry, state,
+                            medium_p, step_p, step, current_p)) return;
+                }
+        }
+
+#undef BVH_STACK_SIZE
+}
+
+
 static void geometry_navigate(struct pumas_geometry * geometry,
     struct pumas_state * state, struct pumas_medium ** medium_p,
     double * step_p, struct pumas_geometry * exclude,
@@ -157,10 +602,17 @@ static void geometry_navigate(struct pumas_geometry * geometry,
 {
         if (geometry == NULL) return;
 
+        struct pumas_state_extended * extended = (void *)state;
+        extended->safety.value = -1;
         geometry->get(geometry, state, medium_p, step_p);
         *current_p = geometry;
 
-        struct pumas_state_extended * extended = (void *)state;
+        /* Update the safety distance, which is null if not supported */
+        const double safety = (extended->safety.value > 0) ?
+            extended->safety.value : 0;
+        if (safety < extended->safety.radius)
+                extended->safety.radius = safety;
+
         struct pumas_user_data * user_data =
             (void *)extended->context->user_data;
         if (user_data->callback != NULL) {
@@ -169,22 +621,22 @@ static void geometry_navigate(struct pumas_geometry * geometry,
         }
 
         if ((*medium_p != NULL) && (geometry->daughters != NULL)) {
-                double step;
+                double step = 0;
                 struct pumas_medium * medium = *medium_p;
                 if (step_p != NULL) step = *step_p;
 
                 *medium_p = NULL;
-                struct pumas_geometry * daughter;
-                for (daughter = geometry->daughters; daughter != NULL;
-                     daughter = daughter->next) {
-                        if (daughter == exclude) continue;
-
-                        geometry_navigate(daughter, state, medium_p, step_p,
-                                          geometry, current_p);
-                        if (*medium_p != NULL) break;
-                        else if (step_p != NULL) {
-                                if ((*step_p > 0) && (*step_p < step))
-                                        step = *step_p;
+                if (geometry->bvh != NULL) {
+                        geometry_navigate_bvh(geometry, state, medium_p,
+                            step_p, &step, exclude, current_p);
+                } else {
+                        struct pumas_geometry * daughter;
+                        for (daughter = geometry->daughters; daughter != NULL;
+                             daughter = daughter->next) {
+                                if (daughter == exclude) continue;
+                                if (geometry_navigate_daughter(daughter,
+                                    geometry, state, medium_p, step_p, &step,
+                                    current_p)) break;
                         }
                 }
                 if (*medium_p == NULL) {
@@ -198,45 +650,284 @@ static void geometry_navigate(struct pumas_geometry * geometry,
 
         if ((*medium_p == NULL) && (geometry->mother != NULL) &&
             (geometry->mother != exclude)) {
+                        /* The distance to the current geometry is kept,
+                         * since it is excluded from the mother's navigation,
+                         * e.g. for non convex volumes
+                         */
+                        const double step = (step_p == NULL) ? 0 : *step_p;
                         geometry_navigate(geometry->mother, state, medium_p,
                                           step_p, geometry, current_p);
+                        if ((step_p != NULL) && (step > 0) &&
+                            ((*step_p <= 0) || (step < *step_p)))
+                                *step_p = step;
         }
 }
 
 
-/* Generic geometry callback */
-enum pumas_step pumas_geometry_medium(struct pumas_context * context,
+/* Locate a state in the geometry. Navigation is skipped as long as the state
+ * remains within its safety sphere.
+ */
+static void geometry_medium(struct pumas_context * context,
     struct pumas_state * state, struct pumas_medium ** medium_p,
     double * step_p)
 {
-        struct pumas_user_data * user_data = context->user_data;
-        struct pumas_geometry * geometry = user_data->current;
-        if (geometry == NULL) geometry = user_data->top;
+#define SAFETY_EPSILON 1E-09
 
+        struct pumas_user_data * user_data = context->user_data;
         struct pumas_state_extended * extended = (void *)state;
         extended->geodetic.computed = 0;
 
+        /* Check the safety sphere */
+        const double * const r = state->position;
+        const double * const u = state->direction;
         struct pumas_medium * tmp;
+        if (extended->safety.radius > 0) {
+                const double * const r0 = extended->safety.origin;
+                const double dr[3] = {r[0] - r0[0], r[1] - r0[1],
+                                      r[2] - r0[2]};
+                const double d = sqrt(dr[0] * dr[0] + dr[1] * dr[1] +
+                    dr[2] * dr[2]);
+                const double epsilon = SAFETY_EPSILON * (1. + fabs(r[0]) +
+                    fabs(r[1]) + fabs(r[2]));
+                if (d < extended->safety.radius - epsilon) {
+                        user_data->current = extended->safety.current;
+                        if (medium_p != NULL)
+                                *medium_p = extended->safety.medium;
+                        if (step_p == NULL) return;
+
+                        /* If the state moved straight ahead, the directional
+                         * step remains valid
+                         */
+                        const double * const u0 = extended->safety.direction;
+                        if ((u[0] == u0[0]) && (u[1] == u0[1]) &&
+                            (u[2] == u0[2])) {
+                                const double sgn =
+                                    (context->mode.direction ==
+                                    PUMAS_MODE_FORWARD) ? d : -d;
+                                const double e[3] = {dr[0] - sgn * u[0],
+                                    dr[1] - sgn * u[1], dr[2] - sgn * u[2]};
+                                if ((fabs(e[0]) + fabs(e[1]) + fabs(e[2]) <=
+                                    epsilon) &&
+                                    (extended->safety.step - d > epsilon)) {
+                                        *step_p = extended->safety.step - d;
+                                        return;
+                                }
+                        }
+
+                        *step_p = extended->safety.radius - d;
+                        return;
+                }
+        }
+
+        /* Navigate the geometry */
+        struct pumas_geometry * geometry = user_data->current;
+        if (geometry == NULL) geometry = user_data->top;
+
+        extended->safety.radius = DBL_MAX;
         geometry_navigate(geometry, state, &tmp, step_p, NULL,
                           &user_data->current);
         if (medium_p != NULL) *medium_p = tmp;
 
+        /* Cache the safety sphere */
+        if ((tmp != NULL) && (extended->safety.radius > 0) &&
+            (extended->safety.radius < DBL_MAX)) {
+                memcpy(extended->safety.origin, r,
+                    sizeof extended->safety.origin);
+                memcpy(extended->safety.direction, u,
+                    sizeof extended->safety.direction);
+                if (step_p == NULL) {
+                        extended->safety.step = 0;
+                } else {
+                        extended->safety.step = (*step_p > 0) ?
+                            *step_p : DBL_MAX;
+                }
+                extended->safety.medium = tmp;
+                extended->safety.current = user_data->current;
+        } else {
+                extended->safety.radius = 0;
+        }
+
+#undef SAFETY_EPSILON
+}
+
+
+/* Generic geometry callback */
+enum pumas_step pumas_geometry_medium(struct pumas_context * context,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+        struct pumas_medium * medium;
+        geometry_medium(context, state, &medium, step_p);
+        if (medium_p != NULL) *medium_p = medium;
+
+        struct pumas_user_data * user_data = context->user_data;
+        if ((user_data->recorder != NULL) && (step_p != NULL)) {
+                if (user_data->frame == NULL) {
+                        pumas_recorder_record(user_data->recorder, state,
+                            medium, *step_p);
+                } else {
+                        /* Record w.r.t. the parent frame */
+                        struct pumas_state parent;
+                        memcpy(&parent, state, sizeof parent);
+                        pumas_coordinates_point_transform_v(user_data->frame,
+                            0, 1, parent.position, 0, parent.position, 0);
+                        pumas_coordinates_vector_transform_v(user_data->frame,
+                            0, 1, parent.direction, 0, parent.direction, 0);
+                        pumas_recorder_record(user_data->recorder, &parent,
+                            medium, *step_p);
+                }
+        }
+
         return PUMAS_STEP_CHECK;
 }
 
 
-static double add_global_magnet(struct pumas_state * state,
-    struct pumas_locals * locals)
+/* Recorder of Monte Carlo steps */
+struct pumas_recorder * pumas_recorder_create(long period, long max_steps)
+{
+        struct pumas_recorder * recorder = malloc(sizeof *recorder);
+        if (recorder == NULL) return NULL;
+
+        recorder->period = (period > 0) ? period : 1;
+        recorder->max_steps = max_steps;
+        recorder->capacity = 0;
+        recorder->records = NULL;
+        pumas_recorder_clear(recorder);
+
+        return recorder;
+}
+
+
+void pumas_recorder_destroy(struct pumas_recorder * recorder)
+{
+        if (recorder == NULL) return;
+        free(recorder->records);
+        free(recorder);
+}
+
+
+void pumas_recorder_clear(struct pumas_recorder * recorder)
+{
+        recorder->event = -1;
+        recorder->steps = 0;
+        recorder->size = 0;
+}
+
+
+void pumas_recorder_start(struct pumas_recorder * recorder)
+{
+        recorder->event++;
+        recorder->steps = 0;
+}
+
+
+static void recorder_append(struct pumas_recorder * recorder,
+    struct pumas_state * state, struct pumas_medium * medium, double step)
+{
+#define RECORDER_MIN_CAPACITY 1024
+
+        if (recorder->size >= recorder->capacity) {
+                /* Grow the buffer geometrically. Records are dropped if
+                 * memory is exhausted
+                 */
+                const size_t capacity = (recorder->capacity > 0) ?
+                    2 * recorder->capacity : RECORDER_MIN_CAPACITY;
+                void * tmp = realloc(recorder->records,
+                    capacity * sizeof *recorder->records);
+                if (tmp == NULL) return;
+                recorder->records = tmp;
+                recorder->capacity = capacity;
+        }
+
+        struct pumas_recorder_record * record =
+            recorder->records + recorder->size++;
+        record->event = recorder->event;
+        memcpy(record->position, state->position, sizeof record->position);
+        memcpy(record->direction, state->direction,
+            sizeof record->direction);
+        record->energy = state->energy;
+        record->step = step;
+        record->medium = medium;
+
+#undef RECORDER_MIN_CAPACITY
+}
+
+
+void pumas_recorder_record(struct pumas_recorder * recorder,
+    struct pumas_state * state, struct pumas_medium * medium, double step)
+{
+        if ((recorder->event < 0) || (recorder->event % recorder->period))
+                return;
+        if ((recorder->max_steps > 0) &&
+            (recorder->steps >= recorder->max_steps)) return;
+
+        recorder->steps++;
+        recorder_append(recorder, state, medium, step);
+}
+
+
+void pumas_recorder_stop(struct pumas_recorder * recorder,
+    struct pumas_state * state, struct pumas_medium * medium)
+{
+        /* The final state is always recorded, for sampled events */
+        if ((recorder->event < 0) || (recorder->event % recorder->period))
+                return;
+
+        recorder_append(recorder, state, medium, 0);
+}
+
+
+/* Get the current geometry node, and its local frame if it is placed */
+static struct pumas_geometry * geometry_current(struct pumas_state * state,
+    const struct pumas_coordinates_unitary_transformation ** frame_p)
 {
         struct pumas_state_extended * extended = (void *)state;
-        struct pumas_context * context = extended->context;
-        struct pumas_user_data * user_data = context->user_data;
+        struct pumas_user_data * user_data = extended->context->user_data;
         struct pumas_geometry * geometry = user_data->current;
+        if ((geometry != NULL) &&
+            (geometry->get == pumas_geometry_placement_get)) {
+                *frame_p = &extended->local.frame;
+                return extended->local.current;
+        } else {
+                *frame_p = NULL;
+                return geometry;
+        }
+}
+
+
+/* Express a state in the local frame of a placed geometry node, if any */
+static struct pumas_state * geometry_localise(struct pumas_state * state,
+    const struct pumas_coordinates_unitary_transformation * frame,
+    struct pumas_state_extended * local)
+{
+        if (frame == NULL) return state;
+
+        memcpy(local, state, sizeof *local);
+        local->geodetic.computed = 0;
+        pumas_coordinates_point_transform_v(frame, 1, 1, state->position, 0,
+            local->base.position, 0);
+        pumas_coordinates_vector_transform_v(frame, 1, 1, state->direction, 0,
+            local->base.direction, 0);
+        return &local->base;
+}
+
+
+static double add_global_magnet(struct pumas_state * state,
+    struct pumas_locals * locals)
+{
+        const struct pumas_coordinates_unitary_transformation * frame;
+        struct pumas_geometry * geometry = geometry_current(state, &frame);
         if (geometry->magnet == NULL)
                 return 0;
 
+        struct pumas_state_extended local;
         double magnet[3];
-        const double s = geometry->magnet(geometry, state, magnet);
+        const double s = geometry->magnet(geometry,
+            geometry_localise(state, frame, &local), magnet);
+        if (frame != NULL) {
+                pumas_coordinates_vector_transform_v(frame, 0, 1, magnet, 0,
+                    magnet, 0);
+        }
 
         int i;
         for (i = 0; i < 3; i++)
@@ -363,6 +1054,9 @@ static void geometry_infinite_get(struct pumas_geometry * base_geometry,
         }
 
         if (step_p != NULL) *step_p = 0;
+
+        struct pumas_state_extended * extended = (void *)state;
+        extended->safety.value = DBL_MAX;
 }
 
 
@@ -380,6 +1074,7 @@ struct pumas_geometry_infinite * pumas_geometry_infinite_create(
 
         geometry->base.get = &geometry_infinite_get;
         geometry->base.destroy = &geometry_infinite_destroy;
+        geometry->base.size = sizeof *geometry;
         geometry->medium = medium;
 
         return geometry;
@@ -392,8 +1087,13 @@ struct pumas_geometry_polyhedron * pumas_geometry_polyhedron_create(
         struct pumas_geometry_polyhedron * geometry = calloc(1,
             sizeof(*geometry) +
             n_faces * sizeof(struct pumas_polyhedron_face));
+        if (geometry == NULL) return NULL;
+
         geometry->base.get = pumas_geometry_polyhedron_get;
         geometry->base.destroy = pumas_geometry_polyhedron_destroy;
+        geometry->base.box = pumas_geometry_polyhedron_box;
+        geometry->base.size = sizeof(*geometry) +
+            n_faces * sizeof(struct pumas_polyhedron_face);
         geometry->medium = medium;
         geometry->n_faces = n_faces;
 
@@ -401,21 +1101,169 @@ struct pumas_geometry_polyhedron * pumas_geometry_polyhedron_create(
 }
 
 
-void pumas_geometry_polyhedron_destroy(struct pumas_geometry * geometry)
+struct pumas_geometry * pumas_geometry_polyhedron_create_v(int n,
+    const int * depths, const int * n_faces, struct pumas_medium ** media,
+    const double * faces)
 {
-        struct pumas_geometry * g;
-        for (g = geometry->daughters; g != NULL; g = g->next) {
-                pumas_geometry_polyhedron_destroy(g);
+        if ((n <= 0) || (depths[0] != 0)) return NULL;
+
+        /* Last mother and last daughter, per depth level */
+        struct pumas_geometry ** mothers = malloc(2 * n * sizeof(*mothers));
+        if (mothers == NULL) return NULL;
+        struct pumas_geometry ** lasts = mothers + n;
+
+        struct pumas_geometry * root = NULL;
+        int i;
+        size_t offset = 0;
+        for (i = 0; i < n; i++) {
+                const int depth = depths[i];
+                if ((depth < 0) || ((i > 0) &&
+                    ((depth == 0) || (depth > depths[i - 1] + 1)))) goto error;
+
+                struct pumas_geometry_polyhedron * p =
+                    pumas_geometry_polyhedron_create(media[i], n_faces[i]);
+                if (p == NULL) goto error;
+                memcpy(p->faces, faces + 6 * offset,
+                    n_faces[i] * sizeof(*p->faces));
+                offset += n_faces[i];
+
+                /* Normalise faces normals, as required for safety
+                 * distances
+                 */
+                int j;
+                for (j = 0; j < n_faces[i]; j++) {
+                        double * const u = p->faces[j].normal;
+                        const double norm =
+                            sqrt(u[0] * u[0] + u[1] * u[1] + u[2] * u[2]);
+                        if (norm <= 0) continue;
+                        u[0] /= norm;
+                        u[1] /= norm;
+                        u[2] /= norm;
+                }
+
+                struct pumas_geometry * g = (void *)p;
+                if (depth == 0) {
+                        root = g;
+                } else {
+                        struct pumas_geometry * mother = mothers[depth - 1];
+                        if (lasts[depth - 1] == NULL) mother->daughters = g;
+                        else lasts[depth - 1]->next = g;
+                        lasts[depth - 1] = g;
+                        g->mother = mother;
+                }
+                mothers[depth] = g;
+                lasts[depth] = NULL;
         }
+
+        free(mothers);
+        return root;
+error:
+        free(mothers);
+        if (root != NULL) geometry_destroy(root);
+        return NULL;
+}
+
+
+void pumas_geometry_polyhedron_destroy(struct pumas_geometry * geometry)
+{
         free(geometry);
 }
 
 
-void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
-    struct pumas_state * state, struct pumas_medium ** medium_p,
-    double * step_p)
+/* The bounding box of a polyhedron is obtained from its vertices, given by
+ * the intersections of triplets of faces. Note that the polyhedron is
+ * unbounded if there is a direction along which all faces recede.
+ */
+int pumas_geometry_polyhedron_box(struct pumas_geometry * geometry,
+    double * box)
 {
-#define POLYHEDRON_STEP_MIN 1E-05
+#define CROSS(a, b, c)                                                         \
+        c[0] = a[1] * b[2] - a[2] * b[1];                                      \
+        c[1] = a[2] * b[0] - a[0] * b[2];                                      \
+        c[2] = a[0] * b[1] - a[1] * b[0]
+#define DOT(a, b) (a[0] * b[0] + a[1] * b[1] + a[2] * b[2])
+#define POLYHEDRON_EPSILON 1E-09
+
+        struct pumas_geometry_polyhedron * p = (void *)geometry;
+        const int n = p->n_faces;
+        const struct pumas_polyhedron_face * const f = p->faces;
+        if (n < 4) return 0;
+
+        /* Check for a receding direction */
+        int i, j, k, m, bounded = 0;
+        for (i = 0; i < n - 1; i++) for (j = i + 1; j < n; j++) {
+                double c[3];
+                CROSS(f[i].normal, f[j].normal, c);
+                const double norm = sqrt(DOT(c, c));
+                if (norm <= POLYHEDRON_EPSILON) continue;
+                bounded = 1;
+
+                int sgn;
+                for (sgn = -1; sgn <= 1; sgn += 2) {
+                        for (k = 0; k < n; k++) {
+                                if (sgn * DOT(f[k].normal, c) >
+                                    POLYHEDRON_EPSILON * norm) break;
+                        }
+                        if (k == n) return 0;
+                }
+        }
+        if (!bounded) return 0;
+
+        /* Loop over vertices */
+        for (i = 0; i < 3; i++) {
+                box[i] = DBL_MAX;
+                box[i + 3] = -DBL_MAX;
+        }
+
+        int n_vertices = 0;
+        for (i = 0; i < n - 2; i++) for (j = i + 1; j < n - 1; j++)
+        for (k = j + 1; k < n; k++) {
+                double cjk[3], cki[3], cij[3];
+                CROSS(f[j].normal, f[k].normal, cjk);
+                const double det = DOT(f[i].normal, cjk);
+                if (fabs(det) <= POLYHEDRON_EPSILON) continue;
+                CROSS(f[k].normal, f[i].normal, cki);
+                CROSS(f[i].normal, f[j].normal, cij);
+
+                const double di = DOT(f[i].normal, f[i].origin);
+                const double dj = DOT(f[j].normal, f[j].origin);
+                const double dk = DOT(f[k].normal, f[k].origin);
+                double r[3];
+                for (m = 0; m < 3; m++) {
+                        r[m] = (di * cjk[m] + dj * cki[m] + dk * cij[m]) / det;
+                }
+
+                const double tolerance = POLYHEDRON_EPSILON *
+                    (1. + fabs(r[0]) + fabs(r[1]) + fabs(r[2]));
+                for (m = 0; m < n; m++) {
+                        const double rn =
+                            (r[0] - f[m].origin[0]) * f[m].normal[0] +
+                            (r[1] - f[m].origin[1]) * f[m].normal[1] +
+                            (r[2] - f[m].origin[2]) * f[m].normal[2];
+                        if (rn > tolerance) break;
+                }
+                if (m < n) continue;
+
+                for (m = 0; m < 3; m++) {
+                        if (r[m] < box[m]) box[m] = r[m];
+                        if (r[m] > box[m + 3]) box[m + 3] = r[m];
+                }
+                n_vertices++;
+        }
+
+        return (n_vertices > 0);
+
+#undef CROSS
+#undef DOT
+#undef POLYHEDRON_EPSILON
+}
+
+
+void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+#define POLYHEDRON_STEP_MIN 1E-05
 
         struct pumas_geometry_polyhedron * p = (void *)geometry;
         const double * const position = state->position;
@@ -428,6 +1276,7 @@ void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
                                      sgn * state->direction[2]};
 
         double dE = -DBL_MAX, dL = DBL_MAX;
+        double rn_max = -DBL_MAX;
         int i, inside = 1;
         struct pumas_polyhedron_face * s;
         for (i = 0, s = p->faces; i < p->n_faces; i++, s++) {
@@ -435,6 +1284,7 @@ void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
                     (position[1] - s->origin[1]) * s->normal[1] +
                     (position[2] - s->origin[2]) * s->normal[2];
                 if (rn > 0) inside = 0;
+                if (rn > rn_max) rn_max = rn;
                 const double un = direction[0] * s->normal[0] +
                     direction[1] * s->normal[1] + direction[2] * s->normal[2];
                 if (fabs(un) <= FLT_EPSILON) continue;
@@ -454,37 +1304,1133 @@ void pumas_geometry_polyhedron_get(struct pumas_geometry * geometry,
                 step = (dE > POLYHEDRON_STEP_MIN) ? dE : POLYHEDRON_STEP_MIN;
                 medium = NULL;
         } else {
+                /* Points located on an exit face are considered as having
+                 * crossed it.
+                 */
                 step = DBL_MAX;
-                medium = (dL == 0) ? p->medium : NULL;
+                medium = NULL;
         }
 
         if (step_p != NULL) *step_p = step;
         if (medium_p != NULL) *medium_p = medium;
 
+        /* The safety distance is given by the closest face plane, if inside,
+         * or by the farthest one otherwise. Faces normals are unit vectors,
+         * see pumas_geometry_polyhedron_create_v.
+         */
+        if (p->n_faces == 0) extended->safety.value = DBL_MAX;
+        else extended->safety.value = fabs(rn_max);
+
 #undef POLYHEDRON_STEP_MIN
 }
 
 
-struct pumas_flux_tabulation * pumas_flux_tabulation_load(const char * path)
+static void geometry_mesh_destroy(struct pumas_geometry * geometry)
 {
-        FILE * fid = fopen(path, "rb");
-        if (fid == NULL) return NULL;
+        free(geometry);
+}
+
+
+/* Access the mesh data, stored after the BVH nodes */
+static double * geometry_mesh_vertices(const struct pumas_geometry_mesh * mesh)
+{
+        return (double *)(mesh->nodes + 2 * mesh->n_triangles - 1);
+}
+
+
+static int * geometry_mesh_triangles(const struct pumas_geometry_mesh * mesh)
+{
+        return (int *)(geometry_mesh_vertices(mesh) + 3 * mesh->n_vertices);
+}
+
+
+struct pumas_geometry_mesh * pumas_geometry_mesh_create(
+    struct pumas_medium * medium, int n_vertices, const double * vertices,
+    int n_triangles, const int * triangles)
+{
+        if (n_triangles <= 0) return NULL;
+
+        /* Compute the bounding boxes of triangles */
+        double * boxes = malloc(n_triangles * (6 * sizeof(*boxes) +
+            sizeof(int)));
+        if (boxes == NULL) return NULL;
+        int * index = (void *)(boxes + 6 * n_triangles);
+
+        int i, j, k;
+        for (i = 0; i < n_triangles; i++) {
+                double * const b = boxes + 6 * i;
+                for (j = 0; j < 3; j++) {
+                        b[j] = DBL_MAX;
+                        b[j + 3] = -DBL_MAX;
+                }
+                for (k = 0; k < 3; k++) {
+                        const double * const v =
+                            vertices + 3 * triangles[3 * i + k];
+                        for (j = 0; j < 3; j++) {
+                                if (v[j] < b[j]) b[j] = v[j];
+                                if (v[j] > b[j + 3]) b[j + 3] = v[j];
+                        }
+                }
+        }
+
+        /* Allocate the geometry, with its data, as a single memory block */
+        const int n_nodes = 2 * n_triangles - 1;
+        const size_t size = sizeof(struct pumas_geometry_mesh) +
+            n_nodes * sizeof(struct pumas_bvh_node) +
+            3 * n_vertices * sizeof(double) + 3 * n_triangles * sizeof(int);
+        struct pumas_geometry_mesh * geometry = calloc(1, size);
+        if (geometry == NULL) {
+                free(boxes);
+                return NULL;
+        }
+        geometry->base.get = pumas_geometry_mesh_get;
+        geometry->base.destroy = geometry_mesh_destroy;
+        geometry->base.box = pumas_geometry_mesh_box;
+        geometry->base.size = size;
+        geometry->medium = medium;
+        geometry->n_vertices = n_vertices;
+        geometry->n_triangles = n_triangles;
+
+        /* Build the BVH and sort triangles accordingly */
+        geometry->n_nodes = pumas_bvh_build(
+            n_triangles, boxes, geometry->nodes, index);
+        memcpy(geometry_mesh_vertices(geometry), vertices,
+            3 * n_vertices * sizeof(double));
+        int * sorted = geometry_mesh_triangles(geometry);
+        for (i = 0; i < n_triangles; i++) {
+                memcpy(sorted + 3 * i, triangles + 3 * index[i],
+                    3 * sizeof(int));
+        }
+        free(boxes);
+
+        return geometry;
+}
+
+
+int pumas_geometry_mesh_box(struct pumas_geometry * geometry, double * box)
+{
+        struct pumas_geometry_mesh * mesh = (void *)geometry;
+        memcpy(box, mesh->nodes[0].box, sizeof(mesh->nodes[0].box));
+        return 1;
+}
+
+
+/* Cast a ray through a mesh, using the Moller-Trumbore algorithm for
+ * intersections with triangles. The distance to the closest hit is returned,
+ * as well as the total number of hits. Hits closer than epsilon are ignored.
+ * The return value is null if a hit is degenerate, e.g. close to an edge.
+ */
+static int geometry_mesh_cast(const struct pumas_geometry_mesh * mesh,
+    const double * r, const double * u, double epsilon, double * distance,
+    int * n_hits)
+{
+#define CROSS(a, b, c)                                                         \
+        c[0] = a[1] * b[2] - a[2] * b[1];                                      \
+        c[1] = a[2] * b[0] - a[0] * b[2];                                      \
+        c[2] = a[0] * b[1] - a[1] * b[0]
+#define DOT(a, b) (a[0] * b[0] + a[1] * b[1] + a[2] * b[2])
+#define MESH_STACK_SIZE 64
+#define MESH_DEGENERATE 1E-09
+
+        const double * const vertices = geometry_mesh_vertices(mesh);
+        const int * const triangles = geometry_mesh_triangles(mesh);
+        double inv[3];
+        int i;
+        for (i = 0; i < 3; i++) inv[i] = (u[i] == 0.) ? 0. : 1. / u[i];
+
+        int regular = 1;
+        *distance = DBL_MAX;
+        *n_hits = 0;
+
+        int stack[MESH_STACK_SIZE], n_stack = 0;
+        stack[n_stack++] = 0;
+        while (n_stack > 0) {
+                const struct pumas_bvh_node * node =
+                    mesh->nodes + stack[--n_stack];
+                if (!bvh_box_hit(node->box, r, u, inv, DBL_MAX)) continue;
+
+                if (node->count == 0) {
+                        stack[n_stack++] = node->first + 1;
+                        stack[n_stack++] = node->first;
+                        continue;
+                }
+
+                const int * t = triangles + 3 * node->first;
+                for (i = 0; i < node->count; i++, t += 3) {
+                        const double * const v0 = vertices + 3 * t[0];
+                        const double * const v1 = vertices + 3 * t[1];
+                        const double * const v2 = vertices + 3 * t[2];
+                        const double e1[3] = {v1[0] - v0[0], v1[1] - v0[1],
+                                              v1[2] - v0[2]};
+                        const double e2[3] = {v2[0] - v0[0], v2[1] - v0[1],
+                                              v2[2] - v0[2]};
+                        double p[3];
+                        CROSS(u, e2, p);
+                        const double det = DOT(e1, p);
+                        const double scale = DOT(e1, e1) * DOT(e2, e2);
+                        if (det * det <= MESH_DEGENERATE * scale) {
+                                /* The ray is parallel to the triangle */
+                                continue;
+                        }
+                        const double invdet = 1. / det;
+                        const double s[3] = {r[0] - v0[0], r[1] - v0[1],
+                                             r[2] - v0[2]};
+                        const double a = DOT(s, p) * invdet;
+                        if ((a < -MESH_DEGENERATE) ||
+                            (a > 1. + MESH_DEGENERATE)) continue;
+                        double q[3];
+                        CROSS(s, e1, q);
+                        const double b = DOT(u, q) * invdet;
+                        if ((b < -MESH_DEGENERATE) ||
+                            (a + b > 1. + MESH_DEGENERATE)) continue;
+                        const double d = DOT(e2, q) * invdet;
+                        if (d <= epsilon) continue;
+
+                        if ((a < MESH_DEGENERATE) || (b < MESH_DEGENERATE) ||
+                            (a + b > 1. - MESH_DEGENERATE)) regular = 0;
+                        if (d < *distance) *distance = d;
+                        (*n_hits)++;
+                }
+        }
+
+        return regular;
+
+#undef CROSS
+#undef DOT
+#undef MESH_STACK_SIZE
+#undef MESH_DEGENERATE
+}
+
+
+void pumas_geometry_mesh_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+#define MESH_STEP_MIN 1E-05
+#define MESH_EPSILON 1E-09
+#define MESH_MAX_TRIALS 4
+
+        struct pumas_geometry_mesh * mesh = (void *)geometry;
+        const double * const position = state->position;
+
+        struct pumas_state_extended * extended = (void *)state;
+        const double sgn =
+            (extended->context->mode.direction == PUMAS_MODE_FORWARD)? 1 : -1;
+        const double direction[3] = {sgn * state->direction[0],
+                                     sgn * state->direction[1],
+                                     sgn * state->direction[2]};
+
+        /* Points located on a boundary, within epsilon, are considered as
+         * having crossed it.
+         */
+        const double epsilon = MESH_EPSILON * (1. + fabs(position[0]) +
+            fabs(position[1]) + fabs(position[2]));
+
+        double distance;
+        int n_hits;
+        int regular = geometry_mesh_cast(
+            mesh, position, direction, epsilon, &distance, &n_hits);
+
+        /* Check the parity along alternative directions, in case of a
+         * degenerate hit
+         */
+        static const double alternatives[MESH_MAX_TRIALS][3] = {
+            {0.5773502691896258, 0.5773502691896258, 0.5773502691896258},
+            {-0.2672612419124244, 0.5345224838248488, 0.8017837257372732},
+            {0.8164965809277261, -0.4082482904761630, -0.4082482904761630},
+            {-0.4242640687119285, -0.5656854249492381, 0.7071067811865476}};
+        int i, parity = n_hits;
+        for (i = 0; (i < MESH_MAX_TRIALS) && !regular; i++) {
+                double d;
+                regular = geometry_mesh_cast(
+                    mesh, position, alternatives[i], epsilon, &d, &parity);
+        }
+        const int inside = parity % 2;
+
+        if (step_p != NULL) {
+                if (distance == DBL_MAX) *step_p = DBL_MAX;
+                else *step_p = (distance > MESH_STEP_MIN) ? distance :
+                    MESH_STEP_MIN;
+        }
+        if (medium_p != NULL) *medium_p = inside ? mesh->medium : NULL;
+
+#undef MESH_STEP_MIN
+#undef MESH_EPSILON
+#undef MESH_MAX_TRIALS
+}
+
+
+static void geometry_voxel_destroy(struct pumas_geometry * geometry)
+{
+        free(geometry);
+}
+
+
+struct pumas_geometry_voxel * pumas_geometry_voxel_create(const int * shape,
+    const double * origin, const double * size, const int * indices,
+    const double * densities, struct pumas_medium ** media)
+{
+        struct pumas_geometry_voxel * geometry = calloc(1, sizeof *geometry);
+        if (geometry == NULL) return NULL;
+
+        geometry->base.get = pumas_geometry_voxel_get;
+        geometry->base.destroy = geometry_voxel_destroy;
+        geometry->base.box = pumas_geometry_voxel_box;
+        geometry->base.size = sizeof *geometry;
+        memcpy(geometry->shape, shape, sizeof geometry->shape);
+        memcpy(geometry->origin, origin, sizeof geometry->origin);
+        memcpy(geometry->size, size, sizeof geometry->size);
+        geometry->indices = indices;
+        geometry->densities = densities;
+        geometry->media = media;
+
+        return geometry;
+}
+
+
+int pumas_geometry_voxel_box(struct pumas_geometry * geometry, double * box)
+{
+        struct pumas_geometry_voxel * voxel = (void *)geometry;
+        int i;
+        for (i = 0; i < 3; i++) {
+                box[i] = voxel->origin[i];
+                box[i + 3] = voxel->origin[i] +
+                    voxel->shape[i] * voxel->size[i];
+        }
+        return 1;
+}
+
+
+/* Locate the voxel containing a position. Positions on a voxel face are
+ * attributed to the voxel in the direction of motion. If clamp is non null,
+ * positions outside of the grid are attributed to the closest voxel.
+ */
+static int geometry_voxel_locate(const struct pumas_geometry_voxel * voxel,
+    const double * r, const double * u, int clamp, int * ijk)
+{
+#define VOXEL_EPSILON 1E-09
+
+        int i;
+        for (i = 0; i < 3; i++) {
+                double g = (r[i] - voxel->origin[i]) / voxel->size[i];
+                const double epsilon = VOXEL_EPSILON * (1. + fabs(g));
+                if (u[i] > 0) g += epsilon;
+                else if (u[i] < 0) g -= epsilon;
+
+                if ((g < 0) || (g >= voxel->shape[i])) {
+                        if (!clamp) return 0;
+                        ijk[i] = (g < 0) ? 0 : voxel->shape[i] - 1;
+                } else {
+                        ijk[i] = (int)g;
+                }
+        }
+        return 1;
+
+#undef VOXEL_EPSILON
+}
+
+
+static size_t geometry_voxel_index(
+    const struct pumas_geometry_voxel * voxel, const int * ijk)
+{
+        return ((size_t)ijk[0] * voxel->shape[1] + ijk[1]) * voxel->shape[2] +
+            ijk[2];
+}
+
+
+/* Navigation using a 3D-DDA algorithm, following Amanatides and Woo (1987).
+ * Consecutive voxels with the same material and density are merged.
+ */
+void pumas_geometry_voxel_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+#define VOXEL_STEP_MIN 1E-05
+
+        struct pumas_geometry_voxel * voxel = (void *)geometry;
+        const double * const r = state->position;
+
+        struct pumas_state_extended * extended = (void *)state;
+        const double sgn =
+            (extended->context->mode.direction == PUMAS_MODE_FORWARD)? 1 : -1;
+        const double u[3] = {sgn * state->direction[0],
+                             sgn * state->direction[1],
+                             sgn * state->direction[2]};
+
+        int i, ijk[3];
+        if (!geometry_voxel_locate(voxel, r, u, 0, ijk)) {
+                /* The position is outside of the grid */
+                if (medium_p != NULL) *medium_p = NULL;
+                if (step_p != NULL) {
+                        double box[6], inv[3];
+                        pumas_geometry_voxel_box(geometry, box);
+                        double t0 = 0., t1 = DBL_MAX;
+                        for (i = 0; i < 3; i++) {
+                                if (u[i] == 0.) {
+                                        if ((r[i] < box[i]) ||
+                                            (r[i] > box[i + 3])) break;
+                                        continue;
+                                }
+                                inv[i] = 1. / u[i];
+                                double ta = (box[i] - r[i]) * inv[i];
+                                double tb = (box[i + 3] - r[i]) * inv[i];
+                                if (ta > tb) {
+                                        const double tmp = ta;
+                                        ta = tb;
+                                        tb = tmp;
+                                }
+                                if (ta > t0) t0 = ta;
+                                if (tb < t1) t1 = tb;
+                                if (t0 > t1) break;
+                        }
+                        if (i < 3) *step_p = DBL_MAX;
+                        else *step_p = (t0 > VOXEL_STEP_MIN) ?
+                            t0 : VOXEL_STEP_MIN;
+                }
+
+                double box[6];
+                pumas_geometry_voxel_box(geometry, box);
+                extended->safety.value = bvh_box_distance(box, r);
+                return;
+        }
+
+        /* The safety distance is given by the current voxel */
+        double safety = DBL_MAX;
+        for (i = 0; i < 3; i++) {
+                const double x0 = voxel->origin[i] + ijk[i] * voxel->size[i];
+                const double d0 = r[i] - x0;
+                const double d1 = x0 + voxel->size[i] - r[i];
+                if (d0 < safety) safety = d0;
+                if (d1 < safety) safety = d1;
+        }
+        extended->safety.value = safety;
+
+        size_t index = geometry_voxel_index(voxel, ijk);
+        const int material = voxel->indices[index];
+        if (medium_p != NULL) {
+                *medium_p = (material < 0) ? NULL : voxel->media[material];
+        }
+        if (step_p == NULL) return;
+
+        /* Initialise the DDA */
+        double tmax[3], tdelta[3];
+        int increment[3];
+        for (i = 0; i < 3; i++) {
+                if (u[i] == 0.) {
+                        tmax[i] = tdelta[i] = DBL_MAX;
+                        increment[i] = 0;
+                } else {
+                        increment[i] = (u[i] > 0) ? 1 : -1;
+                        const double boundary = voxel->origin[i] +
+                            (ijk[i] + (u[i] > 0)) * voxel->size[i];
+                        tmax[i] = (boundary - r[i]) / u[i];
+                        if (tmax[i] < 0) tmax[i] = 0;
+                        tdelta[i] = voxel->size[i] / fabs(u[i]);
+                }
+        }
+
+        /* Traverse voxels until a change of material or density */
+        const double density = voxel->densities[index];
+        double t;
+        for (;;) {
+                int axis = (tmax[0] < tmax[1]) ? 0 : 1;
+                if (tmax[2] < tmax[axis]) axis = 2;
+                t = tmax[axis];
+
+                ijk[axis] += increment[axis];
+                if ((ijk[axis] < 0) || (ijk[axis] >= voxel->shape[axis]))
+                        break;
+                index = geometry_voxel_index(voxel, ijk);
+                if (voxel->indices[index] != material) break;
+                if ((material >= 0) && (voxel->densities[index] != density))
+                        break;
+                tmax[axis] += tdelta[axis];
+        }
 
-        struct pumas_flux_tabulation * tabulation = NULL;
+        *step_p = (t > VOXEL_STEP_MIN) ? t : VOXEL_STEP_MIN;
+
+#undef VOXEL_STEP_MIN
+}
+
+
+/* Voxel media, with a density set by the current voxel geometry */
+static double voxel_locals(struct pumas_medium * medium,
+    struct pumas_state * state, struct pumas_locals * locals)
+{
+        memset(locals->magnet, 0x0, sizeof locals->magnet);
+        const double step = add_global_magnet(state, locals);
+
+        const struct pumas_coordinates_unitary_transformation * frame;
+        struct pumas_geometry_voxel * voxel =
+            (void *)geometry_current(state, &frame);
+        if ((voxel == NULL) ||
+            (voxel->base.get != pumas_geometry_voxel_get)) {
+                locals->density = 0;
+                return step;
+        }
+
+        struct pumas_state_extended local;
+        state = geometry_localise(state, frame, &local);
+        struct pumas_state_extended * extended = (void *)state;
+        const double sgn =
+            (extended->context->mode.direction == PUMAS_MODE_FORWARD)? 1 : -1;
+        const double u[3] = {sgn * state->direction[0],
+                             sgn * state->direction[1],
+                             sgn * state->direction[2]};
+        int ijk[3];
+        geometry_voxel_locate(voxel, state->position, u, 1, ijk);
+        locals->density = voxel->densities[geometry_voxel_index(voxel, ijk)];
+
+        return step;
+}
+
+
+void pumas_medium_voxel_initialise(struct pumas_medium * medium, int material)
+{
+        medium->material = material;
+        medium->locals = &voxel_locals;
+}
+
+
+static void geometry_primitive_destroy(struct pumas_geometry * geometry)
+{
+        free(geometry);
+}
+
+
+struct pumas_geometry_primitive * pumas_geometry_primitive_create(
+    struct pumas_medium * medium, enum pumas_primitive_type type,
+    const double * center, const double * axis, const double * size)
+{
+        struct pumas_geometry_primitive * geometry =
+            calloc(1, sizeof *geometry);
+        if (geometry == NULL) return NULL;
+
+        geometry->base.get = pumas_geometry_primitive_get;
+        geometry->base.destroy = geometry_primitive_destroy;
+        geometry->base.box = pumas_geometry_primitive_box;
+        geometry->base.size = sizeof *geometry;
+        geometry->medium = medium;
+        geometry->type = type;
+        memcpy(geometry->center, center, sizeof geometry->center);
+        memcpy(geometry->size, size, sizeof geometry->size);
+
+        if (axis != NULL) {
+                const double norm = sqrt(axis[0] * axis[0] +
+                    axis[1] * axis[1] + axis[2] * axis[2]);
+                int i;
+                for (i = 0; i < 3; i++) geometry->axis[i] = axis[i] / norm;
+        } else {
+                geometry->axis[2] = 1;
+        }
+
+        return geometry;
+}
+
+
+int pumas_geometry_primitive_box(struct pumas_geometry * geometry,
+    double * box)
+{
+        struct pumas_geometry_primitive * p = (void *)geometry;
+        const double * const a = p->axis;
+        int i;
+        for (i = 0; i < 3; i++) {
+                /* Half extent along the i-th coordinate axis */
+                const double s = sqrt(fabs(1. - a[i] * a[i]));
+                double e;
+                switch (p->type) {
+                case PUMAS_PRIMITIVE_BOX:
+                        e = p->size[i];
+                        break;
+                case PUMAS_PRIMITIVE_SPHERE:
+                        e = p->size[0];
+                        break;
+                case PUMAS_PRIMITIVE_CYLINDER:
+                        if (p->size[1] >= DBL_MAX) return 0;
+                        e = p->size[1] * fabs(a[i]) + p->size[0] * s;
+                        break;
+                case PUMAS_PRIMITIVE_CONE: {
+                        const double r = (p->size[0] > p->size[1]) ?
+                            p->size[0] : p->size[1];
+                        e = p->size[2] * fabs(a[i]) + r * s;
+                        break;
+                }
+                default:
+                        return 0;
+                }
+                box[i] = p->center[i] - e;
+                box[i + 3] = p->center[i] + e;
+        }
+        return 1;
+}
+
+
+/* Restrict the interval [t0, t1] to the solutions of a t^2 + 2 b t + c <= 0.
+ * The interval is emptied (t0 > t1) if there is no solution.
+ */
+static void primitive_quadratic(
+    double a, double b, double c, double * t0, double * t1)
+{
+#define PRIMITIVE_EPSILON 1E-12
+
+        double s0, s1;
+        if (fabs(a) <= PRIMITIVE_EPSILON * (fabs(b) + fabs(c))) {
+                /* Linear case */
+                if (b == 0.) {
+                        if (c > 0) *t1 = *t0 - 1;
+                        return;
+                }
+                const double t = -0.5 * c / b;
+                if (b > 0) {
+                        if (t < *t1) *t1 = t;
+                } else {
+                        if (t > *t0) *t0 = t;
+                }
+                return;
+        }
+
+        const double delta = b * b - a * c;
+        if (delta < 0) {
+                if (a > 0) *t1 = *t0 - 1;
+                return;
+        }
+
+        /* Numerically stable roots */
+        const double q = -(b + ((b >= 0) ? 1 : -1) * sqrt(delta));
+        s0 = q / a;
+        s1 = (q == 0.) ? s0 : c / q;
+        if (s0 > s1) {
+                const double tmp = s0;
+                s0 = s1;
+                s1 = tmp;
+        }
+
+        if (a > 0) {
+                if (s0 > *t0) *t0 = s0;
+                if (s1 < *t1) *t1 = s1;
+        } else {
+                /* Solutions are ]-inf, s0] U [s1, +inf[. The hull of their
+                 * intersections with [t0, t1] is kept, since the solids are
+                 * convex.
+                 */
+                const int lower = (*t0 <= s0);
+                const int upper = (*t1 >= s1);
+                if (lower && !upper) {
+                        if (s0 < *t1) *t1 = s0;
+                } else if (upper && !lower) {
+                        if (s1 > *t0) *t0 = s1;
+                } else if (!lower && !upper) {
+                        *t1 = *t0 - 1;
+                }
+        }
+
+#undef PRIMITIVE_EPSILON
+}
+
+
+/* Restrict the interval [t0, t1] to a slab, |(r + t u - c) . a| <= h */
+static void primitive_slab(const double * r, const double * u,
+    const double * c, const double * a, double h, double * t0, double * t1)
+{
+        if (h >= DBL_MAX) return;
+        const double z = (r[0] - c[0]) * a[0] + (r[1] - c[1]) * a[1] +
+            (r[2] - c[2]) * a[2];
+        const double w = u[0] * a[0] + u[1] * a[1] + u[2] * a[2];
+        if (w == 0.) {
+                if (fabs(z) > h) *t1 = *t0 - 1;
+                return;
+        }
+        double ta = (-h - z) / w, tb = (h - z) / w;
+        if (ta > tb) {
+                const double tmp = ta;
+                ta = tb;
+                tb = tmp;
+        }
+        if (ta > *t0) *t0 = ta;
+        if (tb < *t1) *t1 = tb;
+}
+
+
+/* Compute the interval of a line inside a primitive solid. Since all solids
+ * are convex, this is a single (possibly infinite or empty) interval.
+ */
+static void primitive_interval(const struct pumas_geometry_primitive * p,
+    const double * r, const double * u, double * t0, double * t1)
+{
+        const double * const c = p->center;
+        const double * const a = p->axis;
+        *t0 = -DBL_MAX;
+        *t1 = DBL_MAX;
+
+        int i;
+        switch (p->type) {
+        case PUMAS_PRIMITIVE_BOX:
+                for (i = 0; i < 3; i++) {
+                        double e[3] = {0., 0., 0.};
+                        e[i] = 1.;
+                        primitive_slab(r, u, c, e, p->size[i], t0, t1);
+                }
+                break;
+        case PUMAS_PRIMITIVE_SPHERE: {
+                const double d[3] = {r[0] - c[0], r[1] - c[1], r[2] - c[2]};
+                primitive_quadratic(1.,
+                    d[0] * u[0] + d[1] * u[1] + d[2] * u[2],
+                    d[0] * d[0] + d[1] * d[1] + d[2] * d[2] -
+                    p->size[0] * p->size[0], t0, t1);
+                break;
+        }
+        case PUMAS_PRIMITIVE_CYLINDER:
+        case PUMAS_PRIMITIVE_CONE: {
+                const double h = (p->type == PUMAS_PRIMITIVE_CONE) ?
+                    p->size[2] : p->size[1];
+                primitive_slab(r, u, c, a, h, t0, t1);
+                if (*t0 > *t1) break;
+
+                /* Components transverse to the axis */
+                const double d[3] = {r[0] - c[0], r[1] - c[1], r[2] - c[2]};
+                const double z = d[0] * a[0] + d[1] * a[1] + d[2] * a[2];
+                const double w = u[0] * a[0] + u[1] * a[1] + u[2] * a[2];
+                const double dp[3] = {d[0] - z * a[0], d[1] - z * a[1],
+                                      d[2] - z * a[2]};
+                const double up[3] = {u[0] - w * a[0], u[1] - w * a[1],
+                                      u[2] - w * a[2]};
+                const double A = up[0] * up[0] + up[1] * up[1] +
+                    up[2] * up[2];
+                const double B = dp[0] * up[0] + dp[1] * up[1] +
+                    dp[2] * up[2];
+                const double C = dp[0] * dp[0] + dp[1] * dp[1] +
+                    dp[2] * dp[2];
+
+                if (p->type == PUMAS_PRIMITIVE_CYLINDER) {
+                        const double R = p->size[0];
+                        primitive_quadratic(A, B, C - R * R, t0, t1);
+                } else {
+                        /* The radius varies linearly along the axis, as
+                         * k z + m
+                         */
+                        const double k = 0.5 * (p->size[1] - p->size[0]) / h;
+                        const double m = 0.5 * (p->size[0] + p->size[1]);
+                        const double rho = k * z + m;
+                        primitive_quadratic(A - k * k * w * w,
+                            B - k * w * rho, C - rho * rho, t0, t1);
+                }
+                break;
+        }
+        case PUMAS_PRIMITIVE_SLAB:
+                primitive_slab(r, u, c, a, p->size[0], t0, t1);
+                break;
+        }
+}
+
+
+/* Lower bound of the distance to the boundary of a primitive solid. The
+ * solids are described by signed functions, f(r) <= 0 inside, with a known
+ * Lipschitz constant L. Then, the distance to the boundary is at least
+ * |f(r)| / L.
+ */
+static double primitive_safety(
+    const struct pumas_geometry_primitive * p, const double * r)
+{
+        const double * const c = p->center;
+        const double * const a = p->axis;
+        const double d[3] = {r[0] - c[0], r[1] - c[1], r[2] - c[2]};
+
+        switch (p->type) {
+        case PUMAS_PRIMITIVE_BOX: {
+                double inside = DBL_MAX, outside = 0.;
+                int i;
+                for (i = 0; i < 3; i++) {
+                        const double e = fabs(d[i]) - p->size[i];
+                        if (e > 0) outside += e * e;
+                        else if (-e < inside) inside = -e;
+                }
+                return (outside > 0) ? sqrt(outside) : inside;
+        }
+        case PUMAS_PRIMITIVE_SPHERE:
+                return fabs(sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2]) -
+                    p->size[0]);
+        case PUMAS_PRIMITIVE_CYLINDER:
+        case PUMAS_PRIMITIVE_CONE: {
+                const double z = d[0] * a[0] + d[1] * a[1] + d[2] * a[2];
+                const double dp[3] = {d[0] - z * a[0], d[1] - z * a[1],
+                                      d[2] - z * a[2]};
+                const double rho = sqrt(dp[0] * dp[0] + dp[1] * dp[1] +
+                    dp[2] * dp[2]);
+                double h, fr;
+                if (p->type == PUMAS_PRIMITIVE_CYLINDER) {
+                        h = p->size[1];
+                        fr = rho - p->size[0];
+                } else {
+                        h = p->size[2];
+                        const double k = 0.5 * (p->size[1] - p->size[0]) / h;
+                        const double m = 0.5 * (p->size[0] + p->size[1]);
+                        fr = (rho - k * z - m) / sqrt(1. + k * k);
+                }
+                const double fz = (h >= DBL_MAX) ? -DBL_MAX : fabs(z) - h;
+                if ((fr <= 0) && (fz <= 0)) {
+                        return (-fr < -fz) ? -fr : -fz;
+                } else {
+                        return (fr > fz) ? fr : fz;
+                }
+        }
+        case PUMAS_PRIMITIVE_SLAB: {
+                const double z = d[0] * a[0] + d[1] * a[1] + d[2] * a[2];
+                return fabs(fabs(z) - p->size[0]);
+        }
+        default:
+                return -1;
+        }
+}
+
+
+void pumas_geometry_primitive_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+#define PRIMITIVE_STEP_MIN 1E-05
+#define PRIMITIVE_EPSILON 1E-09
+
+        struct pumas_geometry_primitive * p = (void *)geometry;
+        const double * const r = state->position;
+
+        struct pumas_state_extended * extended = (void *)state;
+        const double sgn =
+            (extended->context->mode.direction == PUMAS_MODE_FORWARD)? 1 : -1;
+        const double u[3] = {sgn * state->direction[0],
+                             sgn * state->direction[1],
+                             sgn * state->direction[2]};
+
+        double t0, t1;
+        primitive_interval(p, r, u, &t0, &t1);
+        extended->safety.value = primitive_safety(p, r);
+
+        /* Points located on a boundary, within epsilon, are considered as
+         * having crossed it.
+         */
+        const double epsilon = PRIMITIVE_EPSILON * (1. + fabs(r[0]) +
+            fabs(r[1]) + fabs(r[2]));
+
+        double step;
+        struct pumas_medium * medium;
+        if ((t0 > t1) || (t1 <= epsilon)) {
+                step = DBL_MAX;
+                medium = NULL;
+        } else if (t0 <= epsilon) {
+                step = t1;
+                medium = p->medium;
+        } else {
+                step = t0;
+                medium = NULL;
+        }
+        if (step < PRIMITIVE_STEP_MIN) step = PRIMITIVE_STEP_MIN;
+
+        if (step_p != NULL) *step_p = step;
+        if (medium_p != NULL) *medium_p = medium;
+
+#undef PRIMITIVE_STEP_MIN
+#undef PRIMITIVE_EPSILON
+}
+
+
+/* Placed geometries */
+static void geometry_placement_destroy(struct pumas_geometry * geometry)
+{
+        struct pumas_geometry_placement * placement = (void *)geometry;
+        if (placement->owned) geometry_destroy(placement->content);
+        free(geometry);
+}
+
+
+static void geometry_placement_reset(struct pumas_geometry * geometry)
+{
+        struct pumas_geometry_placement * placement = (void *)geometry;
+        geometry_reset(placement->content);
+}
+
+
+struct pumas_geometry_placement * pumas_geometry_placement_create(
+    struct pumas_geometry * content, int owned,
+    const struct pumas_coordinates_unitary_transformation * frame)
+{
+        struct pumas_geometry_placement * geometry =
+            calloc(1, sizeof *geometry);
+        if (geometry == NULL) return NULL;
+
+        geometry->base.get = pumas_geometry_placement_get;
+        geometry->base.destroy = geometry_placement_destroy;
+        geometry->base.box = pumas_geometry_placement_box;
+        memcpy(&geometry->frame, frame, sizeof geometry->frame);
+        geometry->content = content;
+        geometry->owned = owned;
+
+        if (owned) {
+                /* The content is specific to this placement */
+                geometry_index(content);
+                if (pumas_geometry_stateful(content))
+                        geometry->base.reset = geometry_placement_reset;
+        } else {
+                geometry->base.size = sizeof *geometry;
+        }
+
+        return geometry;
+}
+
+
+int pumas_geometry_placement_box(struct pumas_geometry * geometry,
+    double * box)
+{
+        struct pumas_geometry_placement * placement = (void *)geometry;
+        struct pumas_geometry * content = placement->content;
+        double b[6];
+        if ((content->box == NULL) || !content->box(content, b)) return 0;
+
+        /* Bound the corners of the content box, in the parent frame */
+        int i, j;
+        for (i = 0; i < 3; i++) {
+                box[i] = DBL_MAX;
+                box[i + 3] = -DBL_MAX;
+        }
+        for (j = 0; j < 8; j++) {
+                double r[3] = {b[(j & 1) ? 3 : 0], b[(j & 2) ? 4 : 1],
+                    b[(j & 4) ? 5 : 2]};
+                pumas_coordinates_point_transform_v(&placement->frame, 0, 1,
+                    r, 0, r, 0);
+                for (i = 0; i < 3; i++) {
+                        if (r[i] < box[i]) box[i] = r[i];
+                        if (r[i] > box[i + 3]) box[i + 3] = r[i];
+                }
+        }
+        return 1;
+}
+
+
+/* Compose two frames, i.e. c = a * b. The output might alias an input */
+static void placement_compose(
+    const struct pumas_coordinates_unitary_transformation * a,
+    const struct pumas_coordinates_unitary_transformation * b,
+    struct pumas_coordinates_unitary_transformation * c)
+{
+        struct pumas_coordinates_unitary_transformation tmp;
+        int i, j;
+        for (i = 0; i < 3; i++) {
+                tmp.translation[i] = a->translation[i];
+                for (j = 0; j < 3; j++) {
+                        tmp.translation[i] += a->matrix[i][j] *
+                            b->translation[j];
+                        tmp.matrix[i][j] = a->matrix[i][0] * b->matrix[0][j] +
+                            a->matrix[i][1] * b->matrix[1][j] +
+                            a->matrix[i][2] * b->matrix[2][j];
+                }
+        }
+        memcpy(c, &tmp, sizeof tmp);
+}
+
+
+void pumas_geometry_placement_get(struct pumas_geometry * geometry,
+    struct pumas_state * state, struct pumas_medium ** medium_p,
+    double * step_p)
+{
+        struct pumas_geometry_placement * placement = (void *)geometry;
+        struct pumas_state_extended * extended = (void *)state;
+
+        /* Navigate the content, w.r.t. the local frame. Since distances are
+         * invariant, steps and safeties need no transform.
+         */
+        double r[3], u[3];
+        memcpy(r, state->position, sizeof r);
+        memcpy(u, state->direction, sizeof u);
+        pumas_coordinates_point_transform_v(&placement->frame, 1, 1, r, 0,
+            state->position, 0);
+        pumas_coordinates_vector_transform_v(&placement->frame, 1, 1, u, 0,
+            state->direction, 0);
+        extended->geodetic.computed = 0;
+
+        struct pumas_medium * medium;
+        struct pumas_geometry * current;
+        geometry_navigate(placement->content, state, &medium, step_p, NULL,
+            &current);
+
+        memcpy(state->position, r, sizeof r);
+        memcpy(state->direction, u, sizeof u);
+        extended->geodetic.computed = 0;
+
+        /* The safety radius was already updated by the content navigation */
+        extended->safety.value = extended->safety.radius;
+
+        /* Keep track of the located node, e.g. for media locals */
+        if (medium != NULL) {
+                if (current->get == pumas_geometry_placement_get) {
+                        placement_compose(&placement->frame,
+                            &extended->local.frame, &extended->local.frame);
+                } else {
+                        extended->local.current = current;
+                        memcpy(&extended->local.frame, &placement->frame,
+                            sizeof extended->local.frame);
+                }
+        }
+        if (medium_p != NULL) *medium_p = medium;
+}
+
+
+/* Integration of DCSs using a Gauss-Legendre quadrature over log(q) */
+double pumas_dcs_integrate(pumas_dcs_t * dcs, double Z, double A,
+    double mass, double energy, int order, double q0, double q1)
+{
+#define DCS_INTEGRATION_INTERVALS_PER_DECADE 4
+#define DCS_INTEGRATION_ORDER 8
+
+        static const double xGL[DCS_INTEGRATION_ORDER] = {
+            -0.9602898564975363, -0.7966664774136267, -0.5255324099163290,
+            -0.1834346424956498,  0.1834346424956498,  0.5255324099163290,
+             0.7966664774136267,  0.9602898564975363};
+        static const double wGL[DCS_INTEGRATION_ORDER] = {
+             0.1012285362903763,  0.2223810344533745,  0.3137066458778873,
+             0.3626837833783620,  0.3626837833783620,  0.3137066458778873,
+             0.2223810344533745,  0.1012285362903763};
+
+        if ((q0 <= 0) || (q1 <= q0)) return 0.;
+
+        const double lnr = log(q1 / q0);
+        int n = (int)ceil(DCS_INTEGRATION_INTERVALS_PER_DECADE * lnr /
+            log(10.));
+        if (n < 1) n = 1;
+        const double h = lnr / n;
+
+        double integral = 0.;
+        int i, j;
+        for (i = 0; i < n; i++) {
+                const double t0 = (i + 0.5) * h;
+                for (j = 0; j < DCS_INTEGRATION_ORDER; j++) {
+                        const double q = q0 * exp(t0 + 0.5 * h * xGL[j]);
+                        const double f = dcs(Z, A, mass, energy, q);
+                        if (f <= 0.) continue;
+                        integral += wGL[j] * f * pow(q, order + 1);
+                }
+        }
+
+        return 0.5 * h * integral;
+
+#undef DCS_INTEGRATION_INTERVALS_PER_DECADE
+#undef DCS_INTEGRATION_ORDER
+}
+
+
+/* Tabulation of DCS samplers. The CDF is tabulated at n nodes evenly spaced
+ * in log(q), between the kinematic bounds restricted by the relative cutoff.
+ */
+enum pumas_return pumas_dcs_sampler_tabulate(pumas_dcs_t * dcs,
+    enum pumas_process process, double Z, double A, double mass,
+    double energy, double cutoff, int n, double * cdf)
+{
+        double q0, q1;
+        enum pumas_return rc = pumas_dcs_range(
+            process, Z, mass, energy, &q0, &q1);
+        if (rc != PUMAS_RETURN_SUCCESS) return rc;
+        if (q0 < cutoff * energy) q0 = cutoff * energy;
+
+        memset(cdf, 0x0, n * sizeof(*cdf));
+        if ((n < 2) || (q1 <= q0)) return PUMAS_RETURN_SUCCESS;
+
+        const double dlq = log(q1 / q0) / (n - 1);
+        double qi = q0;
+        int i;
+        for (i = 1; i < n; i++) {
+                const double qj = q0 * exp(i * dlq);
+                cdf[i] = cdf[i - 1] +
+                    pumas_dcs_integrate(dcs, Z, A, mass, energy, 0, qi, qj);
+                qi = qj;
+        }
+
+        const double norm = cdf[n - 1];
+        if (norm <= 0) {
+                memset(cdf, 0x0, n * sizeof(*cdf));
+        } else {
+                for (i = 1; i < n - 1; i++) cdf[i] /= norm;
+                cdf[n - 1] = 1.;
+        }
+
+        return PUMAS_RETURN_SUCCESS;
+}
+
+
+/* Header of version 2 flux tabulations */
+#define FLUX_MAGIC "PUMASFLX"
+#define FLUX_VERSION 2
+#define FLUX_BYTE_ORDER 0x01020304
+
+struct flux_header {
+        char magic[8];
+        uint32_t version;
+        uint32_t byte_order;
         int64_t shape[3];
         double range[6];
+        char padding[40];
+};
 
-        if (fread(shape, 8, 3, fid) != 3) goto error;
-        if (fread(range, 8, 6, fid) != 6) goto error;
+/* Reverse the byte order of n items of the given size */
+static void flux_swap(void * data, size_t size, size_t n)
+{
+        unsigned char * p = data;
+        size_t i, j;
+        for (i = 0; i < n; i++, p += size) {
+                for (j = 0; j < size / 2; j++) {
+                        const unsigned char tmp = p[j];
+                        p[j] = p[size - 1 - j];
+                        p[size - 1 - j] = tmp;
+                }
+        }
+}
 
-        /* XXX check endianess */
+static int flux_check_shape(const int64_t * shape)
+{
+        int i;
+        for (i = 0; i < 3; i++)
+                if ((shape[i] < 1) || (shape[i] > INT_MAX)) return 0;
+        return 1;
+}
 
-        int64_t size = 2 * shape[0] * shape[1] * shape[2];
-        tabulation = malloc(sizeof (*tabulation) + 4 * size);
+struct pumas_flux_tabulation * pumas_flux_tabulation_load(const char * path)
+{
+        FILE * fid = fopen(path, "rb");
+        if (fid == NULL) return NULL;
+
+        struct pumas_flux_tabulation * tabulation =
+            calloc(1, sizeof (*tabulation));
         if (tabulation == NULL) goto error;
 
-        if (fread(tabulation->data, 4, size, fid) != (size_t)size) goto error;
-        fclose(fid);
+        /* Parse the header. Version 1 files have no magic, thus the byte
+         * order is guessed from the shape
+         */
+        struct flux_header header;
+        int64_t * const shape = header.shape;
+        double * const range = header.range;
+        if (fread(header.magic, 8, 1, fid) != 1) goto error;
+
+        int version, swap;
+        if (memcmp(header.magic, FLUX_MAGIC, 8) == 0) {
+                if (fread(&header.version, sizeof (header) - 8, 1, fid) != 1)
+                        goto error;
+                swap = (header.byte_order != FLUX_BYTE_ORDER);
+                if (swap) {
+                        flux_swap(&header.version, 4, 2);
+                        if (header.byte_order != FLUX_BYTE_ORDER) goto error;
+                        flux_swap(shape, 8, 3);
+                        flux_swap(range, 8, 6);
+                }
+                version = header.version;
+                if (version != FLUX_VERSION) goto error;
+        } else {
+                memcpy(shape, header.magic, 8);
+                if (fread(shape + 1, 8, 2, fid) != 2) goto error;
+                if (fread(range, 8, 6, fid) != 6) goto error;
+                version = 1;
+                swap = !flux_check_shape(shape);
+                if (swap) {
+                        flux_swap(shape, 8, 3);
+                        flux_swap(range, 8, 6);
+                }
+        }
+        if (!flux_check_shape(shape)) goto error;
 
         tabulation->n_k = shape[0];
         tabulation->n_c = shape[1];
@@ -496,39 +2442,96 @@ struct pumas_flux_tabulation * pumas_flux_tabulation_load(const char * path)
         tabulation->h_min = range[4];
         tabulation->h_max = range[5];
 
+        /* Precompute the grid steps */
+        tabulation->dlk = log(tabulation->k_max / tabulation->k_min) /
+                          (tabulation->n_k - 1);
+        tabulation->dc = (tabulation->c_max - tabulation->c_min) /
+                         (tabulation->n_c - 1);
+        tabulation->dh = (tabulation->h_max - tabulation->h_min) /
+                         (tabulation->n_h - 1);
+
+        /* Load the data */
+        const size_t size = 2 * (size_t)shape[0] * shape[1] * shape[2];
+        if ((version == FLUX_VERSION) && !swap) {
+                /* Map the flux, which is loaded lazily and shared between
+                 * processes
+                 */
+                fclose(fid);
+                fid = NULL;
+
+                const int fd = open(path, O_RDONLY);
+                if (fd < 0) goto error;
+                struct stat st;
+                if ((fstat(fd, &st) != 0) ||
+                    ((size_t)st.st_size < sizeof (header) + 4 * size)) {
+                        close(fd);
+                        goto error;
+                }
+                void * map = mmap(
+                    NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+                close(fd);
+                if (map == MAP_FAILED) goto error;
+                tabulation->map = map;
+                tabulation->map_size = st.st_size;
+                tabulation->data =
+                    (const float *)((char *)map + sizeof (header));
+        } else {
+                float * data = malloc(4 * size);
+                if (data == NULL) goto error;
+                tabulation->data = data;
+                if (fread(data, 4, size, fid) != size) goto error;
+                if (swap) flux_swap(data, 4, size);
+        }
+        if (fid != NULL) fclose(fid);
+
         return tabulation;
 error:
-        fclose(fid);
-        free(tabulation);
+        if (fid != NULL) fclose(fid);
+        pumas_flux_tabulation_destroy(tabulation);
         return NULL;
 }
 
 
-double pumas_flux_tabulation_get(
+void pumas_flux_tabulation_destroy(struct pumas_flux_tabulation * tabulation)
+{
+        if (tabulation == NULL) return;
+        if (tabulation->map != NULL)
+                munmap(tabulation->map, tabulation->map_size);
+        else
+                free((void *)tabulation->data);
+        free(tabulation);
+}
+
+
+/* Interpolation nodes of a flux tabulation, as offsets in data, in the order
+ * 000, 010, 100, 110, 001, 011, 101 and 111 w.r.t. (k, c, h). Zero is returned
+ * if the point is out of the tabulated range.
+ */
+struct flux_nodes {
+        int64_t offset[8];
+        double hk;
+        double hc;
+        double hh;
+};
+
+static int flux_tabulation_nodes(
     const struct pumas_flux_tabulation * tabulation, double k, double c,
-    double h, double charge)
+    double h, struct flux_nodes * nodes)
 {
-        /* Compute the interpolation indices and coefficients */
-        const double dlk = log(tabulation->k_max / tabulation->k_min) /
-                           (tabulation->n_k - 1);
-        double hk = log(k / tabulation->k_min) / dlk;
-        if ((hk < 0.) || (hk > tabulation->n_k - 1)) return 0.;
+        double hk = log(k / tabulation->k_min) / tabulation->dlk;
+        if (!(hk >= 0.) || (hk > tabulation->n_k - 1)) return 0;
         const int ik = (int)hk;
-        hk -= ik;
+        nodes->hk = hk - ik;
 
-        const double dc = (tabulation->c_max - tabulation->c_min) /
-                          (tabulation->n_c - 1);
-        double hc = (c - tabulation->c_min) / dc;
-        if ((hc < 0.) || (hc > tabulation->n_c - 1)) return 0.;
+        double hc = (c - tabulation->c_min) / tabulation->dc;
+        if (!(hc >= 0.) || (hc > tabulation->n_c - 1)) return 0;
         const int ic = (int)hc;
-        hc -= ic;
+        nodes->hc = hc - ic;
 
-        const double dh = (tabulation->h_max - tabulation->h_min) /
-                          (tabulation->n_h - 1);
-        double hh = (h - tabulation->h_min) / dh;
-        if ((hh < 0.) || (hh > tabulation->n_h - 1)) return 0.;
+        double hh = (h - tabulation->h_min) / tabulation->dh;
+        if (!(hh >= 0.) || (hh > tabulation->n_h - 1)) return 0;
         const int ih = (int)hh;
-        hh -= ih;
+        nodes->hh = hh - ih;
 
         const int ik1 = (ik < tabulation->n_k - 1) ?
             ik + 1 : tabulation->n_k - 1;
@@ -536,61 +2539,101 @@ double pumas_flux_tabulation_get(
             ic + 1 : tabulation->n_c - 1;
         const int ih1 = (ih < tabulation->n_h - 1) ?
             ih + 1 : tabulation->n_h - 1;
-        const float * const f000 =
-            tabulation->data + 2 * ((ih * tabulation->n_c + ic) *
-            tabulation->n_k + ik);
-        const float * const f010 =
-            tabulation->data + 2 * ((ih * tabulation->n_c + ic1) *
-            tabulation->n_k + ik);
-        const float * const f100 =
-            tabulation->data + 2 * ((ih * tabulation->n_c + ic) *
-            tabulation->n_k + ik1);
-        const float * const f110 =
-            tabulation->data + 2 * ((ih * tabulation->n_c + ic1) *
-            tabulation->n_k + ik1);
-        const float * const f001 =
-            tabulation->data + 2 * ((ih1 * tabulation->n_c + ic) *
-            tabulation->n_k + ik);
-        const float * const f011 =
-            tabulation->data + 2 * ((ih1 * tabulation->n_c + ic1) *
-            tabulation->n_k + ik);
-        const float * const f101 =
-            tabulation->data + 2 * ((ih1 * tabulation->n_c + ic) *
-            tabulation->n_k + ik1);
-        const float * const f111 =
-            tabulation->data + 2 * ((ih1 * tabulation->n_c + ic1) *
-            tabulation->n_k + ik1);
-
-        /* Interpolate the flux */
+        const int64_t n_c = tabulation->n_c, n_k = tabulation->n_k;
+        nodes->offset[0] = 2 * ((ih * n_c + ic) * n_k + ik);
+        nodes->offset[1] = 2 * ((ih * n_c + ic1) * n_k + ik);
+        nodes->offset[2] = 2 * ((ih * n_c + ic) * n_k + ik1);
+        nodes->offset[3] = 2 * ((ih * n_c + ic1) * n_k + ik1);
+        nodes->offset[4] = 2 * ((ih1 * n_c + ic) * n_k + ik);
+        nodes->offset[5] = 2 * ((ih1 * n_c + ic1) * n_k + ik);
+        nodes->offset[6] = 2 * ((ih1 * n_c + ic) * n_k + ik1);
+        nodes->offset[7] = 2 * ((ih1 * n_c + ic1) * n_k + ik1);
+
+        return 1;
+}
+
+
+/* Flux interpolation for a given charge index. If the flux is positive at
+ * all four nodes obtained after the interpolation along cos(theta), then the
+ * successive log interpolations along log(kinetic) and altitude reduce to a
+ * single bilinear one, which spares 2 log and 2 exp.
+ */
+static double flux_tabulation_interpolate(
+    const struct pumas_flux_tabulation * tabulation,
+    const struct flux_nodes * nodes, int i)
+{
+        const float * const f = tabulation->data + i;
+        const int64_t * const o = nodes->offset;
+        const double hk = nodes->hk, hc = nodes->hc, hh = nodes->hh;
+
+        /* Linear interpolation along cos(theta) */
+        const double g00 = f[o[0]] * (1. - hc) + f[o[1]] * hc;
+        const double g10 = f[o[2]] * (1. - hc) + f[o[3]] * hc;
+        const double g01 = f[o[4]] * (1. - hc) + f[o[5]] * hc;
+        const double g11 = f[o[6]] * (1. - hc) + f[o[7]] * hc;
+
+        if ((g00 > 0.) && (g10 > 0.) && (g01 > 0.) && (g11 > 0.)) {
+                /* Log interpolation along log(kinetic) and altitude */
+                return exp(
+                    (log(g00) * (1. - hk) + log(g10) * hk) * (1. - hh) +
+                    (log(g01) * (1. - hk) + log(g11) * hk) * hh);
+        }
+
+        /* Log or linear interpolation along log(kinetic) */
+        double g0;
+        if ((g00 <= 0.) || (g10 <= 0.))
+                g0 = g00 * (1. - hk) + g10 * hk;
+        else
+                g0 = exp(log(g00) * (1. - hk) + log(g10) * hk);
+
+        double g1;
+        if ((g01 <= 0.) || (g11 <= 0.))
+                g1 = g01 * (1. - hk) + g11 * hk;
+        else
+                g1 = exp(log(g01) * (1. - hk) + log(g11) * hk);
+
+        /* Log or linear interpolation along altitude */
+        if ((g0 <= 0.) || (g1 <= 0.))
+                return g0 * (1. - hh) + g1 * hh;
+        else
+                return exp(log(g0) * (1. - hh) + log(g1) * hh);
+}
+
+
+double pumas_flux_tabulation_get(
+    const struct pumas_flux_tabulation * tabulation, double k, double c,
+    double h, double charge)
+{
+        struct flux_nodes nodes;
+        if (!flux_tabulation_nodes(tabulation, k, c, h, &nodes)) return 0.;
+
         double flux = 0.;
         int i;
         for (i = 0; i < 2; i++) {
                 if ((1 - 2 * i) * charge < 0) continue;
-
-                /* Linear interpolation along cos(theta) */
-                const double g00 = f000[i] * (1. - hc) + f010[i] * hc;
-                const double g10 = f100[i] * (1. - hc) + f110[i] * hc;
-                const double g01 = f001[i] * (1. - hc) + f011[i] * hc;
-                const double g11 = f101[i] * (1. - hc) + f111[i] * hc;
-
-                /* Log or linear interpolation along log(kinetic) */
-                double g0;
-                if ((g00 <= 0.) || (g10 <= 0.))
-                        g0 = g00 * (1. - hk) + g10 * hk;
-                else
-                        g0 = exp(log(g00) * (1. - hk) + log(g10) * hk);
-
-                double g1;
-                if ((g01 <= 0.) || (g11 <= 0.))
-                        g1 = g01 * (1. - hk) + g11 * hk;
-                else
-                        g1 = exp(log(g01) * (1. - hk) + log(g11) * hk);
-
-                /* Log or linear interpolation along altitude */
-                if ((g0 <= 0.) || (g1 <= 0.))
-                        flux += g0 * (1. - hh) + g1 * hh;
-                else
-                        flux += exp(log(g0) * (1. - hh) + log(g1) * hh);
+                flux += flux_tabulation_interpolate(tabulation, &nodes, i);
         }
         return flux;
 }
+
+
+void pumas_flux_tabulation_get_v(
+    const struct pumas_flux_tabulation * tabulation, size_t n,
+    const double * k, const double * c, const double * h,
+    const double * charge, double * flux)
+{
+        size_t j;
+        for (j = 0; j < n; j++) {
+                struct flux_nodes nodes;
+                flux[j] = 0.;
+                if (!flux_tabulation_nodes(tabulation, k[j], c[j], h[j],
+                    &nodes)) continue;
+
+                int i;
+                for (i = 0; i < 2; i++) {
+                        if ((1 - 2 * i) * charge[j] < 0) continue;
+                        flux[j] += flux_tabulation_interpolate(tabulation,
+                            &nodes, i);
+                }
+        }
+}
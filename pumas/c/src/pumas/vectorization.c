@@ -1,4 +1,9 @@
+#include <math.h>
+#include <pthread.h>
 #include <signal.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
 
 #include "pumas/extensions.h"
 #include "pumas/vectorization.h"
@@ -37,10 +42,15 @@ static void signal_handler(int code)
 
 /* Vectorization of the transport */
 enum pumas_return pumas_context_transport_v(struct pumas_context * context,
-    size_t n_states, struct pumas_state * states)
+    size_t n_states, struct pumas_state * states, enum pumas_event * events)
 {
         signal_handler(SIGNAL_CATCH);
 
+        struct pumas_user_data * user_data = context->user_data;
+        struct pumas_recorder * recorder = user_data->recorder;
+        const struct pumas_coordinates_unitary_transformation * frame =
+            user_data->frame;
+
         enum pumas_return rc = PUMAS_RETURN_SUCCESS;
         struct pumas_state * state;
         size_t i;
@@ -48,13 +58,30 @@ enum pumas_return pumas_context_transport_v(struct pumas_context * context,
                 struct pumas_state_extended extended;
                 memcpy(&extended, state, sizeof(*state));
                 pumas_state_extended_reset(&extended, context);
+                if (frame != NULL)
+                        pumas_state_transform_v(frame, 1, 1, &extended.base);
+
+                enum pumas_event event = PUMAS_EVENT_NONE;
+                struct pumas_medium * media[2];
+                if (recorder == NULL) {
+                        rc = pumas_context_transport(context,
+                            &extended.base, &event, NULL);
+                } else {
+                        pumas_recorder_start(recorder);
+                        rc = pumas_context_transport(context,
+                            &extended.base, &event, media);
+                }
 
-                rc = pumas_context_transport(context,
-                    &extended.base, NULL, NULL);
+                if (frame != NULL)
+                        pumas_state_transform_v(frame, 0, 1, &extended.base);
+                if (recorder != NULL)
+                        pumas_recorder_stop(recorder, &extended.base,
+                            media[1]);
                 if (rc != PUMAS_RETURN_SUCCESS)
                         break;
 
                 memcpy(state, &extended, sizeof(*state));
+                if (events != NULL) events[i] = event;
         }
 
         signal_handler(SIGNAL_RAISE);
@@ -63,6 +90,19 @@ enum pumas_return pumas_context_transport_v(struct pumas_context * context,
 }
 
 
+/* Vectorization of frame transforms, over states */
+void pumas_state_transform_v(
+    const struct pumas_coordinates_unitary_transformation * frame,
+    int inverse, size_t n, struct pumas_state * states)
+{
+        const size_t stride = sizeof(*states) / sizeof(double);
+        pumas_coordinates_point_transform_v(frame, inverse, n,
+            states->position, stride, states->position, stride);
+        pumas_coordinates_vector_transform_v(frame, inverse, n,
+            states->direction, stride, states->direction, stride);
+}
+
+
 /* Vectorization of random numbers generation */
 void pumas_context_random_v(
     struct pumas_context * context, size_t n, double * data)
@@ -75,15 +115,108 @@ void pumas_context_random_v(
 }
 
 
-/* Vectorization of DCS calls */
+/* Vectorization of DCS calls, over (energy, q) pairs */
 void pumas_dcs_call_v(pumas_dcs_t * dcs, double Z, double A, double mass,
-    double energy, size_t n, double * qs, double * values)
+    size_t n, double * energies, double * qs, double * values)
+{
+        double * energy, * q, * value;
+        size_t i;
+        for (i = 0, energy = energies, q = qs, value = values; i < n;
+            i++, energy++, q++, value++) {
+                *value = dcs(Z, A, mass, *energy, *q);
+        }
+}
+
+
+/* Vectorization of DCS integrals, over the energy transfer range
+ * [x0 * energy, x1 * energy] restricted to the kinematic range
+ */
+enum pumas_return pumas_dcs_integrate_v(pumas_dcs_t * dcs,
+    enum pumas_process process, double Z, double A, double mass, int order,
+    double x0, double x1, size_t n, double * energies, double * values)
+{
+        enum pumas_return rc = PUMAS_RETURN_SUCCESS;
+        double * energy, * value;
+        size_t i;
+        for (i = 0, energy = energies, value = values; i < n;
+            i++, energy++, value++) {
+                double q0, q1;
+                rc = pumas_dcs_range(process, Z, mass, *energy, &q0, &q1);
+                if (rc != PUMAS_RETURN_SUCCESS)
+                        break;
+
+                if (q0 < x0 * *energy) q0 = x0 * *energy;
+                if (q1 > x1 * *energy) q1 = x1 * *energy;
+                *value = pumas_dcs_integrate(
+                    dcs, Z, A, mass, *energy, order, q0, q1);
+        }
+
+        return rc;
+}
+
+
+/* Vectorised sampling of energy transfers from tabulated CDFs. The CDFs are
+ * tabulated at energy nodes and selected by stochastic interpolation in
+ * log(energy). Two random numbers are consumed per sample.
+ */
+enum pumas_return pumas_dcs_sample_v(enum pumas_process process, double Z,
+    double mass, double cutoff, int n_nodes, const double * nodes, int n_cdf,
+    const double * cdfs, size_t n, double * energies, double * randoms,
+    double * values)
 {
-        double * q, * value;
+        enum pumas_return rc = PUMAS_RETURN_SUCCESS;
+        double * energy, * value, * u;
         size_t i;
-        for (i = 0, q = qs, value = values; i < n; i++, q++, value++) {
-                *value = dcs(Z, A, mass, energy, *q);
+        for (i = 0, energy = energies, value = values, u = randoms; i < n;
+            i++, energy++, value++, u += 2) {
+                /* Select the energy node */
+                int i0 = 0, i1 = n_nodes - 1;
+                if (*energy <= nodes[i0]) {
+                        i1 = i0;
+                } else if (*energy >= nodes[i1]) {
+                        i0 = i1;
+                } else {
+                        while (i1 - i0 > 1) {
+                                const int i2 = (i0 + i1) / 2;
+                                if (*energy >= nodes[i2]) i0 = i2;
+                                else i1 = i2;
+                        }
+                }
+                int node = i0;
+                if (i1 > i0) {
+                        const double h = log(*energy / nodes[i0]) /
+                            log(nodes[i1] / nodes[i0]);
+                        if (u[0] < h) node = i1;
+                }
+
+                const double * const cdf = cdfs + node * n_cdf;
+                if (cdf[n_cdf - 1] <= 0) {
+                        *value = 0.;
+                        continue;
+                }
+
+                /* Invert the CDF */
+                int j0 = 0, j1 = n_cdf - 1;
+                while (j1 - j0 > 1) {
+                        const int j2 = (j0 + j1) / 2;
+                        if (u[1] >= cdf[j2]) j0 = j2;
+                        else j1 = j2;
+                }
+                const double dc = cdf[j1] - cdf[j0];
+                const double t = (dc > 0) ?
+                    (j0 + (u[1] - cdf[j0]) / dc) / (n_cdf - 1) :
+                    j0 / (double)(n_cdf - 1);
+
+                /* Map to the kinematic range of the actual energy */
+                double q0, q1;
+                rc = pumas_dcs_range(process, Z, mass, *energy, &q0, &q1);
+                if (rc != PUMAS_RETURN_SUCCESS)
+                        break;
+                if (q0 < cutoff * *energy) q0 = cutoff * *energy;
+                *value = (q1 > q0) ? q0 * exp(t * log(q1 / q0)) : 0.;
         }
+
+        return rc;
 }
 
 
@@ -101,6 +234,37 @@ void pumas_elastic_path_v(int order, double Z, double A, double mass,
 }
 
 
+/* Vectorization of the density effect for electronic collisions */
+void pumas_electronic_density_effect_v(int n_elements, const double * Z,
+    const double * A, const double * w, double I, double density,
+    double mass, size_t n, double * energies, double * values)
+{
+        double * energy, * value;
+        size_t i;
+        for (i = 0, energy = energies, value = values; i < n;
+            i++, energy++, value++) {
+                const double gamma = 1. + *energy / mass;
+                *value = pumas_electronic_density_effect(
+                    n_elements, Z, A, w, I, density, gamma);
+        }
+}
+
+
+/* Vectorization of the electronic stopping power */
+void pumas_electronic_stopping_power_v(int n_elements, const double * Z,
+    const double * A, const double * w, double I, double density,
+    double mass, size_t n, double * energies, double * values)
+{
+        double * energy, * value;
+        size_t i;
+        for (i = 0, energy = energies, value = values; i < n;
+            i++, energy++, value++) {
+                *value = pumas_electronic_stopping_power(
+                    n_elements, Z, A, w, I, density, mass, *energy);
+        }
+}
+
+
 /* Vectorization of the elastic cutoff angle */
 enum pumas_return pumas_physics_property_elastic_cutoff_angle_v(
     const struct pumas_physics * physics, int material, size_t n,
@@ -277,3 +441,220 @@ enum pumas_return pumas_physics_table_value_v(
 
         return rc;
 }
+
+
+/* Vectorised ray casting through a geometry, without any physics. The
+ * grammage is accumulated per medium, along straight lines, until the ray
+ * exits the geometry or the maximum distance is reached.
+ */
+struct raycast_medium {
+        struct pumas_medium * medium;
+        int index;
+};
+
+struct raycast_task {
+        int n_media;
+        const struct raycast_medium * media;
+        const double * origins;
+        const double * directions;
+        const double * max_distances;
+        double * grammages;
+        double * distances;
+};
+
+struct raycast_thread {
+        struct pumas_context context;
+        struct pumas_user_data user_data;
+        const struct raycast_task * task;
+        size_t start;
+        size_t end;
+        pthread_t thread;
+};
+
+static int raycast_compare(const void * a, const void * b)
+{
+        const struct raycast_medium * ma = a, * mb = b;
+        const uintptr_t ua = (uintptr_t)ma->medium;
+        const uintptr_t ub = (uintptr_t)mb->medium;
+        return (ua > ub) - (ua < ub);
+}
+
+static double raycast_density(struct pumas_context * context,
+    struct pumas_medium * medium, struct pumas_state_extended * extended,
+    double s)
+{
+        /* Evaluate the density at a distance s along the ray */
+        struct pumas_state * state = &extended->base;
+        const double r[3] = {
+            state->position[0], state->position[1], state->position[2]};
+        const double distance = state->distance;
+
+        int i;
+        for (i = 0; i < 3; i++) state->position[i] += s * state->direction[i];
+        state->distance += s;
+        extended->geodetic.computed = 0;
+
+        struct pumas_locals locals;
+        medium->locals(medium, state, &locals);
+
+        memcpy(state->position, r, sizeof r);
+        state->distance = distance;
+        extended->geodetic.computed = 0;
+
+        return locals.density;
+}
+
+static void raycast_ray(struct pumas_context * context,
+    const struct raycast_task * task, size_t index)
+{
+#define RAYCAST_GAUSS 0.28867513459481287 /* 1 / (2 sqrt(3)) */
+#define RAYCAST_STEP_FRACTION 0.5
+
+        struct pumas_user_data * user_data = context->user_data;
+        user_data->current = user_data->top;
+
+        struct pumas_state_extended extended;
+        memset(&extended, 0x0, sizeof extended);
+        pumas_state_extended_reset(&extended, context);
+        struct pumas_state * state = &extended.base;
+        memcpy(state->position, task->origins + 3 * index,
+            sizeof state->position);
+        memcpy(state->direction, task->directions + 3 * index,
+            sizeof state->direction);
+        state->weight = 1;
+
+        double * grammage = task->grammages + index * task->n_media;
+        memset(grammage, 0x0, task->n_media * sizeof *grammage);
+        const double max_distance = task->max_distances[index];
+
+        while (state->distance < max_distance) {
+                struct pumas_medium * medium;
+                double step;
+                pumas_geometry_medium(context, state, &medium, &step);
+                if (medium == NULL) break;
+
+                struct raycast_medium key = {medium, 0};
+                const struct raycast_medium * m = bsearch(&key, task->media,
+                    task->n_media, sizeof key, &raycast_compare);
+
+                const double remaining = max_distance - state->distance;
+                if ((step <= 0) || (step > remaining)) step = remaining;
+                if (isinf(step)) {
+                        /* Unbounded ray, in an unbounded medium */
+                        if ((m != NULL) && (raycast_density(context, medium,
+                            &extended, 0) > 0))
+                                grammage[m->index] = INFINITY;
+                        state->distance = INFINITY;
+                        break;
+                }
+
+                /* Integrate the density over the step, using the midpoint
+                 * rule or a two points Gauss-Legendre quadrature for
+                 * non-uniform media
+                 */
+                struct pumas_locals locals;
+                const double s_locals = medium->locals(medium, state, &locals);
+                double density;
+                if (s_locals > 0) {
+                        if (step > RAYCAST_STEP_FRACTION * s_locals)
+                                step = RAYCAST_STEP_FRACTION * s_locals;
+                        density = 0.5 * (
+                            raycast_density(context, medium, &extended,
+                                (0.5 - RAYCAST_GAUSS) * step) +
+                            raycast_density(context, medium, &extended,
+                                (0.5 + RAYCAST_GAUSS) * step));
+                } else {
+                        density = raycast_density(
+                            context, medium, &extended, 0.5 * step);
+                }
+                if (m != NULL) grammage[m->index] += density * step;
+
+                int i;
+                for (i = 0; i < 3; i++)
+                        state->position[i] += step * state->direction[i];
+                state->distance += step;
+        }
+
+        task->distances[index] = state->distance;
+
+#undef RAYCAST_GAUSS
+#undef RAYCAST_STEP_FRACTION
+}
+
+static void * raycast_run(void * args)
+{
+        struct raycast_thread * thread = args;
+        size_t i;
+        for (i = thread->start; i < thread->end; i++)
+                raycast_ray(&thread->context, thread->task, i);
+        return NULL;
+}
+
+enum pumas_return pumas_geometry_raycast_v(struct pumas_geometry * geometry,
+    int n_threads, int n_media, struct pumas_medium ** media, size_t n,
+    const double * origins, const double * directions,
+    const double * max_distances, double * grammages, double * distances)
+{
+        /* Nodes with a per-context state cannot be shared between threads */
+        if (pumas_geometry_stateful(geometry) || (n_threads < 1))
+                n_threads = 1;
+        if ((size_t)n_threads > n) n_threads = (n > 0) ? n : 1;
+
+        struct raycast_medium * sorted = malloc(
+            (n_media > 0 ? n_media : 1) * sizeof *sorted);
+        struct raycast_thread * threads = malloc(n_threads * sizeof *threads);
+        if ((sorted == NULL) || (threads == NULL)) {
+                free(sorted);
+                free(threads);
+                return PUMAS_RETURN_MEMORY_ERROR;
+        }
+
+        int i;
+        for (i = 0; i < n_media; i++) {
+                sorted[i].medium = media[i];
+                sorted[i].index = i;
+        }
+        qsort(sorted, n_media, sizeof *sorted, &raycast_compare);
+
+        const struct raycast_task task = {n_media, sorted, origins, directions,
+            max_distances, grammages, distances};
+
+        /* Initialise the per thread contexts, sharing the geometry */
+        for (i = 0; i < n_threads; i++) {
+                struct raycast_thread * t = threads + i;
+                memset(&t->context, 0x0, sizeof t->context);
+                t->context.mode.direction = PUMAS_MODE_FORWARD;
+                t->context.accuracy = 1E-02;
+                t->context.user_data = &t->user_data;
+                memset(&t->user_data, 0x0, sizeof t->user_data);
+                if (i == 0) {
+                        pumas_geometry_set(&t->context, geometry);
+                } else {
+                        t->user_data.top = geometry;
+                }
+                t->task = &task;
+                t->start = (n * i) / n_threads;
+                t->end = (n * (i + 1)) / n_threads;
+        }
+
+        /* Run the threads, falling back to the calling one on failure */
+        int * started = calloc(n_threads, sizeof *started);
+        for (i = 1; i < n_threads; i++) {
+                if ((started != NULL) && (pthread_create(&threads[i].thread,
+                    NULL, &raycast_run, threads + i) == 0))
+                        started[i] = 1;
+        }
+        raycast_run(threads);
+        for (i = 1; i < n_threads; i++) {
+                if ((started != NULL) && started[i])
+                        pthread_join(threads[i].thread, NULL);
+                else
+                        raycast_run(threads + i);
+        }
+
+        free(started);
+        free(threads);
+        free(sorted);
+
+        return PUMAS_RETURN_SUCCESS;
+}
@@ -29,6 +29,9 @@ class Context:
         user_data.top = ffi.NULL
         user_data.current = ffi.NULL
         user_data.callback = ffi.NULL
+        user_data.recorder = ffi.NULL
+        user_data.stateful = 0
+        user_data.frame = ffi.NULL
 
         # Set the mappings
         if self._ENERGY_LOSS_STR is None:
@@ -43,8 +46,11 @@ class Context:
             self._ENERGY_LOSS_IDX = d_idx
             self._ENERGY_LOSS_STR = d_str
 
-        # Initialise the geometry ref
+        # Initialise the geometry, frame and recorder refs
         self._geometry = None
+        self._generation = None
+        self._frame = None
+        self._recorder = None
 
         # Set any extra arguments
         for k, v in kwargs.items():
@@ -137,6 +143,21 @@ class Context:
         except KeyError:
             raise ValueError(f"bad energy loss mode ('{v}')")
 
+    @property
+    def frame(self):
+        '''Local frame of the geometry, w.r.t. the frame of states
+
+           States are transformed to the local frame before their transport,
+           and back afterwards.
+        '''
+        return self._frame
+
+    @frame.setter
+    def frame(self, v):
+        user_data = ffi.cast('struct pumas_user_data *', self._c.user_data)
+        user_data.frame = ffi.NULL if v is None else v._c
+        self._frame = v
+
     @property
     def geometry(self):
         return self._geometry
@@ -149,6 +170,7 @@ class Context:
         if self._geometry is not None:
             lib.pumas_geometry_destroy(self._c)
         self._geometry = v
+        self._generation = None
 
     @property
     def grammage_limit(self):
@@ -192,6 +214,16 @@ class Context:
         seed = ffi.new('unsigned long *', v)
         lib.pumas_context_random_seed_set(self._c, seed)
 
+    @property
+    def recorder(self):
+        return self._recorder
+
+    @recorder.setter
+    def recorder(self, v):
+        user_data = ffi.cast('struct pumas_user_data *', self._c.user_data)
+        user_data.recorder = ffi.NULL if v is None else v._c
+        self._recorder = v
+
     @property
     def scattering(self):
         if self._c.mode.scattering == lib.PUMAS_MODE_DISABLED:
@@ -226,6 +258,10 @@ class Context:
 
     def transport(self, states):
         '''Transport Monte Carlo state(s)
+
+           The events ending the transport of states are returned, as PUMAS
+           event flags, e.g. lib.PUMAS_EVENT_MEDIUM if a state exited the
+           geometry.
         '''
         missing = Medium._update(self._physics)
         if missing:
@@ -236,5 +272,12 @@ class Context:
         else:
             self._geometry._update(self)
 
+        if self._recorder is not None:
+            self._recorder._register(self._geometry)
+
         data = ffi.cast('struct pumas_state *', states.ctypes.data)
-        pcall(lib.pumas_context_transport_v, self._c, states.size, data)
+        events = numpy.empty(states.shape, dtype='i4')
+        pcall(lib.pumas_context_transport_v, self._c, states.size, data,
+            ffi.cast('enum pumas_event *', events.ctypes.data))
+
+        return events
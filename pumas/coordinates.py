@@ -0,0 +1,228 @@
+from .libpumas import ffi, lib
+from .state import StateArray
+
+import numpy
+
+__all__ = ('UnitaryTransformation', 'ecef_from_geodetic',
+    'ecef_from_horizontal', 'ecef_to_geodetic', 'ecef_to_horizontal')
+
+
+def _is_states(v):
+    '''Check if v is a structured array of Monte Carlo states
+    '''
+    return isinstance(v, StateArray) and (v.dtype.names is not None)
+
+
+def _input(v, field, size):
+    '''Get a 2D view of input vectors, and its stride in number of doubles
+    '''
+    if (field is not None) and _is_states(v):
+        v = v[field]
+    v = numpy.asarray(v, dtype='f8')
+    if v.shape[-1:] != (size,):
+        raise ValueError(f'bad shape (expected (..., {size}))')
+    shape = v.shape[:-1]
+    v = v.reshape((-1, size))
+    if (v.strides[1] != 8) or (v.strides[0] % 8):
+        v = numpy.ascontiguousarray(v)
+    return v, v.strides[0] // 8, shape
+
+
+def _output(out, field, size, shape):
+    '''Get a 2D view of output vectors, and its stride in number of doubles
+    '''
+    if out is None:
+        out = numpy.empty(shape + (size,))
+    result = out
+    if (field is not None) and _is_states(out):
+        out = out[field]
+    if (not isinstance(out, numpy.ndarray)) or (out.dtype != 'f8') or       \
+       (out.shape != shape + (size,)):
+        raise ValueError(f'bad output (expected a float64 array with shape '
+                         f'{shape + (size,)})')
+    view = out.view(numpy.ndarray)
+    try:
+        view.shape = (-1, size)
+    except AttributeError:
+        view = None
+    if (view is None) or (view.strides[1] != 8) or (view.strides[0] % 8):
+        raise ValueError('bad output (expected a strided array)')
+    return result, view, view.strides[0] // 8
+
+
+def _broadcast(*args):
+    '''Broadcast input vectors, w.r.t. their leading dimensions
+    '''
+    args = [numpy.asarray(v[field] if (field is not None) and _is_states(v)
+        else v, dtype='f8') for v, field in args]
+    shape = numpy.broadcast_shapes(*(v.shape[:-1] for v in args))
+    return [numpy.broadcast_to(v, shape + v.shape[-1:]) for v in args]
+
+
+def _pointer(v):
+    return ffi.cast('double *', v.ctypes.data)
+
+
+def ecef_from_geodetic(geodetic, out=None):
+    '''Convert geodetic coordinates (latitude, longitude, altitude) to ECEF
+       positions
+
+       Angles are in degrees, and the altitude w.r.t. the WGS84 ellipsoid in m.
+       The output might be a StateArray, in which case its positions are set.
+    '''
+    geodetic, stride, shape = _input(geodetic, None, 3)
+    result, view, out_stride = _output(out, 'position', 3, shape)
+    lib.pumas_coordinates_ecef_from_geodetic_v(view.shape[0],
+        _pointer(geodetic), stride, _pointer(view), out_stride)
+    return result
+
+
+def ecef_to_geodetic(position, out=None):
+    '''Convert ECEF positions to geodetic coordinates (latitude, longitude,
+       altitude)
+
+       The input might be a StateArray, in which case its positions are used.
+    '''
+    position, stride, shape = _input(position, 'position', 3)
+    result, view, out_stride = _output(out, None, 3, shape)
+    lib.pumas_coordinates_ecef_to_geodetic_v(view.shape[0],
+        _pointer(position), stride, _pointer(view), out_stride)
+    return result
+
+
+def ecef_from_horizontal(geodetic, horizontal, out=None):
+    '''Convert horizontal directions (azimuth, elevation), at geodetic
+       location(s), to ECEF directions
+
+       The azimuth is clockwise from the geographic North. The output might be
+       a StateArray, in which case its directions are set.
+    '''
+    geodetic, horizontal = _broadcast((geodetic, None), (horizontal, None))
+    geodetic, geodetic_stride, shape = _input(geodetic, None, 3)
+    horizontal, horizontal_stride, _ = _input(horizontal, None, 2)
+    result, view, out_stride = _output(out, 'direction', 3, shape)
+    lib.pumas_coordinates_ecef_from_horizontal_v(view.shape[0],
+        _pointer(geodetic), geodetic_stride, _pointer(horizontal),
+        horizontal_stride, _pointer(view), out_stride)
+    return result
+
+
+def ecef_to_horizontal(geodetic, direction, out=None):
+    '''Convert ECEF directions, at geodetic location(s), to horizontal
+       directions (azimuth, elevation)
+
+       The direction might be a StateArray, in which case its directions are
+       used.
+    '''
+    geodetic, direction = _broadcast((geodetic, None),
+        (direction, 'direction'))
+    geodetic, geodetic_stride, shape = _input(geodetic, None, 3)
+    direction, direction_stride, _ = _input(direction, None, 3)
+    result, view, out_stride = _output(out, None, 2, shape)
+    lib.pumas_coordinates_ecef_to_horizontal_v(view.shape[0],
+        _pointer(geodetic), geodetic_stride, _pointer(direction),
+        direction_stride, _pointer(view), out_stride)
+    return result
+
+
+class UnitaryTransformation:
+    '''Rotation and translation from a local frame to its parent one
+
+       The columns of the matrix are the local basis vectors, and the
+       translation is the local origin, both expressed in the parent frame.
+    '''
+
+    def __init__(self, matrix=None, translation=None):
+        self._c = ffi.new('struct pumas_coordinates_unitary_transformation *')
+        if matrix is None:
+            matrix = numpy.eye(3)
+        matrix = numpy.asarray(matrix, dtype='f8')
+        if matrix.shape != (3, 3):
+            raise ValueError('bad matrix shape (expected (3, 3))')
+        if not numpy.allclose(matrix @ matrix.T, numpy.eye(3), atol=1E-09):
+            raise ValueError('bad matrix (expected a unitary one)')
+        self._c.matrix = matrix.tolist()
+        if translation is not None:
+            translation = numpy.asarray(translation, dtype='f8')
+            if translation.shape != (3,):
+                raise ValueError('bad translation shape (expected (3,))')
+            self._c.translation = translation.tolist()
+
+    @classmethod
+    def from_euler(cls, axes, angles, translation=None):
+        '''Create a rotation from a sequence of Euler angles, in degrees
+
+           Axes are given as a string, e.g. 'zyz'.
+        '''
+        angles = numpy.atleast_1d(numpy.asarray(angles, dtype='f8'))
+        if len(axes) != len(angles):
+            raise ValueError('inconsistent axes and angles')
+        try:
+            index = ffi.new('int []', ['xyz'.index(a) for a in axes.lower()])
+        except ValueError:
+            raise ValueError(f"bad axes ('{axes}')")
+
+        self = cls(translation=translation)
+        lib.pumas_coordinates_unitary_transformation_from_euler(self._c,
+            len(angles), index, ffi.new('double []',
+            numpy.radians(angles).tolist()))
+        return self
+
+    @classmethod
+    def local(cls, geodetic, declination=None, inclination=None):
+        '''Create a local frame at a geodetic location
+
+           The x, y and z axes point to the East, North and Up directions. The
+           frame might be rotated by a declination w.r.t. the geographic North,
+           and by an inclination w.r.t. the horizontal, both in degrees.
+        '''
+        geodetic = numpy.asarray(geodetic, dtype='f8')
+        if geodetic.shape != (3,):
+            raise ValueError('bad geodetic shape (expected (3,))')
+        point = ffi.new('struct pumas_geodetic_point *', geodetic.tolist())
+
+        self = cls()
+        lib.pumas_coordinates_frame_initialise_local(self._c, ffi.NULL,
+            point, declination or 0, inclination or 0)
+        return self
+
+    @property
+    def matrix(self):
+        return numpy.array([list(row) for row in self._c.matrix])
+
+    @property
+    def translation(self):
+        return numpy.array(list(self._c.translation))
+
+    def transform(self, states, inverse=False):
+        '''Transform the positions and directions of a StateArray, in place
+
+           States are transformed from the local frame to the parent one, or
+           conversely if inverse is True.
+        '''
+        if _is_states(states) and states.flags.c_contiguous:
+            lib.pumas_state_transform_v(self._c, bool(inverse), states.size,
+                ffi.cast('struct pumas_state *', states.ctypes.data))
+        else:
+            self.transform_points(states, inverse, out=states)
+            self.transform_vectors(states, inverse, out=states)
+
+    def transform_points(self, points, inverse=False, out=None):
+        '''Transform cartesian point(s), e.g. positions
+        '''
+        points, stride, shape = _input(points, 'position', 3)
+        result, view, out_stride = _output(out, 'position', 3, shape)
+        lib.pumas_coordinates_point_transform_v(self._c, bool(inverse),
+            view.shape[0], _pointer(points), stride, _pointer(view),
+            out_stride)
+        return result
+
+    def transform_vectors(self, vectors, inverse=False, out=None):
+        '''Transform cartesian vector(s), e.g. directions
+        '''
+        vectors, stride, shape = _input(vectors, 'direction', 3)
+        result, view, out_stride = _output(out, 'direction', 3, shape)
+        lib.pumas_coordinates_vector_transform_v(self._c, bool(inverse),
+            view.shape[0], _pointer(vectors), stride, _pointer(view),
+            out_stride)
+        return result
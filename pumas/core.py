@@ -1,8 +1,9 @@
 from .libpumas import ffi, lib
 
+import numpy
 import re
 
-__all__ = ('LibraryError', 'pcall')
+__all__ = ('empty_array', 'LibraryError', 'pcall')
 
 
 class LibraryError(Exception):
@@ -12,6 +13,24 @@ class LibraryError(Exception):
 
 
 
+def empty_array(shape, out=None):
+    '''Allocate an array of floats for C outputs, or check a user supplied one
+    '''
+    if out is None:
+        return numpy.empty(shape, dtype='f8')
+
+    if (not isinstance(out, numpy.ndarray)) or (out.dtype != numpy.float64) \
+        or (not out.flags.c_contiguous) or (not out.flags.writeable):
+        raise ValueError('bad output array (expected a writeable C '
+            'contiguous float64 array)')
+
+    shape = tuple(shape)
+    if out.shape != shape:
+        raise ValueError(f"bad output shape ('{out.shape}' != '{shape}')")
+
+    return out
+
+
 def pcall(function, *args):
     '''Protected library call with exception handling
     '''
@@ -1,3 +1,4 @@
+from collections.abc import MutableMapping
 import copy
 from dataclasses import dataclass, field
 import numpy
@@ -10,18 +11,31 @@ __all__ = ('ElementDefinition', 'elements', 'ElementsDict',
     'MaterialDefinition', 'materials', 'MaterialsDescription', 'MaterialsDict')
 
 
+_TABLES = os.path.join(os.path.dirname(__file__), 'data')
+'''Location of the precomputed tables of PDG elements and materials
+'''
+
+
 def __getattr__(name):
-    if name == 'elements':
-        from ._elements import data
-    elif name == 'materials':
-        from ._materials import data
-    else:
+    if name not in ('elements', 'materials'):
         raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
     this = sys.modules[__name__]
-    setattr(this, name, data)
+    try:
+        data = _load_tables(_TABLES)
+    except FileNotFoundError:
+        # Fallback to the source tables, e.g. if not dumped yet
+        if name == 'elements':
+            from ._elements import data
+        else:
+            from ._materials import data
+        setattr(this, name, data)
+        return data
 
-    return data
+    for k, v in data.items():
+        setattr(this, k, v)
+
+    return data[name]
 
 
 @dataclass
@@ -102,6 +116,107 @@ class MaterialDefinition:
         return ZoA, I
 
 
+class _DefinitionsTable(MutableMapping):
+    '''Mapping of definitions that are built lazily from a table
+    '''
+
+    def __init__(self, names, build):
+        self._keys = dict.fromkeys(names)
+        self._index = {name: i for i, name in enumerate(names)}
+        self._build = build
+        self._data = {}
+
+    def __delitem__(self, k):
+        del self._keys[k]
+        self._index.pop(k, None)
+        self._data.pop(k, None)
+
+    def __getitem__(self, k):
+        try:
+            return self._data[k]
+        except KeyError:
+            v = self._data[k] = self._build(self._index.pop(k))
+            return v
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self._keys)})'
+
+    def __setitem__(self, k, v):
+        self._keys[k] = None
+        self._index.pop(k, None)
+        self._data[k] = v
+
+
+def _load_tables(path):
+    '''Load the precomputed tables of elements and materials
+    '''
+    elements, materials, components = (numpy.load(os.path.join(path,
+        f'{name}.npy')) for name in ('elements', 'materials', 'components'))
+    symbols = [symbol.decode() for symbol in elements['symbol'].tolist()]
+
+    def build_element(i):
+        Z, A, I = elements[['Z', 'A', 'I']][i].item()
+        return ElementDefinition(Z=Z, A=A, I=I)
+
+    def build_material(i):
+        density, I, ZoA, offset, count = materials[
+            ['density', 'I', 'ZoA', 'offset', 'count']][i].item()
+        c = components[offset:offset + count]
+        material = MaterialDefinition.__new__(MaterialDefinition)
+        material.density = density
+        material.elements = dict(zip((symbols[j] for j in c['element']),
+            c['weight'].tolist()))
+        material.I = I
+        material.ZoA = ZoA
+        return material
+
+    return {
+        'elements': _DefinitionsTable(symbols, build_element),
+        'materials': _DefinitionsTable(
+            [name.decode() for name in materials['name'].tolist()],
+            build_material)
+    }
+
+
+def _dump_tables(path=None):
+    '''Dump the source tables of elements and materials, precomputed
+    '''
+    from ._elements import data as elements
+    from ._materials import data as materials
+
+    if path is None:
+        path = _TABLES
+
+    symbols = list(elements.keys())
+    index = {symbol: i for i, symbol in enumerate(symbols)}
+    e_table = numpy.array([(symbol, e.Z, e.A, e.I)
+        for symbol, e in elements.items()], dtype=[('symbol', 'S2'),
+        ('Z', 'i4'), ('A', 'f8'), ('I', 'f8')])
+
+    m_rows, c_rows = [], []
+    for name, m in materials.items():
+        m_rows.append((name, m.density, m.I, m.ZoA, len(c_rows),
+            len(m.elements)))
+        c_rows += [(index[symbol], w) for symbol, w in m.elements.items()]
+    n = max(len(name) for name in materials.keys())
+    m_table = numpy.array(m_rows, dtype=[('name', f'S{n}'),
+        ('density', 'f8'), ('I', 'f8'), ('ZoA', 'f8'), ('offset', 'i4'),
+        ('count', 'i4')])
+    c_table = numpy.array(c_rows, dtype=[('element', 'i2'),
+        ('weight', 'f8')])
+
+    os.makedirs(path, exist_ok=True)
+    for name, table in (('elements', e_table), ('materials', m_table),
+        ('components', c_table)):
+        numpy.save(os.path.join(path, f'{name}.npy'), table)
+
+
 class DefinitionsDict(dict):
     '''Specialisation of dict for storing PUMAS materials definitions
     '''
@@ -0,0 +1,375 @@
+from .context import Context
+from .coordinates import ecef_to_geodetic, ecef_to_horizontal
+from .geometry import EarthGeometry
+from .libpumas import ffi, lib
+from .state import StateArray
+
+import json
+import multiprocessing
+import numpy
+import os
+import time
+
+__all__ = ('FluxTabulation', 'FluxTabulator')
+
+
+class FluxTabulation:
+    '''Tabulation of a muon flux, over kinetic energy, cos(theta) and altitude
+
+       The flux is interpolated linearly w.r.t. cos(theta). Then, its logarithm
+       is interpolated linearly w.r.t. log(kinetic energy) and altitude, except
+       close to null values. Outside of the tabulated range, the flux is null.
+
+       Version 2 files, e.g. written by the dump method, are memory mapped.
+       Thus, they are loaded lazily and shared between processes.
+    '''
+
+    _HEADER = numpy.dtype([('magic', 'S8'), ('version', 'u4'),
+        ('byte_order', 'u4'), ('shape', 'i8', 3), ('range', 'f8', 6),
+        ('padding', 'V40')])
+    '''Header of version 2 files
+    '''
+
+    def __init__(self, path):
+        c = lib.pumas_flux_tabulation_load(os.fsencode(path))
+        if c == ffi.NULL:
+            raise OSError(f"could not load flux tabulation ('{path}')")
+        self._c = ffi.gc(c, lib.pumas_flux_tabulation_destroy)
+        self._path = os.fspath(path)
+
+    def __call__(self, energy, cos_theta, altitude, charge=None):
+        '''Get the flux at the given kinetic energy, cos(theta) and altitude
+
+           The flux of negative or positive muons is returned depending on the
+           sign of charge, or the total flux if charge is null or None.
+        '''
+        if charge is None:
+            charge = 0
+        args = numpy.broadcast_arrays(*(numpy.asarray(v, dtype='f8')
+            for v in (energy, cos_theta, altitude, charge)))
+        shape = args[0].shape
+        args = [numpy.require(v, requirements='C') for v in args]
+        flux = numpy.empty(shape)
+
+        lib.pumas_flux_tabulation_get_v(self._c, flux.size,
+            *(ffi.cast('double *', v.ctypes.data) for v in args),
+            ffi.cast('double *', flux.ctypes.data))
+
+        return flux if shape else float(flux)
+
+    def dump(self, path):
+        '''Dump the tabulation to a version 2 file
+        '''
+        self.write(path, self.table, self.energy, self.cos_theta,
+            self.altitude)
+
+    @classmethod
+    def write(cls, path, flux, energy, cos_theta, altitude):
+        '''Write a flux tabulation to a version 2 file
+
+           The flux is given as an array of shape (n_energy, n_cos_theta,
+           n_altitude, 2), where the last axis stands for positive and negative
+           muons. Nodes span the kinetic energy (log scale), cos(theta) and
+           altitude ranges.
+        '''
+        flux = numpy.asarray(flux, dtype='f8')
+        if (flux.ndim != 4) or (flux.shape[3] != 2):
+            raise ValueError('bad flux shape (expected (n_energy, '
+                             'n_cos_theta, n_altitude, 2))')
+        if numpy.any(~(flux >= 0)):
+            raise ValueError('bad flux value(s) (expected positive values)')
+
+        header = numpy.zeros((), dtype=cls._HEADER)
+        header['magic'] = b'PUMASFLX'
+        header['version'] = 2
+        header['byte_order'] = 0x01020304
+        header['shape'] = flux.shape[:3]
+        ranges = []
+        for name, v in (('energy', energy), ('cos_theta', cos_theta),
+            ('altitude', altitude)):
+            v = tuple(float(vi) for vi in v)
+            if len(v) != 2:
+                raise ValueError(f"bad {name} range ('{v}')")
+            ranges += v
+        header['range'] = ranges
+
+        data = numpy.ascontiguousarray(flux.transpose(2, 1, 0, 3), dtype='f4')
+
+        with open(path, 'wb') as f:
+            header.tofile(f)
+            data.tofile(f)
+
+    @property
+    def altitude(self):
+        '''Tabulated range of altitude
+        '''
+        return (self._c.h_min, self._c.h_max)
+
+    @property
+    def cos_theta(self):
+        '''Tabulated range of cos(theta)
+        '''
+        return (self._c.c_min, self._c.c_max)
+
+    @property
+    def energy(self):
+        '''Tabulated range of kinetic energy
+        '''
+        return (self._c.k_min, self._c.k_max)
+
+    @property
+    def mapped(self):
+        '''Flag for memory mapped data
+        '''
+        return self._c.map != ffi.NULL
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def shape(self):
+        '''Number of nodes along kinetic energy, cos(theta) and altitude
+        '''
+        return (self._c.n_k, self._c.n_c, self._c.n_h)
+
+    @property
+    def table(self):
+        '''Copy of the tabulated flux, with shape (n_energy, n_cos_theta,
+           n_altitude, 2)
+        '''
+        n_k, n_c, n_h = self.shape
+        size = 2 * n_k * n_c * n_h
+        data = numpy.frombuffer(ffi.buffer(self._c.data, 4 * size),
+            dtype='f4').astype('f8')
+        return data.reshape(n_h, n_c, n_k, 2).transpose(2, 1, 0, 3).copy()
+
+
+class FluxTabulator:
+    '''Tabulate a muon flux using backward Monte Carlo transport
+
+       For each node of the (energy, cos_theta, altitude) grid, events are
+       transported backward, from position (0, 0, altitude) and with a
+       downward going direction, until they exit the geometry. The flux is
+       the mean weight times the model flux at the final states. States that
+       did not exit the geometry, e.g. due to an energy limit, do not
+       contribute. The model is called as model(energy, cos_theta, altitude,
+       charge), e.g. with a FluxTabulation, where cos_theta is the cosine of
+       the zenith angle of arrival.
+
+       Grid nodes are expressed in the frame of the tabulation site, if any,
+       w.r.t. the geometry. For an EarthGeometry, the frame is mandatory, e.g.
+       UnitaryTransformation.local, and the model is evaluated at the geodetic
+       altitude and local zenith angle of final states.
+
+       Extra keyword arguments are forwarded to the transport Context, e.g. an
+       energy limit.
+    '''
+
+    def __init__(self, physics, geometry, model, energy, cos_theta, altitude,
+            shape, events=None, seed=None, frame=None, **kwargs):
+        shape = tuple(int(n) for n in shape)
+        if (len(shape) != 3) or any(n < 2 for n in shape):
+            raise ValueError(f"bad shape ('{shape}')")
+        if events is None:
+            events = 1000
+        elif events < 1:
+            raise ValueError(f"bad number of events ('{events}')")
+        if isinstance(geometry, EarthGeometry) and (frame is None):
+            raise ValueError('missing frame (required for an Earth geometry)')
+        self._seed_given = seed is not None
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'little')
+
+        self.physics = physics
+        self.geometry = geometry
+        self.model = model
+        self.energy = tuple(float(v) for v in energy)
+        self.cos_theta = tuple(float(v) for v in cos_theta)
+        self.altitude = tuple(float(v) for v in altitude)
+        self.shape = shape
+        self.events = int(events)
+        self.seed = int(seed)
+        self.frame = frame
+        self.settings = kwargs
+
+        self.flux = numpy.zeros(shape + (2,))
+        '''Tabulated flux, for positive and negative muons
+        '''
+
+        self.error = numpy.zeros(shape + (2,))
+        '''Monte Carlo uncertainty on the tabulated flux
+        '''
+
+        self.done = numpy.zeros(shape[1:], dtype=bool)
+        '''Flags for computed (cos_theta, altitude) nodes
+        '''
+
+    def run(self, path=None, processes=None, checkpoint=None, interval=None):
+        '''Run the tabulation, and write the result to path, if not None
+
+           Grid nodes are distributed over processes, which requires the fork
+           start method if there are more than one. If a checkpoint file is
+           given, computed nodes are saved to it every interval seconds, and
+           restored when the run is resumed. If no seed was given, the one of
+           the checkpoint is used.
+        '''
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if interval is None:
+            interval = 60
+
+        if (checkpoint is not None) and os.path.exists(checkpoint):
+            self._restore(checkpoint)
+
+        todo = numpy.flatnonzero(~self.done.ravel()).tolist()
+        if todo:
+            if processes > 1:
+                global _tabulator
+                _tabulator = self
+                try:
+                    ctx = multiprocessing.get_context('fork')
+                    with ctx.Pool(processes, _tabulator_initialise) as pool:
+                        results = pool.imap_unordered(_tabulator_run, todo)
+                        self._collect(results, checkpoint, interval)
+                finally:
+                    _tabulator = None
+            else:
+                context = self._new_context()
+                self._collect((self._compute(context, index)
+                    for index in todo), checkpoint, interval)
+
+        if path is not None:
+            FluxTabulation.write(path, self.flux, self.energy, self.cos_theta,
+                self.altitude)
+
+        return self.flux
+
+    def _collect(self, results, checkpoint, interval):
+        '''Collect the computed nodes, and dump checkpoints
+        '''
+        t0 = time.monotonic()
+        for index, flux, error in results:
+            ic, ih = numpy.unravel_index(index, self.shape[1:])
+            self.flux[:, ic, ih] = flux
+            self.error[:, ic, ih] = error
+            self.done[ic, ih] = True
+            if (checkpoint is not None) and                                  \
+               (time.monotonic() - t0 >= interval):
+                self._dump(checkpoint)
+                t0 = time.monotonic()
+
+        if checkpoint is not None:
+            self._dump(checkpoint)
+
+    def _compute(self, context, index):
+        '''Compute the flux at all energies, for a (cos_theta, altitude) node
+        '''
+        ic, ih = numpy.unravel_index(index, self.shape[1:])
+        n_k, n_c, n_h = self.shape
+        c = numpy.linspace(*self.cos_theta, n_c)[ic]
+        h = numpy.linspace(*self.altitude, n_h)[ih]
+        energy = numpy.exp(numpy.linspace(*numpy.log(self.energy), n_k))
+
+        # States are ordered as (energy, charge, event)
+        n = self.events
+        states = StateArray(2 * n_k * n)
+        states.energy = numpy.repeat(energy, 2 * n)
+        states.charge = numpy.tile(numpy.repeat((1., -1.), n), n_k)
+        states.position = (0, 0, h)
+        states.direction = (numpy.sqrt(max(1 - c**2, 0)), 0, -c)
+        if self.frame is not None:
+            self.frame.transform(states)
+
+        context.random_seed = self.seed + int(index)
+        events = context.transport(states)
+
+        # Evaluate the model at exit points
+        if isinstance(self.geometry, EarthGeometry):
+            geodetic = ecef_to_geodetic(states)
+            elevation = ecef_to_horizontal(geodetic, states)[:, 1]
+            cos_theta = -numpy.sin(numpy.radians(elevation))
+            altitude = geodetic[:, 2]
+        else:
+            if self.frame is not None:
+                self.frame.transform(states, inverse=True)
+            cos_theta = -states.direction[:, 2]
+            altitude = states.position[:, 2]
+
+        exited = (events & lib.PUMAS_EVENT_MEDIUM) != 0
+        w = numpy.zeros(states.size)
+        w[exited] = states.weight[exited] * self.model(states.energy[exited],
+            cos_theta[exited], altitude[exited], states.charge[exited])
+        w = w.reshape(n_k, 2, n)
+        return index, numpy.mean(w, axis=-1),                                 \
+            numpy.std(w, axis=-1) / numpy.sqrt(n)
+
+    def _dump(self, path):
+        '''Dump a checkpoint, atomically
+        '''
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, flux=self.flux, error=self.error, done=self.done,
+                energy=self.energy, cos_theta=self.cos_theta,
+                altitude=self.altitude, shape=self.shape, events=self.events,
+                seed=self.seed, frame=self._frame_array(),
+                settings=self._settings_str())
+        os.replace(tmp, path)
+
+    def _frame_array(self):
+        '''Serialise the frame of the tabulation site, e.g. for checkpoints
+        '''
+        if self.frame is None:
+            return numpy.zeros((0, 3))
+        else:
+            return numpy.vstack((self.frame.matrix, self.frame.translation))
+
+    def _settings_str(self):
+        '''Serialise the transport settings, e.g. for checkpoints
+        '''
+        return json.dumps(self.settings, sort_keys=True, default=str)
+
+    def _new_context(self):
+        '''Create a backward transport context
+        '''
+        return Context(self.physics, geometry=self.geometry,
+            direction='backward', **self.settings)
+
+    def _restore(self, path):
+        '''Restore a checkpoint
+        '''
+        with numpy.load(path) as data:
+            for k in ('energy', 'cos_theta', 'altitude', 'shape', 'events'):
+                if not numpy.array_equal(data[k], getattr(self, k)):
+                    raise ValueError(f"bad checkpoint (inconsistent {k})")
+            if ('frame' not in data) or                                       \
+               not numpy.array_equal(data['frame'], self._frame_array()):
+                raise ValueError('bad checkpoint (inconsistent frame)')
+            if ('settings' not in data) or                                    \
+               (str(data['settings']) != self._settings_str()):
+                raise ValueError('bad checkpoint (inconsistent settings)')
+            if not self._seed_given:
+                self.seed = int(data['seed'])
+            elif data['seed'] != self.seed:
+                raise ValueError('bad checkpoint (inconsistent seed)')
+            self.flux[:] = data['flux']
+            self.error[:] = data['error']
+            self.done[:] = data['done']
+
+
+_tabulator = None
+'''Flux tabulator of the current run, inherited by forked workers
+'''
+
+_context = None
+'''Transport context of a worker
+'''
+
+
+def _tabulator_initialise():
+    global _context
+    _context = _tabulator._new_context()
+
+
+def _tabulator_run(index):
+    return _tabulator._compute(_context, index)
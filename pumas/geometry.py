@@ -1,21 +1,56 @@
+from .core import pcall
 from .libpumas import ffi, lib
+from .medium import Medium
 
-__all__ = ('InfiniteGeometry', 'Geometry', 'PolyhedronGeometry')
+import datetime
+import numbers
+import numpy
+import os
+from typing import NamedTuple
+import weakref
+
+__all__ = ('BoxGeometry', 'ConeGeometry', 'CylinderGeometry', 'EarthGeometry',
+    'InfiniteGeometry', 'Geometry', 'MagnetGrid', 'MeshGeometry',
+    'PlacedGeometry', 'PolyhedronGeometry', 'Raycast', 'SlabGeometry',
+    'SphereGeometry', 'Topography', 'VoxelGeometry')
+
+
+class Raycast(NamedTuple):
+    '''Result of a ray casting through a geometry
+    '''
+
+    materials: tuple
+    '''Names of traversed materials
+    '''
+
+    grammage: numpy.ndarray
+    '''Column density per material, in kg/m^2
+    '''
+
+    distance: numpy.ndarray
+    '''Travelled distance, in m
+    '''
 
 
 class Geometry:
     '''Base wrapper for `pumas_geometry` objects
     '''
 
+    _mutable = False
+    '''Flag for geometries with a per-context state
+    '''
+
     def __init__(self):
         self._daughters = []
         self._mothers = {}
-        self._valid = True
+        self._generation = 0
+        self._frozen = None
 
     def __getitem__(self, i):
         return self._daughters[i]
 
     def __setitem__(self, i, v):
+        self._check_frozen()
         self._check_circular(v)
 
         # Pop out the existing item
@@ -30,33 +65,154 @@ class Geometry:
         self._invalidate()
 
     def append(self, v):
+        self._check_frozen()
         self._check_circular(v)
         self._daughters.append(v)
         self._register(v)
         self._invalidate()
 
     def insert(self, i, v):
+        self._check_frozen()
         self._check_circular(v)
         self._daughters.insert(i, v)
         self._register(v)
         self._invalidate()
 
     def pop(self, pos=-1):
-        v = self.daughters.pop(pos)
+        self._check_frozen()
+        v = self._daughters.pop(pos)
         self._unregister(v)
         self._invalidate()
         return v
 
     def remove(self, v):
-        self.daughters.remove(v)
+        self._check_frozen()
+        self._daughters.remove(v)
         self._unregister(v)
         self._invalidate()
 
+    @property
+    def frozen(self):
+        return self._frozen is not None
+
+    def freeze(self):
+        '''Compile the geometry into an immutable C object
+
+           The frozen geometry is stored in a single memory block, which is
+           shared by all contexts, instead of being rebuilt per context. Note
+           that the geometry hierarchy cannot be modified afterwards.
+        '''
+        if self._frozen is not None:
+            return
+
+        def check(geometry):
+            if geometry._mutable:
+                raise ValueError(f"cannot freeze '{type(geometry).__name__}' "
+                                 f"(per-context state)")
+            content = getattr(geometry, '_geometry', None)
+            if (content is not None) and (content._frozen is None):
+                raise ValueError(f"cannot freeze '{type(geometry).__name__}' "
+                                 f"(content is not frozen)")
+            for daughter in geometry._daughters:
+                check(daughter)
+
+        check(self)
+        c = lib.pumas_geometry_freeze(self._build())
+        if c == ffi.NULL:
+            raise MemoryError('could not freeze geometry')
+        self._frozen = ffi.gc(c, lib.pumas_geometry_frozen_destroy)
+
+    def raycast(self, origins, directions, max_distance=None, threads=None):
+        '''Compute the grammage along straight lines, without any physics
+
+           Rays start from origins, with shape (..., 3), along directions. The
+           grammage is accumulated per material until the ray exits the
+           geometry, or up to max_distance. Rays are distributed over threads,
+           except for geometries with a per-context state.
+        '''
+        origins, directions = numpy.broadcast_arrays(
+            numpy.asarray(origins, dtype='f8'),
+            numpy.asarray(directions, dtype='f8'))
+        if origins.shape[-1:] != (3,):
+            raise ValueError('bad shape (expected (..., 3))')
+        shape = origins.shape[:-1]
+        origins = numpy.ascontiguousarray(origins)
+        norm = numpy.linalg.norm(directions, axis=-1, keepdims=True)
+        if numpy.any(norm == 0):
+            raise ValueError('bad direction (expected a non null 3-vector)')
+        directions = numpy.ascontiguousarray(directions / norm)
+
+        if max_distance is None:
+            max_distance = numpy.inf
+        max_distance = numpy.ascontiguousarray(
+            numpy.broadcast_to(numpy.asarray(max_distance, 'f8'), shape))
+
+        if threads is None:
+            threads = os.cpu_count() or 1
+
+        # Collect the media of the hierarchy
+        media = {}
+        for medium in self._iter_media():
+            media[id(medium)] = medium
+        media = list(media.values())
+        c_media = ffi.new('struct pumas_medium *[]',
+            [ffi.cast('struct pumas_medium *', m._c) for m in media])
+
+        # Cast the rays
+        n = origins.size // 3
+        grammage = numpy.empty((n, len(media)))
+        distance = numpy.empty(shape)
+        if self._frozen is not None:
+            c = self._frozen
+        else:
+            c = ffi.gc(self._build(), lib.pumas_geometry_tree_destroy)
+        rc = lib.pumas_geometry_raycast_v(c, threads, len(media), c_media, n,
+            ffi.cast('double *', origins.ctypes.data),
+            ffi.cast('double *', directions.ctypes.data),
+            ffi.cast('double *', max_distance.ctypes.data),
+            ffi.cast('double *', grammage.ctypes.data),
+            ffi.cast('double *', distance.ctypes.data))
+        if rc != lib.PUMAS_RETURN_SUCCESS:
+            raise MemoryError('could not allocate ray casting data')
+
+        # Sum the grammage per material
+        materials = sorted({str(m.material) for m in media})
+        index = {material: i for i, material in enumerate(materials)}
+        total = numpy.zeros((n, len(materials)))
+        for i, m in enumerate(media):
+            total[:, index[str(m.material)]] += grammage[:, i]
+        grammage = total.reshape(shape + (len(materials),))
+
+        return Raycast(tuple(materials), grammage, distance)
+
+    def _iter_media(self):
+        '''Iterate over the media of the geometry hierarchy
+        '''
+        media = getattr(self, '_media', None)
+        if media is None:
+            media = (getattr(self, '_medium', None),)
+        for medium in media:
+            if medium is not None:
+                yield medium
+        for daughter in self._daughters:
+            yield from daughter._iter_media()
+
+    def _check_frozen(self):
+        '''Check that the geometry is not part of a frozen hierarchy
+        '''
+        def check(v, *args):
+            if v._frozen is not None:
+                raise ValueError('frozen geometry')
+
+        check(self)
+        self.walk_up(self, check)
+
     def _check_circular(self, v):
         circular = self is v
 
-        def check(v):
-            if self == v:
+        def check(k, *args):
+            nonlocal circular
+            if k is v:
                 circular = True
                 return True
 
@@ -92,19 +248,15 @@ class Geometry:
     def _invalidate(self):
         '''Invalidate a geometry and all its parents
         '''
-        def invalidate(v):
-            v._valid = False
+        def invalidate(v, *args):
+            v._generation += 1
 
         self.walk_up(self, invalidate)
         invalidate(self)
 
-    def _update(self, context):
-        '''Update the per-context data of a geometry
+    def _build(self):
+        '''Build the C geometry hierarchy
         '''
-        lib.pumas_geometry_reset(context._c)
-        if (lib.pumas_geometry_get(context._c) != ffi.NULL) and self._valid:
-            return # XXX What is the 1st condition for?
-
         def set_daughters(mother, c_mother):
             for daughter in mother._daughters:
                 c_daughter = daughter._new()
@@ -113,8 +265,25 @@ class Geometry:
 
         c = self._new()
         set_daughters(self, c)
-        lib.pumas_geometry_set(context._c, c)
-        self._valid = True
+        return c
+
+    def _update(self, context):
+        '''Update the per-context data of a geometry
+
+           The C hierarchy of the context is rebuilt only if the geometry was
+           modified since it was set.
+        '''
+        if self._frozen is not None:
+            if lib.pumas_geometry_get(context._c) != self._frozen:
+                lib.pumas_geometry_destroy(context._c)
+                lib.pumas_geometry_set(context._c, self._frozen)
+        elif (context._generation != self._generation) or                     \
+             (lib.pumas_geometry_get(context._c) == ffi.NULL):
+            lib.pumas_geometry_destroy(context._c)
+            lib.pumas_geometry_set(context._c, self._build())
+            context._generation = self._generation
+
+        lib.pumas_geometry_reset(context._c)
 
 
 class InfiniteGeometry(Geometry):
@@ -139,66 +308,726 @@ class InfiniteGeometry(Geometry):
         return ffi.cast('struct pumas_geometry *', c)
 
 
+class _PrimitiveGeometry(Geometry):
+    '''Base wrapper for analytic primitive solids
+    '''
+
+    _type = None
+
+    def __init__(self, size, center=None, axis=None, medium=None):
+        super().__init__()
+        if center is None:
+            center = (0, 0, 0)
+        if axis is None:
+            axis = (0, 0, 1)
+
+        self._size = numpy.zeros(3)
+        self._size[:len(size)] = size
+        self._center = numpy.array(center, dtype='f8')
+        self._axis = numpy.array(axis, dtype='f8')
+        if self._center.shape != (3,):
+            raise ValueError('bad center shape (expected (3,))')
+        if (self._axis.shape != (3,)) or not numpy.any(self._axis):
+            raise ValueError('bad axis (expected a non null 3-vector)')
+        self._axis /= numpy.linalg.norm(self._axis)
+        self._medium = medium
+
+    @property
+    def center(self):
+        return self._center
+
+    @property
+    def medium(self):
+        return self._medium
+
+    def _new(self):
+        '''Spawn a new C geometry object
+        '''
+        if self._medium:
+            c_medium = ffi.cast('struct pumas_medium *', self._medium._c)
+        else:
+            c_medium = ffi.NULL
+        c = lib.pumas_geometry_primitive_create(c_medium, self._type,
+            ffi.cast('double *', self._center.ctypes.data),
+            ffi.cast('double *', self._axis.ctypes.data),
+            ffi.cast('double *', self._size.ctypes.data))
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate geometry')
+
+        return ffi.cast('struct pumas_geometry *', c)
+
+
+class BoxGeometry(_PrimitiveGeometry):
+    '''Axis aligned box, given its full size along the x, y and z axes
+    '''
+
+    _type = lib.PUMAS_PRIMITIVE_BOX
+
+    def __init__(self, size, center=None, medium=None):
+        size = 0.5 * numpy.broadcast_to(numpy.asarray(size, dtype='f8'), (3,))
+        super().__init__(size, center, None, medium)
+
+    @property
+    def size(self):
+        return 2 * self._size
+
+
+class SphereGeometry(_PrimitiveGeometry):
+    '''Sphere, given its radius
+    '''
+
+    _type = lib.PUMAS_PRIMITIVE_SPHERE
+
+    def __init__(self, radius, center=None, medium=None):
+        super().__init__((radius,), center, None, medium)
+
+    @property
+    def radius(self):
+        return self._size[0]
+
+
+class CylinderGeometry(_PrimitiveGeometry):
+    '''Cylinder, given its radius and length along its axis
+
+       The cylinder has an infinite length if none is provided.
+    '''
+
+    _type = lib.PUMAS_PRIMITIVE_CYLINDER
+
+    def __init__(self, radius, length=None, center=None, axis=None,
+        medium=None):
+        half = numpy.finfo('f8').max if length is None else 0.5 * length
+        super().__init__((radius, half), center, axis, medium)
+
+    @property
+    def axis(self):
+        return self._axis
+
+    @property
+    def length(self):
+        half = self._size[1]
+        return None if half == numpy.finfo('f8').max else 2 * half
+
+    @property
+    def radius(self):
+        return self._size[0]
+
+
+class ConeGeometry(_PrimitiveGeometry):
+    '''Conical frustum, given its bottom and top radii and its length along
+       its axis
+
+       The bottom face is located at center - 0.5 * length * axis.
+    '''
+
+    _type = lib.PUMAS_PRIMITIVE_CONE
+
+    def __init__(self, radii, length, center=None, axis=None, medium=None):
+        r0, r1 = radii
+        super().__init__((r0, r1, 0.5 * length), center, axis, medium)
+
+    @property
+    def axis(self):
+        return self._axis
+
+    @property
+    def length(self):
+        return 2 * self._size[2]
+
+    @property
+    def radii(self):
+        return tuple(self._size[:2])
+
+
+class SlabGeometry(_PrimitiveGeometry):
+    '''Slab of infinite extension, given its thickness along its axis
+    '''
+
+    _type = lib.PUMAS_PRIMITIVE_SLAB
+
+    def __init__(self, thickness, center=None, axis=None, medium=None):
+        super().__init__((0.5 * thickness,), center, axis, medium)
+
+    @property
+    def axis(self):
+        return self._axis
+
+    @property
+    def thickness(self):
+        return 2 * self._size[0]
+
+
 class PolyhedronGeometry(Geometry):
     '''Static geometry made from a hierarchy of polyhedrons
+
+       Polyhedrons are defined by their faces, as an array of shape (n, 6)
+       with rows (origin, normal). Normals need not be unit vectors. Nested
+       daughters are given as a sequence of (data, medium, daughters) tuples.
     '''
 
     def __init__(self, data, medium=None, daughters=None):
         super().__init__()
-        self._refs = []
-        self._build_polyhedrons((data, medium, daughters), self._refs, 1, 0)
+
+        # Flatten the hierarchy of polyhedrons, in depth first order
+        faces, n_faces, depths, media = [], [], [], []
+        stack = [((data, medium, daughters), 0)]
+        while stack:
+            args, depth = stack.pop()
+            data = numpy.require(args[0], 'f8', ('C',))
+            if data.size == 0:
+                data = data.reshape(0, 6)
+            if (data.ndim != 2) or (data.shape[1] != 6):
+                raise ValueError('bad faces shape (expected (n, 6))')
+            medium = args[1] if len(args) > 1 else None
+            daughters = args[2] if len(args) > 2 else None
+
+            faces.append(data)
+            n_faces.append(data.shape[0])
+            depths.append(depth)
+            media.append(medium)
+            if daughters:
+                stack += [(d, depth + 1) for d in reversed(daughters)]
+
+        self._faces = faces[0] if len(faces) == 1 else \
+            numpy.concatenate(faces)
+        self._n_faces = numpy.array(n_faces, dtype='i4')
+        self._depths = numpy.array(depths, dtype='i4')
+        self._media = media
+        self._c_media = ffi.new('struct pumas_medium *[]',
+            [ffi.NULL if m is None else ffi.cast('struct pumas_medium *', m._c)
+             for m in media])
 
     def _new(self):
-        '''Spawn a C geometry reference
+        '''Spawn a new C geometry object
         '''
-        return ffi.cast('struct pumas_geometry *', self._refs[0])
+        c = lib.pumas_geometry_polyhedron_create_v(len(self._media),
+            ffi.cast('int *', self._depths.ctypes.data),
+            ffi.cast('int *', self._n_faces.ctypes.data), self._c_media,
+            ffi.cast('double *', self._faces.ctypes.data))
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate geometry')
 
-    @staticmethod 
-    def _build_polyhedrons(args, refs, depth, index):
-        data = args[0]
-        try:
-            medium = args[1]
-        except IndexError:
-            medium = None
-        try:
-            daughters = args[2]
-        except IndexError:
-            daughters = None
-
-        n_faces = len(data)
-        size = ffi.sizeof('struct pumas_geometry_polyhedron') +                \
-            n_faces * ffi.sizeof('struct pumas_polyhedron_face')
-        if medium is not None:
-            m = ffi.cast('struct pumas_medium *', medium._c)
+        return c
+
+
+class MeshGeometry(Geometry):
+    '''Geometry of a closed triangular mesh
+
+       The mesh is defined by an array of vertices, of shape (n, 3), and by an
+       array of triangles, of shape (m, 3), indexing the vertices. Points are
+       located inside the mesh by ray parity. Thus, the mesh must be closed,
+       but it needs not be convex.
+    '''
+
+    def __init__(self, vertices, triangles, medium=None):
+        super().__init__()
+
+        vertices = numpy.require(vertices, 'f8', ('C',))
+        triangles = numpy.require(triangles, 'i4', ('C',))
+        if (vertices.ndim != 2) or (vertices.shape[1] != 3):
+            raise ValueError('bad vertices shape (expected (n, 3))')
+        if (triangles.ndim != 2) or (triangles.shape[1] != 3) or \
+            (triangles.shape[0] == 0):
+            raise ValueError('bad triangles shape (expected (m, 3))')
+        if (numpy.min(triangles) < 0) or \
+            (numpy.max(triangles) >= vertices.shape[0]):
+            raise ValueError('bad triangles (out of range vertex index)')
+
+        self._vertices = vertices
+        self._triangles = triangles
+        self._medium = medium
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @property
+    def triangles(self):
+        return self._triangles
+
+    @classmethod
+    def load(cls, path, medium=None):
+        '''Load a mesh from a STL (ASCII or binary) or OBJ file
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.stl':
+            vertices, triangles = cls._load_stl(path)
+        elif ext == '.obj':
+            vertices, triangles = cls._load_obj(path)
+        else:
+            raise ValueError(f"bad mesh format ('{ext}')")
+
+        return cls(vertices, triangles, medium)
+
+    @staticmethod
+    def _load_stl(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # Binary files are identified by their size, since some exporters
+        # write a 'solid' header anyway
+        if len(data) >= 84:
+            n = int.from_bytes(data[80:84], 'little')
+        else:
+            n = -1
+        if len(data) == 84 + 50 * n:
+            dtype = numpy.dtype([('normal', '<f4', 3), ('vertices', '<f4', 9),
+                ('attribute', '<u2')])
+            records = numpy.frombuffer(data, dtype, n, 84)
+            corners = records['vertices'].reshape(-1, 3)
+        else:
+            corners = []
+            for line in data.decode().splitlines():
+                words = line.split()
+                if words and (words[0] == 'vertex'):
+                    corners.append([float(v) for v in words[1:4]])
+            corners = numpy.array(corners)
+
+        # Merge duplicate vertices
+        vertices, triangles = numpy.unique(corners.astype('f8'),
+            axis=0, return_inverse=True)
+        return vertices, triangles.reshape(-1, 3)
+
+    @staticmethod
+    def _load_obj(path):
+        vertices, triangles = [], []
+        with open(path) as f:
+            for line in f:
+                words = line.split()
+                if not words:
+                    continue
+                elif words[0] == 'v':
+                    vertices.append([float(v) for v in words[1:4]])
+                elif words[0] == 'f':
+                    face = []
+                    for word in words[1:]:
+                        i = int(word.split('/')[0])
+                        face.append(i - 1 if i > 0 else len(vertices) + i)
+                    for i in range(1, len(face) - 1): # Triangles fan
+                        triangles.append((face[0], face[i], face[i + 1]))
+
+        return numpy.array(vertices), numpy.array(triangles)
+
+    def _new(self):
+        '''Spawn a new C geometry object
+        '''
+        if self._medium:
+            c_medium = ffi.cast('struct pumas_medium *', self._medium._c)
+        else:
+            c_medium = ffi.NULL
+        c = lib.pumas_geometry_mesh_create(c_medium,
+            self._vertices.shape[0],
+            ffi.cast('double *', self._vertices.ctypes.data),
+            self._triangles.shape[0],
+            ffi.cast('int *', self._triangles.ctypes.data))
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate geometry')
+
+        return ffi.cast('struct pumas_geometry *', c)
+
+
+class _VoxelMedium(Medium):
+    '''Medium with a density set by a voxel geometry
+    '''
+
+    def __init__(self, material):
+        super().__init__('struct pumas_medium *', material, material)
+        lib.pumas_medium_voxel_initialise(self._c, -1)
+
+
+class VoxelGeometry(Geometry):
+    '''Geometry of a regular grid of voxels
+
+       Voxels are defined by a 3D array of *indices*, referring to the
+       *materials* sequence, and by a 3D array of *densities*, in kg/m^3.
+       An index of -1 stands for void. Arrays of type int32 and float64, in C
+       order, are referenced without copy. Thus, their content can be
+       modified in place between transport calls.
+    '''
+
+    def __init__(self, materials, indices, densities, origin, size):
+        super().__init__()
+
+        indices = numpy.asarray(indices, dtype='i4', order='C')
+        densities = numpy.asarray(densities, dtype='f8', order='C')
+        if indices.ndim != 3:
+            raise ValueError('bad indices shape (expected a 3D array)')
+        if densities.shape != indices.shape:
+            raise ValueError(f"bad densities shape ('{densities.shape}' != "
+                             f"'{indices.shape}')")
+        if indices.size == 0:
+            raise ValueError('bad indices shape (expected a non empty array)')
+        if (numpy.max(indices) >= len(materials)) or                          \
+           (numpy.min(indices) < -1):
+            raise ValueError('bad indices (out of range material index)')
+
+        origin = numpy.asarray(origin, dtype='f8')
+        size = numpy.broadcast_to(numpy.asarray(size, dtype='f8'), (3,))
+        if origin.shape != (3,):
+            raise ValueError('bad origin shape (expected (3,))')
+        if numpy.any(size <= 0):
+            raise ValueError('bad voxel size (expected positive values)')
+
+        self._indices = indices
+        self._densities = densities
+        self._origin = origin.copy()
+        self._size = size.copy()
+        self._media = [_VoxelMedium(material) for material in materials]
+        self._c_media = ffi.new('struct pumas_medium *[]',
+            [ffi.cast('struct pumas_medium *', medium._c)
+             for medium in self._media])
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def densities(self):
+        return self._densities
+
+    @property
+    def materials(self):
+        return tuple(medium.material for medium in self._media)
+
+    @property
+    def origin(self):
+        return self._origin
+
+    @property
+    def size(self):
+        return self._size
+
+    def _new(self):
+        '''Spawn a new C geometry object
+        '''
+        c = lib.pumas_geometry_voxel_create(self._indices.shape,
+            ffi.cast('double *', self._origin.ctypes.data),
+            ffi.cast('double *', self._size.ctypes.data),
+            ffi.cast('int *', self._indices.ctypes.data),
+            ffi.cast('double *', self._densities.ctypes.data),
+            self._c_media)
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate geometry')
+
+        return ffi.cast('struct pumas_geometry *', c)
+
+
+class PlacedGeometry(Geometry):
+    '''Geometry placed in a local frame, e.g. a copy of a detector
+
+       The content geometry is expressed in the local frame, given as a
+       UnitaryTransformation w.r.t. the parent frame. If the content is frozen,
+       its compiled definition is shared by all placements. Note that gradient
+       media are evaluated in the parent frame.
+    '''
+
+    def __init__(self, geometry, frame):
+        super().__init__()
+        self._geometry = geometry
+        self._frame = frame
+        self._register(geometry)
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @frame.setter
+    def frame(self, v):
+        self._check_frozen()
+        self._frame = v
+        self._invalidate()
+
+    @property
+    def geometry(self):
+        return self._geometry
+
+    def _iter_media(self):
+        yield from self._geometry._iter_media()
+        yield from super()._iter_media()
+
+    def _new(self):
+        '''Spawn a new C geometry object
+        '''
+        content = self._geometry._frozen
+        owned = content is None
+        if owned:
+            content = self._geometry._build()
+        c = lib.pumas_geometry_placement_create(content, owned,
+            self._frame._c)
+        if c == ffi.NULL:
+            if owned:
+                lib.pumas_geometry_tree_destroy(content)
+            raise MemoryError('could not allocate geometry')
+
+        return ffi.cast('struct pumas_geometry *', c)
+
+
+def _check_earth():
+    '''Check that the library was built with Earth geometry support
+    '''
+    if not hasattr(lib, 'pumas_geometry_earth_create'):
+        raise RuntimeError('missing Earth geometry support (rebuild with '
+                           'PUMAS_USE_EARTH_GEOMETRY=1)')
+
+
+class Topography:
+    '''Topography data, e.g. from a Digital Elevation Model (DEM)
+
+       If path is a folder, it is loaded as a stack of tiles. Tiles are decoded
+       on demand and the `cache_size` most recently used ones are kept in
+       memory. This cache is shared by all contexts. Otherwise, path is loaded
+       as a single map.
+    '''
+
+    def __init__(self, path, cache_size=None):
+        _check_earth()
+        if cache_size is None:
+            cache_size = 16
+        elif cache_size <= 0:
+            raise ValueError(f"bad cache size ('{cache_size}')")
+
+        c = ffi.new('struct pumas_earth_topography *[1]')
+        pcall(lib.pumas_earth_topography_create, c, os.fsencode(path),
+            cache_size)
+        weakref.finalize(self, lib.pumas_earth_topography_destroy, c)
+        self._c = c[0]
+        self._path = os.fspath(path)
+        self._cache_size = cache_size
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    @property
+    def path(self):
+        return self._path
+
+
+class _MagnetSnapshot:
+    '''Wrapper for a geomagnetic model snapshot at a given date
+    '''
+
+    def __init__(self, path, date):
+        c = ffi.new('struct gull_snapshot *[1]')
+        pcall(lib.pumas_earth_magnet_create, c, os.fsencode(path), date.day,
+            date.month, date.year)
+        weakref.finalize(self, lib.pumas_earth_magnet_destroy, c)
+        self._c = c[0]
+
+    def field(self, geodetic, grid=None):
+        '''Get the field, in ECEF frame, at geodetic position(s)
+        '''
+        geodetic = numpy.require(geodetic, dtype='f8', requirements='C')
+        magnet = numpy.empty(geodetic.shape)
+        n = geodetic.size // 3
+        pcall(lib.pumas_earth_magnet_field_v, self._c if grid is None else
+            ffi.NULL, ffi.NULL if grid is None else grid._c, n,
+            ffi.cast('double *', geodetic.ctypes.data),
+            ffi.cast('double *', magnet.ctypes.data))
+        return magnet
+
+
+class MagnetGrid:
+    '''Geomagnetic field tabulated over a regular geodetic grid
+
+       The field is given in ECEF frame, in T, as an array of shape
+       (n_latitude, n_longitude, n_altitude, 3). Nodes span the latitude and
+       longitude ranges, in deg, and the altitude range, in m. The field is
+       trilinearly interpolated between nodes. Outside of the grid, the
+       closest boundary value is used.
+    '''
+
+    error = None
+    '''Maximum relative interpolation error, w.r.t. the geomagnetic model
+    '''
+
+    def __init__(self, field, latitude, longitude, altitude, error=None):
+        _check_earth()
+        field = numpy.require(field, dtype='f8', requirements='C')
+        if (field.ndim != 4) or (field.shape[3] != 3):
+            raise ValueError('bad field shape (expected (n_latitude, '
+                             'n_longitude, n_altitude, 3))')
+
+        c = ffi.new('struct pumas_earth_magnet_grid *')
+        for i, (name, v) in enumerate((('latitude', latitude),
+            ('longitude', longitude), ('altitude', altitude))):
+            v = tuple(float(vi) for vi in v)
+            if (len(v) != 2) or ((field.shape[i] > 1) and (v[0] == v[1])):
+                raise ValueError(f"bad {name} range ('{v}')")
+            setattr(c, name, v)
+            c.shape[i] = field.shape[i]
+        c.data = ffi.cast('double *', field.ctypes.data)
+
+        self._c = c
+        self._field = field
+        self.error = error
+
+    @classmethod
+    def compute(cls, model, latitude, longitude, altitude, shape, date=None,
+            tolerance=None):
+        '''Tabulate the field of a geomagnetic model over a grid
+
+           The interpolation error is estimated at the centers of grid cells.
+           If a tolerance is given, a ValueError is raised when the maximum
+           relative error exceeds it.
+        '''
+        _check_earth()
+        if date is None:
+            date = datetime.date.today()
+        snapshot = _MagnetSnapshot(model, date)
+
+        shape = tuple(shape)
+        if (len(shape) != 3) or any(n < 1 for n in shape):
+            raise ValueError(f"bad shape ('{shape}')")
+        field = numpy.empty(shape + (3,))
+        grid = cls(field, latitude, longitude, altitude)
+        pcall(lib.pumas_earth_magnet_grid_compute, snapshot._c, grid._c,
+            ffi.cast('double *', field.ctypes.data))
+
+        # Estimate the interpolation error
+        nodes = []
+        for n, (x0, x1) in zip(shape, (latitude, longitude, altitude)):
+            if n > 1:
+                h = 0.5 * (x1 - x0) / (n - 1)
+                nodes.append(numpy.linspace(x0 + h, x1 - h, n - 1))
+            else:
+                nodes.append(numpy.array((x0,), dtype='f8'))
+        geodetic = numpy.stack(numpy.meshgrid(*nodes, indexing='ij'), axis=-1)
+        b0 = snapshot.field(geodetic)
+        b1 = snapshot.field(geodetic, grid)
+        norm = numpy.linalg.norm(b0, axis=-1)
+        grid.error = float(numpy.max(numpy.linalg.norm(b1 - b0, axis=-1) /
+            numpy.where(norm > 0, norm, 1)))
+
+        if (tolerance is not None) and (grid.error > tolerance):
+            raise ValueError(f'interpolation error exceeds tolerance '
+                             f'({grid.error:.3g} > {tolerance:.3g})')
+
+        return grid
+
+    @classmethod
+    def load(cls, path):
+        '''Load a grid from a .npz file
+        '''
+        with numpy.load(path) as data:
+            error = float(data['error']) if data['error'].size else None
+            return cls(data['field'], data['latitude'], data['longitude'],
+                data['altitude'], error)
+
+    def dump(self, path):
+        '''Dump the grid to a .npz file
+        '''
+        numpy.savez(path, field=self._field, latitude=self.latitude,
+            longitude=self.longitude, altitude=self.altitude,
+            error=numpy.array(() if self.error is None else self.error))
+
+    @property
+    def altitude(self):
+        return tuple(self._c.altitude)
+
+    @property
+    def field(self):
+        return self._field
+
+    @property
+    def latitude(self):
+        return tuple(self._c.latitude)
+
+    @property
+    def longitude(self):
+        return tuple(self._c.longitude)
+
+    @property
+    def shape(self):
+        return self._field.shape[:3]
+
+
+class EarthGeometry(Geometry):
+    '''Earth geometry with layered media
+
+       Layers are given from bottom to top, as (medium, surface) or (medium,
+       surface, offset) tuples. The top surface of a layer is either a constant
+       altitude, in m, or topography data, i.e. a Topography object or a path,
+       shifted by offset. Optionally, a geoid map and a geomagnetic field can be
+       provided. The field is either a MagnetGrid or a path to a geomagnetic
+       model, evaluated at the given date (defaulting to today).
+    '''
+
+    _mutable = True
+
+    def __init__(self, *layers, geoid=None, magnet=None, date=None):
+        _check_earth()
+        super().__init__()
+        if not layers:
+            raise ValueError('missing layer(s)')
+
+        self._layers = []
+        for layer in layers:
+            if len(layer) == 2:
+                (medium, surface), offset = layer, 0
+            elif len(layer) == 3:
+                medium, surface, offset = layer
+            else:
+                raise ValueError('bad layer (expected (medium, surface) or '
+                                 '(medium, surface, offset))')
+
+            if isinstance(surface, numbers.Real):
+                surface, offset = None, surface + offset
+            elif not isinstance(surface, Topography):
+                surface = Topography(surface)
+            self._layers.append((medium, surface, float(offset)))
+
+        self._media = [medium for medium, _, _ in self._layers]
+        self._c_media = ffi.new('struct pumas_medium *[]',
+            [ffi.NULL if medium is None else
+             ffi.cast('struct pumas_medium *', medium._c)
+             for medium in self._media])
+        self._c_topography = ffi.new('struct pumas_earth_topography *[]',
+            [ffi.NULL if surface is None else surface._c
+             for _, surface, _ in self._layers])
+        self._offsets = numpy.array([offset for _, _, offset in self._layers],
+            dtype='f8')
+
+        if (geoid is not None) and not isinstance(geoid, Topography):
+            geoid = Topography(geoid)
+        if (geoid is not None) and (geoid._c.map == ffi.NULL):
+            raise ValueError('bad geoid (expected a single map)')
+        self._geoid = geoid
+
+        self._snapshot = None
+        if isinstance(magnet, MagnetGrid):
+            self._magnet = magnet
+        elif magnet is not None:
+            if date is None:
+                date = datetime.date.today()
+            self._snapshot = _MagnetSnapshot(magnet, date)
+            self._magnet = (os.fspath(magnet), date)
         else:
-            m = ffi.NULL
-        mother = lib.pumas_geometry_polyhedron_create(m, n_faces)
-        refs.append(mother)
-        if medium is not None:
-            refs.append(medium)
-
-        for i in range(n_faces):
-            d = data[i]
-            mother.faces[i].origin[0] = d[0]
-            mother.faces[i].origin[1] = d[1]
-            mother.faces[i].origin[2] = d[2]
-            mother.faces[i].normal[0] = d[3]
-            mother.faces[i].normal[1] = d[4]
-            mother.faces[i].normal[2] = d[5]
-
-        mother = ffi.cast('struct pumas_geometry *', mother)
-
-        if daughters is not None:
-            last_daughter = None
-            for i, daughter_args in enumerate(daughters):
-                daughter = build_polyhedrons(daughter_args, frame, refs,
-                    depth + 1, i)
-
-                if i == 0:
-                    mother.daughters = daughter
-                else:
-                    last_daughter.next = daughter
-                daughter.mother = mother
-                last_daughter = daughter
-
-        return mother
+            self._magnet = None
+
+    @property
+    def geoid(self):
+        return self._geoid
+
+    @property
+    def layers(self):
+        return tuple(self._layers)
+
+    @property
+    def magnet(self):
+        return self._magnet
+
+    def _new(self):
+        '''Spawn a new C geometry object
+        '''
+        geoid = ffi.NULL if self._geoid is None else self._geoid._c
+        snapshot = ffi.NULL if self._snapshot is None else self._snapshot._c
+        grid = self._magnet._c if isinstance(self._magnet, MagnetGrid) else \
+            ffi.NULL
+        c = lib.pumas_geometry_earth_create(len(self._layers), self._c_media,
+            self._c_topography, ffi.cast('double *', self._offsets.ctypes.data),
+            geoid, snapshot, grid)
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate geometry')
+
+        return ffi.cast('struct pumas_geometry *', c)
@@ -1,5 +1,6 @@
 from .libpumas import ffi, lib
 
+import numpy
 import weakref
 
 
@@ -11,55 +12,72 @@ class Medium:
     '''Reference to the last physics object in use
     '''
 
-    _media = []
-    '''Weak-references to existing media instances
+    _indices = weakref.WeakKeyDictionary()
+    '''Per physics cache of material indices, by name
+    '''
+
+    _media = weakref.WeakSet()
+    '''Existing media instances
+    '''
+
+    _dirty = weakref.WeakSet()
+    '''Media with a material index not set for the last physics
     '''
 
     def __init__ (self, ctype, material, name):
         self._c = ffi.new(ctype)
         self.material = material
         self.name = name
-        self._media.append(weakref.ref(self))
-        Medium._last_physics = None
+        self._media.add(self)
+
+    @property
+    def material(self):
+        return self._material
+
+    @material.setter
+    def material(self, v):
+        self._material = v
+        Medium._dirty.add(self)
 
     @classmethod
     def _update(cls, physics):
         '''Update the material indices for the given physics
         '''
-        if cls._last_physics is physics:
+        if Medium._last_physics is not physics:
+            Medium._dirty = weakref.WeakSet(Medium._media)
+            Medium._last_physics = physics
+        elif not Medium._dirty:
             return None
 
-        dead, missing = [], None
-        index = ffi.new('int *')
-        for ref in cls._media:
-            medium = ref()
-            if medium is None:
-                dead.append(ref)
-                continue
+        try:
+            indices = Medium._indices[physics]
+        except KeyError:
+            indices = Medium._indices[physics] = {}
 
+        index = ffi.new('int *')
+        for medium in tuple(Medium._dirty):
             material = medium.material
             if material and (material != 'Transparent'):
                 try:
-                    material = material.encode()
-                except AttributeError:
-                    pass
+                    i = indices[material]
+                except KeyError:
+                    try:
+                        name = material.encode()
+                    except AttributeError:
+                        name = material
 
-                rc = lib.pumas_physics_material_index(
-                    physics._c, material, index)
-                if rc != lib.PUMAS_RETURN_SUCCESS:
-                    missing = medium
-                    break
-                else:
-                    m = ffi.cast('struct pumas_medium *', medium._c)
-                    m.material = index[0]
+                    rc = lib.pumas_physics_material_index(
+                        physics._c, name, index)
+                    if rc != lib.PUMAS_RETURN_SUCCESS:
+                        return medium
+                    i = indices[material] = index[0]
 
-        cls._last_physics = physics
+                m = ffi.cast('struct pumas_medium *', medium._c)
+                m.material = i
 
-        if dead:
-            for ref in dead:
-                cls._media.remove(ref)
+            Medium._dirty.discard(medium)
 
-        return missing
+        return None
 
 
 class UniformMedium(Medium):
@@ -75,3 +93,86 @@ class UniformMedium(Medium):
 
         super().__init__('struct pumas_medium_uniform *', material, name)
         lib.pumas_medium_uniform_initialise(self._c, -1, density, magnet)
+
+
+class GradientMedium(Medium):
+    '''Medium with a density gradient along an axis
+
+       The density varies as `rho0 * (1 + (z - z0) / length)`, for a linear
+       profile, or as `rho0 * exp((z - z0) / length)`, for an exponential one.
+       The coordinate z is the projection of the position onto the axis, or
+       the altitude if axis is 'altitude' (requires Earth geometry support).
+    '''
+
+    _TYPE_IDX = {
+        'exponential': lib.PUMAS_MEDIUM_GRADIENT_EXPONENTIAL,
+        'linear': lib.PUMAS_MEDIUM_GRADIENT_LINEAR
+    }
+
+    def __init__(self, material, density, length, type=None, axis=None,
+            z0=None, magnet=None, name=None):
+        if type is None:
+            type = 'exponential'
+        try:
+            type_ = self._TYPE_IDX[type]
+        except KeyError:
+            raise ValueError(f"bad gradient type ('{type}')")
+
+        if (length == 0) or not numpy.isfinite(length):
+            raise ValueError(f"bad gradient length ('{length}')")
+
+        if axis is None:
+            axis = (0, 0, 1)
+
+        if z0 is None:
+            z0 = 0
+
+        if magnet is None:
+            magnet = ffi.NULL
+
+        super().__init__('struct pumas_medium_gradient *', material, name)
+        lib.pumas_medium_gradient_initialise(self._c, -1, type_, length, z0,
+            density, magnet)
+
+        if isinstance(axis, str):
+            if axis != 'altitude':
+                raise ValueError(f"bad axis ('{axis}')")
+            try:
+                project = ffi.addressof(lib,
+                    'pumas_medium_gradient_project_altitude')
+            except AttributeError:
+                raise ValueError('altitude projection requires Earth '
+                                 'geometry support')
+            self._c.gradient.project = project
+        else:
+            axis = numpy.asarray(axis, dtype='f8')
+            norm = numpy.linalg.norm(axis) if axis.shape == (3,) else 0
+            if norm == 0:
+                raise ValueError(f"bad axis ('{axis}')")
+            self._c.gradient.axis = (axis / norm).tolist()
+
+    @property
+    def axis(self):
+        if self._c.gradient.project != ffi.NULL:
+            return 'altitude'
+        else:
+            return numpy.array(list(self._c.gradient.axis))
+
+    @property
+    def density(self):
+        return self._c.gradient.rho0
+
+    @property
+    def length(self):
+        return getattr(self._c.gradient, 'lambda')
+
+    @property
+    def type(self):
+        if self._c.gradient.type == lib.PUMAS_MEDIUM_GRADIENT_LINEAR:
+            return 'linear'
+        else:
+            return 'exponential'
+
+    @property
+    def z0(self):
+        return self._c.gradient.z0
@@ -162,6 +162,9 @@ class PhysicsSettings:
         except AttributeError:
             energies = None
 
+        def get_model(value):
+            return None if value == ffi.NULL else ffi.string(value).decode()
+
         c = self._c[0]
         copy = self.__class__(
             cutoff = c.cutoff,
@@ -169,9 +172,9 @@ class PhysicsSettings:
             energies = energies,
             update = c.update,
             dry = c.dry,
-            bremsstrahlung = c.bremsstrahlung,
-            pair_production = c.pair_production,
-            photonuclear = c.photonuclear
+            bremsstrahlung = get_model(c.bremsstrahlung),
+            pair_production = get_model(c.pair_production),
+            photonuclear = get_model(c.photonuclear)
         )
 
         if kwargs:
@@ -205,9 +208,18 @@ class PhysicsSettings:
             if value is None:
                 return
 
-            if isinstance(value, RadiativeProcess):
-                value = bremsstrahlung.model
+            if isinstance(value, RadiativeProcess) or (
+                isinstance(value, type) and
+                issubclass(value, RadiativeProcess)):
+                value = value.model
+
+            try:
+                value = value.encode()
+            except AttributeError:
+                pass
 
+            value = ffi.new('char []', value)
+            setattr(self, f'_{process}', value) # Keep reference alive
             setattr(c, process, value)
 
         set_dcs('bremsstrahlung', bremsstrahlung)
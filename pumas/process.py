@@ -1,14 +1,19 @@
-from .core import pcall
+from .core import empty_array, pcall
 from .libpumas import ffi, lib
 
+from collections import OrderedDict
+import hashlib
+import importlib.machinery
+import importlib.util
 import numbers
 import numpy
+import os
 import sys
 
 __all__ = ('Bremsstrahlung', 'BremsstrahlungABB', 'BremsstrahlungKKP',
-    'BremsstrahlungSSR', 'Elastic', 'Electronic', 'PairProduction',
-    'PairProductionKKP', 'PairProductionSSR', 'Photonuclear',
-    'PhotonuclearBBKS', 'PhotonuclearBM', 'PhotonuclearDRSS',
+    'BremsstrahlungSSR', 'compile_dcs', 'Elastic', 'Electronic',
+    'PairProduction', 'PairProductionKKP', 'PairProductionSSR',
+    'Photonuclear', 'PhotonuclearBBKS', 'PhotonuclearBM', 'PhotonuclearDRSS',
     'RadiativeProcess')
 
 
@@ -36,6 +41,54 @@ def __getattr__(name):
     return cls
 
 
+_DEFAULT_CUTOFF = 5E-02
+'''Default relative cutoff between continuous and discrete energy losses
+'''
+
+
+class _LRUCache(OrderedDict):
+    '''Cache with a bounded size, evicting the least recently used entries
+    '''
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def get(self, key):
+        try:
+            value = self[key]
+        except KeyError:
+            return None
+        self.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+def _call_dcs(dcs, Z, A, mass, energy, q, out=None):
+    '''Call a C DCS, broadcasting over energies and energy transfers
+    '''
+    if (out is None) and isinstance(energy, numbers.Number) and \
+        isinstance(q, numbers.Number):
+        return dcs(Z, A, mass, energy, q)
+
+    energies, qs = numpy.broadcast_arrays(
+        numpy.asarray(energy, dtype='f8'), numpy.asarray(q, dtype='f8'))
+    energies = numpy.ascontiguousarray(energies)
+    qs = numpy.ascontiguousarray(qs)
+    values = empty_array(energies.shape, out)
+
+    lib.pumas_dcs_call_v(dcs, Z, A, mass, energies.size,
+        ffi.cast('double *', energies.ctypes.data),
+        ffi.cast('double *', qs.ctypes.data),
+        ffi.cast('double *', values.ctypes.data))
+    return values
+
+
 class Elastic:
     '''Elastic collisions with atoms
     '''
@@ -43,42 +96,39 @@ class Elastic:
     name = 'Elastic'
 
     @staticmethod
-    def dcs(Z, A, mass, energy, mu):
+    def dcs(Z, A, mass, energy, mu, out=None):
         '''DCS for elastic collisions
+
+           The energy and the scattering angle are broadcasted against each
+           other.
         '''
-        if isinstance(q, numbers.Number):
+        if (out is None) and isinstance(energy, numbers.Number) and \
+            isinstance(mu, numbers.Number):
             return lib.pumas_elastic_dcs(Z, A, mass, energy, mu)
         else:
-            qs = numpy.asarray(q, dtype='f8')
-            n = qs.size
-            values = numpy.empty(n, dtype='f8')
             dcs = ffi.addressof(lib, 'pumas_elastic_dcs')
-            lib.pumas_dcs_call_v(dcs, Z, A, mass, energy, n,
-                ffi.cast('double *', qs.ctypes.data),
-                ffi.cast('double *', values.ctypes.data))
-            return values
+            return _call_dcs(dcs, Z, A, mass, energy, mu, out)
 
     @classmethod
-    def transport_path(cls, Z, A, mass, energy):
+    def transport_path(cls, Z, A, mass, energy, out=None):
         '''First transport path for elastic collisions
         '''
-        return cls._path(1, Z, A, mass, energy)
+        return cls._path(1, Z, A, mass, energy, out)
 
     @classmethod
-    def free_path(cls, Z, A, mass, energy):
+    def free_path(cls, Z, A, mass, energy, out=None):
         '''Mean free path for elastic collisions
         '''
-        return cls._path(0, Z, A, mass, energy)
+        return cls._path(0, Z, A, mass, energy, out)
 
     @staticmethod
-    def _path(order, Z, A, mass, energy):
-        if isinstance(energy, numbers.Number):
+    def _path(order, Z, A, mass, energy, out=None):
+        if (out is None) and isinstance(energy, numbers.Number):
             return lib.pumas_elastic_length(order, Z, A, mass, energy)
         else:
-            energies = numpy.asarray(energy, dtype='f8')
-            n = energies.size
-            values = numpy.empty(n, dtype='f8')
-            lib.pumas_elastic_path_v(order, Z, A, mass, n,
+            energies = numpy.asarray(energy, dtype='f8', order='C')
+            values = empty_array(energies.shape, out)
+            lib.pumas_elastic_path_v(order, Z, A, mass, energies.size,
                 ffi.cast('double *', energies.ctypes.data),
                 ffi.cast('double *', values.ctypes.data))
             return values
@@ -91,28 +141,58 @@ class Electronic:
     name = 'Electronic'
 
     @staticmethod
-    def dcs(Z, I, mass, energy, q):
+    def dcs(Z, I, mass, energy, q, out=None):
         '''Effective DCS for close collisions
         '''
-        if isinstance(q, numbers.Number):
+        if (out is None) and isinstance(energy, numbers.Number) and \
+            isinstance(q, numbers.Number):
             return lib.pumas_electronic_dcs(Z, I, mass, energy, q)
         else:
-            qs = numpy.asarray(q, dtype='f8')
-            n = qs.size
-            values = numpy.empty(n, dtype='f8')
             dcs = ffi.addressof(lib, 'pumas_electronic_dcs')
-            lib.pumas_dcs_call_v(dcs, Z, I, mass, energy, n,
-                ffi.cast('double *', qs.ctypes.data),
-                ffi.cast('double *', values.ctypes.data))
-            return values
+            return _call_dcs(dcs, Z, I, mass, energy, q, out)
 
-    @staticmethod
-    def density_effect():
-        pass
+    @classmethod
+    def density_effect(cls, Z, A, w, I, density, mass, energy, out=None):
+        '''Density effect for electronic collisions in a material
+
+           The material is defined by the charge numbers, *Z*, the mass
+           numbers, *A*, and the mass fractions, *w*, of its atomic elements.
+        '''
+        return cls._material_property(
+            lib.pumas_electronic_density_effect_v, Z, A, w, I, density, mass,
+            energy, out)
+
+    @classmethod
+    def stopping_power(cls, Z, A, w, I, density, mass, energy, out=None):
+        '''Electronic stopping power per unit mass of a material
+
+           The material is defined by the charge numbers, *Z*, the mass
+           numbers, *A*, and the mass fractions, *w*, of its atomic elements.
+        '''
+        return cls._material_property(
+            lib.pumas_electronic_stopping_power_v, Z, A, w, I, density, mass,
+            energy, out)
 
     @staticmethod
-    def stopping_power():
-        pass
+    def _material_property(function, Z, A, w, I, density, mass, energy, out):
+        elements = [numpy.atleast_1d(numpy.asarray(v, dtype='f8', order='C'))
+            for v in (Z, A, w)]
+        n_elements = elements[0].size
+        for v in elements[1:]:
+            if v.size != n_elements:
+                raise ValueError('inconsistent elements data')
+
+        energies = numpy.asarray(energy, dtype='f8', order='C')
+        values = empty_array(energies.shape, out)
+        function(n_elements, *[ffi.cast('double *', v.ctypes.data)
+            for v in elements], I, density, mass, energies.size,
+            ffi.cast('double *', energies.ctypes.data),
+            ffi.cast('double *', values.ctypes.data))
+
+        if (out is None) and isinstance(energy, numbers.Number):
+            return float(values)
+        else:
+            return values
 
 
 class RadiativeProcess:
@@ -121,13 +201,54 @@ class RadiativeProcess:
 
     _dcs = None
 
+    _integrals = _LRUCache(128)
+    '''Memoised DCS integrals
+    '''
+
+    _samplers = _LRUCache(4096)
+    '''Tabulated CDFs for sampling energy transfers, per energy node
+    '''
+
+    _SAMPLER_NODES_PER_DECADE = 10
+    _SAMPLER_CDF_SIZE = 65
+
+    @classmethod
+    def cross_section(cls, Z, A, mass, energy, cutoff=None, out=None):
+        '''Cross-section for energy transfers above the relative cutoff
+        '''
+        if cutoff is None:
+            cutoff = _DEFAULT_CUTOFF
+        return cls._integrate(0, cutoff, 1, Z, A, mass, energy, out)
+
+    @classmethod
+    def energy_loss(cls, Z, A, mass, energy, cutoff=None, out=None):
+        '''First moment of the energy transfer, below the relative cutoff
+
+           The energy loss per unit mass, b(E) E, is obtained by multiplying
+           the result with N_A / A. By default the whole kinematic range is
+           integrated.
+        '''
+        if cutoff is None:
+            cutoff = 1
+        return cls._integrate(1, 0, cutoff, Z, A, mass, energy, out)
+
     @classmethod
-    def dcs(cls, Z, A, mass, energy, q):
+    def energy_straggling(cls, Z, A, mass, energy, cutoff=None, out=None):
+        '''Second moment of the energy transfer, below the relative cutoff
+        '''
+        if cutoff is None:
+            cutoff = 1
+        return cls._integrate(2, 0, cutoff, Z, A, mass, energy, out)
+
+    @classmethod
+    def dcs(cls, Z, A, mass, energy, q, out=None):
         '''Call the default DCS
+
+           The energy and the energy transfer are broadcasted against each
+           other, e.g. `energy[:,None]` and `q[None,:]` evaluate the DCS over
+           a full grid in a single C call.
         '''
-        if cls._dcs is None:
-            cls._dcs = cls._wrap_dcs()
-        return cls._dcs(Z, A, mass, energy, q)
+        return _call_dcs(cls._get_dcs(), Z, A, mass, energy, q, out)
 
     @classmethod
     def range(cls, Z, mass, energy):
@@ -138,31 +259,103 @@ class RadiativeProcess:
         return (float(r[0]), float(r[1]))
 
     @classmethod
-    def _wrap_dcs(cls):
-        try:
-            model_b = cls.model.encode()
-        except AttributeError:
-            model_b = cls.model
-
-        dcs = ffi.new('pumas_dcs_t *[1]')
-        pcall(lib.pumas_dcs_get, cls.process, model_b, dcs)
-        dcs = dcs[0]
-
-        def dcs_wrapper(Z, A, mass, energy, q):
-            '''Wrapper for calling a C-defined DCS
-            '''
-            if isinstance(q, numbers.Number):
-                return dcs(Z, A, mass, energy, q)
+    def sample(cls, Z, A, mass, energies, n=None, prng=None, cutoff=None):
+        '''Sample energy transfers above the relative cutoff
+
+           If *n* is given, *n* values are sampled per energy, along a trailing
+           axis. Otherwise, a single value is sampled per energy. The random
+           stream, *prng*, must return an array of *n* uniform numbers when
+           called as prng(n).
+        '''
+        if prng is None:
+            prng = numpy.random.rand
+        if cutoff is None:
+            cutoff = _DEFAULT_CUTOFF
+
+        energies_ = numpy.asarray(energies, dtype='f8')
+        if numpy.any(energies_ <= 0):
+            raise ValueError('bad energy (expected strictly positive values)')
+
+        # Get the CDFs tabulated at energy nodes
+        npd = cls._SAMPLER_NODES_PER_DECADE
+        k0 = int(numpy.floor(numpy.log10(numpy.min(energies_)) * npd))
+        k1 = int(numpy.ceil(numpy.log10(numpy.max(energies_)) * npd))
+        if k1 == k0:
+            k1 += 1
+        nodes = 10**(numpy.arange(k0, k1 + 1) / npd)
+        cdfs = numpy.empty((nodes.size, cls._SAMPLER_CDF_SIZE))
+        for i, k in enumerate(range(k0, k1 + 1)):
+            key = (cls.process, cls.model, Z, A, mass, cutoff, k)
+            cdf = cls._samplers.get(key)
+            if cdf is None:
+                cdf = cdfs[i]
+                pcall(lib.pumas_dcs_sampler_tabulate, cls._get_dcs(),
+                    cls.process, Z, A, mass, nodes[i], cutoff, cdf.size,
+                    ffi.cast('double *', cdf.ctypes.data))
+                cls._samplers.put(key, cdf.copy())
             else:
-                qs = numpy.asarray(q, dtype='f8')
-                n = qs.size
-                values = numpy.empty(n, dtype='f8')
-                lib.pumas_dcs_call_v(dcs, Z, A, mass, energy, n,
-                    ffi.cast('double *', qs.ctypes.data),
-                    ffi.cast('double *', values.ctypes.data))
-                return values
+                cdfs[i] = cdf
+
+        # Sample the energy transfers
+        if n is None:
+            shape = energies_.shape
+            e = numpy.ascontiguousarray(energies_.ravel())
+        else:
+            shape = energies_.shape + (n,)
+            e = numpy.repeat(energies_.ravel(), n)
+        u = numpy.ascontiguousarray(prng(2 * e.size), dtype='f8')
+        values = numpy.empty(e.size)
+        pcall(lib.pumas_dcs_sample_v, cls.process, Z, mass, cutoff,
+            nodes.size, ffi.cast('double *', nodes.ctypes.data), cdfs.shape[1],
+            ffi.cast('double *', cdfs.ctypes.data), e.size,
+            ffi.cast('double *', e.ctypes.data),
+            ffi.cast('double *', u.ctypes.data),
+            ffi.cast('double *', values.ctypes.data))
+
+        if (n is None) and isinstance(energies, numbers.Number):
+            return float(values[0])
+        else:
+            return values.reshape(shape)
 
-        return dcs_wrapper
+    @classmethod
+    def _integrate(cls, order, x0, x1, Z, A, mass, energy, out):
+        '''Integrate q^order times the DCS over [x0 * energy, x1 * energy]
+        '''
+        energies = numpy.asarray(energy, dtype='f8', order='C')
+        values = empty_array(energies.shape, out)
+
+        key = (cls.process, cls.model, order, x0, x1, Z, A, mass,
+            energies.shape, energies.tobytes())
+        cached = cls._integrals.get(key)
+        if cached is not None:
+            values[...] = cached
+        else:
+            pcall(lib.pumas_dcs_integrate_v, cls._get_dcs(), cls.process, Z,
+                A, mass, order, x0, x1, energies.size,
+                ffi.cast('double *', energies.ctypes.data),
+                ffi.cast('double *', values.ctypes.data))
+            cls._integrals.put(key, values.copy())
+
+        if (out is None) and isinstance(energy, numbers.Number):
+            return float(values)
+        else:
+            return values
+
+    @classmethod
+    def _get_dcs(cls):
+        '''Get the C-defined DCS of the model
+        '''
+        if cls._dcs is None:
+            try:
+                model_b = cls.model.encode()
+            except AttributeError:
+                model_b = cls.model
+
+            dcs = ffi.new('pumas_dcs_t *[1]')
+            pcall(lib.pumas_dcs_get, cls.process, model_b, dcs)
+            cls._dcs = dcs[0]
+
+        return cls._dcs
 
 
 class BremsstrahlungABB(RadiativeProcess):
@@ -257,3 +450,101 @@ class PhotonuclearDRSS(RadiativeProcess):
     name = 'PhotonuclearDRSS'
     process = lib.PUMAS_PROCESS_PHOTONUCLEAR
     model = 'DRSS'
+
+
+_compiled = {}
+'''Registry of compiled DCS models
+'''
+
+
+def compile_dcs(process, model, source, cache=None):
+    '''Compile a C-defined DCS and register it as a new radiative model
+
+       The source is the body of a C function with prototype `double dcs(double
+       Z, double A, double mass, double energy, double q)`, where <math.h> is
+       included. The compiled extension is cached under the *cache* directory,
+       keyed by the hash of the source. The returned RadiativeProcess subclass
+       can be given to PhysicsSettings, e.g. as `bremsstrahlung=cls`.
+    '''
+    processes = {
+        'bremsstrahlung': ('Bremsstrahlung', lib.PUMAS_PROCESS_BREMSSTRAHLUNG),
+        'pair_production': ('PairProduction',
+            lib.PUMAS_PROCESS_PAIR_PRODUCTION),
+        'photonuclear': ('Photonuclear', lib.PUMAS_PROCESS_PHOTONUCLEAR)
+    }
+    try:
+        prefix, index = processes[process]
+    except KeyError:
+        raise ValueError(f"bad process ('{process}')")
+
+    source = os.linesep.join((
+        '#include <math.h>',
+        '',
+        'double dcs(double Z, double A, double mass, double energy, double q)',
+        '{',
+        source,
+        '}',
+        ''))
+    digest = hashlib.sha256(source.encode()).hexdigest()
+
+    try:
+        registered_digest, cls = _compiled[(process, model)]
+    except KeyError:
+        pass
+    else:
+        if registered_digest == digest:
+            return cls
+        else:
+            raise ValueError(f"model '{model}' is already registered")
+
+    # Load the compiled DCS, or build it
+    if cache is None:
+        cache = os.getenv('PUMAS_CACHE', os.path.join(
+            os.path.expanduser('~'), '.cache', 'pumas'))
+    os.makedirs(cache, exist_ok=True)
+
+    module_name = f'_dcs_{digest[:16]}'
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        path = os.path.join(cache, module_name + suffix)
+        if os.path.exists(path):
+            break
+    else:
+        from cffi import FFI
+
+        builder = FFI()
+        builder.cdef('double dcs(double, double, double, double, double);')
+        builder.set_source(module_name, source,
+            extra_compile_args=['-O3', '-std=c99'], libraries=['m'])
+        path = builder.compile(tmpdir=cache)
+
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    address = module.ffi.cast('uintptr_t',
+        module.ffi.addressof(module.lib, 'dcs'))
+    dcs = ffi.cast('pumas_dcs_t *', int(address))
+
+    # Register the DCS to PUMAS
+    try:
+        model_b = model.encode()
+    except AttributeError:
+        model_b = model
+    pcall(lib.pumas_dcs_register, index, model_b, dcs)
+
+    # Wrap the model as a RadiativeProcess
+    name = prefix + model
+    cls = type(name, (RadiativeProcess,), {
+        '__doc__': f'''User-defined {model} model of the {prefix} process
+    ''',
+        '__module__': __name__,
+        'name': name,
+        'process': index,
+        'model': model,
+        '_dcs': dcs,
+        '_module': module
+    })
+
+    _compiled[(process, model)] = (digest, cls)
+
+    return cls
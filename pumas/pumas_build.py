@@ -8,15 +8,23 @@ from tempfile import TemporaryDirectory
 PUMAS_C = os.path.join('pumas', 'c')
 SOURCES = (
     'pumas.c',
+    os.path.join('pumas', 'coordinates.c'),
     os.path.join('pumas', 'extensions.c'),
     os.path.join('pumas', 'vectorization.c')
 )
 HEADERS = (
     'pumas.h',
+    os.path.join('pumas', 'coordinates.h'),
     os.path.join('pumas', 'extensions.h'),
     os.path.join('pumas', 'vectorization.h')
 )
 
+# Optional Earth geometry, using the TURTLE and GULL libraries
+USE_EARTH_GEOMETRY = bool(os.getenv('PUMAS_USE_EARTH_GEOMETRY'))
+if USE_EARTH_GEOMETRY:
+    SOURCES += (os.path.join('pumas', 'earth.c'),)
+    HEADERS += (os.path.join('pumas', 'earth.h'),)
+
 
 def load_headers(*paths):
     '''
@@ -29,7 +37,16 @@ def load_headers(*paths):
 
         header_content = header_content.replace('#include <stdio.h>',
             'struct FILE;')
+        header_content = header_content.replace('#include <stddef.h>', '')
         header_content = header_content.replace('#include "pumas.h"', '')
+        header_content = header_content.replace(
+            '#include "pumas/coordinates.h"', '')
+        header_content = header_content.replace(
+            '#include "pumas/extensions.h"', '')
+        header_content = header_content.replace('#include "gull.h"',
+            'struct gull_snapshot;')
+        header_content = header_content.replace('#include "turtle.h"',
+            'struct turtle_map; struct turtle_stack; struct turtle_stepper;')
 
         cpp = Preprocessor()
         cpp.parse(header_content)
@@ -52,8 +69,15 @@ def load_sources(*paths):
 
 
 ffi = FFI()
-ffi.set_source('pumas.libpumas', load_sources(*SOURCES),
-    extra_compile_args=['-std=c99', f'-I{PUMAS_C}/include'])
+if USE_EARTH_GEOMETRY:
+    ffi.set_source('pumas.libpumas', load_sources(*SOURCES),
+        define_macros=[('PUMAS_USE_EARTH_GEOMETRY', None)],
+        extra_compile_args=['-std=c99', '-pthread', f'-I{PUMAS_C}/include'],
+        extra_link_args=['-pthread'], libraries=['turtle', 'gull'])
+else:
+    ffi.set_source('pumas.libpumas', load_sources(*SOURCES),
+        extra_compile_args=['-std=c99', '-pthread', f'-I{PUMAS_C}/include'],
+        extra_link_args=['-pthread'])
 ffi.cdef(load_headers(*HEADERS))
 
 
@@ -0,0 +1,119 @@
+from .libpumas import ffi, lib
+
+import numpy
+import weakref
+
+__all__ = ('Recorder',)
+
+
+class Recorder:
+    '''Recorder of Monte Carlo steps
+    '''
+
+    _dtype = numpy.dtype([('event', 'i8'), ('position', 'f8', 3),
+        ('direction', 'f8', 3), ('energy', 'f8'), ('step', 'f8'),
+        ('medium', 'i4')], align=True)
+    '''NumPy structured array data type of records
+    '''
+
+    _c_dtype = numpy.dtype([('event', f'i{ffi.sizeof("long")}'),
+        ('position', 'f8', 3), ('direction', 'f8', 3), ('energy', 'f8'),
+        ('step', 'f8'), ('medium', numpy.uintp)], align=True)
+
+    def __init__(self, period=None, max_steps=None):
+        if period is None:
+            period = 1
+        elif period < 1:
+            raise ValueError(f"bad period ('{period}')")
+        if max_steps is None:
+            max_steps = 0
+        elif max_steps < 1:
+            raise ValueError(f"bad max_steps ('{max_steps}')")
+
+        c = lib.pumas_recorder_create(period, max_steps)
+        if c == ffi.NULL:
+            raise MemoryError('could not allocate recorder')
+        self._c = ffi.gc(c, lib.pumas_recorder_destroy)
+
+        # Media that might be referenced by records, indexed by address
+        self._media = []
+        self._index = {}
+        self._registered = None
+
+    def __len__(self):
+        return self._c.size
+
+    def clear(self):
+        '''Clear all records
+        '''
+        lib.pumas_recorder_clear(self._c)
+        self._media.clear()
+        self._index.clear()
+        self._registered = None
+
+    @property
+    def max_steps(self):
+        return self._c.max_steps if self._c.max_steps > 0 else None
+
+    @max_steps.setter
+    def max_steps(self, v):
+        if v is None:
+            v = 0
+        elif v < 1:
+            raise ValueError(f"bad max_steps ('{v}')")
+        self._c.max_steps = v
+
+    @property
+    def media(self):
+        '''Media referenced by records, in index order
+        '''
+        return tuple(self._media)
+
+    @property
+    def period(self):
+        return self._c.period
+
+    @period.setter
+    def period(self, v):
+        if v < 1:
+            raise ValueError(f"bad period ('{v}')")
+        self._c.period = v
+
+    @property
+    def records(self):
+        '''Copy of the records, as a NumPy structured array
+
+        Media are indexed w.r.t. the `media` attribute, or -1 if none.
+        '''
+        n = self._c.size
+        records = numpy.empty(n, dtype=self._dtype)
+        if n == 0:
+            return records
+
+        size = n * ffi.sizeof('struct pumas_recorder_record')
+        data = numpy.frombuffer(ffi.buffer(self._c.records, size),
+            dtype=self._c_dtype)
+        for k in ('event', 'position', 'direction', 'energy', 'step'):
+            records[k] = data[k]
+
+        addresses, inverse = numpy.unique(data['medium'], return_inverse=True)
+        index = numpy.array([self._index.get(int(a), -1) for a in addresses],
+            dtype='i4')
+        records['medium'] = index[inverse]
+
+        return records
+
+    def _register(self, geometry):
+        '''Register the media of a geometry hierarchy
+        '''
+        if self._registered is not None:
+            ref, generation = self._registered
+            if (ref() is geometry) and (generation == geometry._generation):
+                return
+        self._registered = (weakref.ref(geometry), geometry._generation)
+
+        for medium in geometry._iter_media():
+            address = int(ffi.cast('uintptr_t', medium._c))
+            if address not in self._index:
+                self._index[address] = len(self._media)
+                self._media.append(medium)
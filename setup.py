@@ -5,6 +5,7 @@ setup(name='pumas',
       description='Python wrapper for PUMAS',
       author='Valentin Niess',
       packages=['pumas'],
+      package_data={'pumas': ['data/*.npy']},
       setup_requires=['cffi>=1.0.0'],
       cffi_modules=['pumas/pumas_build.py:ffi'],
       install_requires=['cffi>=1.0.0']